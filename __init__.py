@@ -22,8 +22,23 @@ from .qianfan import (
     _NODE_DISPLAY_NAME_MAPPINGS as qianfan_node_display,
 )
 
-NODE_CLASS_MAPPINGS = {**appbuilder_node_class, **qianfan_node_class}
-NODE_DISPLAY_NAME_MAPPINGS = {**appbuilder_node_display, **qianfan_node_display}
+from .batch_job import (
+    _NODE_CLASS_MAPPINGS as batch_job_node_class,
+    _NODE_DISPLAY_NAME_MAPPINGS as batch_job_node_display,
+)
+
+NODE_CLASS_MAPPINGS = {
+    **appbuilder_node_class,
+    **qianfan_node_class,
+    **batch_job_node_class,
+}
+NODE_DISPLAY_NAME_MAPPINGS = {
+    **appbuilder_node_display,
+    **qianfan_node_display,
+    **batch_job_node_display,
+}
+
+WEB_DIRECTORY = "./web"
 
-__all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS"]
+__all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS", "WEB_DIRECTORY"]
 
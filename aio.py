@@ -0,0 +1,130 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import typing as tg
+
+from .dispatch import ItemResult, get_executor
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+try:
+    import comfy.model_management as model_management
+except ImportError:
+    model_management = None
+
+T = tg.TypeVar("T")
+R = tg.TypeVar("R")
+
+# how often a waiting node thread checks whether its prompt was interrupted
+POLL_INTERVAL = 0.1
+
+_loop: asyncio.AbstractEventLoop | None = None
+_thread: threading.Thread | None = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Get the process-wide event loop, running on its own daemon thread"""
+    global _loop, _thread
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            # sync-only SDK calls go to the shared dispatch pool
+            _loop.set_default_executor(get_executor())
+            _thread = threading.Thread(
+                target=_loop.run_forever, name="qianfan-aio", daemon=True
+            )
+            _thread.start()
+        return _loop
+
+
+def submit(coro: tg.Coroutine[tg.Any, tg.Any, R]) -> concurrent.futures.Future[R]:
+    """
+    Schedule `coro` on the event loop thread. It runs in a copy of the caller's
+    context, so metrics annotations reach the caller's call record.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def interrupted() -> bool:
+    """Check whether the current ComfyUI prompt was interrupted"""
+    return model_management is not None and model_management.processing_interrupted()
+
+
+def run(coro: tg.Coroutine[tg.Any, tg.Any, R]) -> R:
+    """
+    Run `coro` on the event loop and block the calling thread for its result.
+    The coroutine is cancelled if the ComfyUI prompt is interrupted, or if the
+    calling thread is interrupted itself.
+    """
+    if threading.current_thread() is _thread:
+        coro.close()
+        raise RuntimeError("aio.run() called from the event loop thread, await instead")
+
+    future = submit(coro)
+    try:
+        while True:
+            done, _ = concurrent.futures.wait([future], timeout=POLL_INTERVAL)
+            if done:
+                return future.result()
+            if interrupted():
+                logger.info("Prompt interrupted, cancelling in-flight requests")
+                future.cancel()
+                model_management.throw_exception_if_processing_interrupted()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+async def map_concurrent(
+    fn: tg.Callable[[T], tg.Awaitable[R]],
+    items: tg.Iterable[T],
+    max_in_flight: int,
+) -> list[ItemResult[R]]:
+    """
+    Await `fn` over `items` with at most `max_in_flight` calls running at once.
+    Results keep the input order, a failing item is reported in its ItemResult
+    instead of failing the batch.
+    """
+    items = list(items)
+    results: list[ItemResult[R]] = [ItemResult() for _ in items]
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+
+    async def one(index: int, item: T) -> None:
+        async with semaphore:
+            try:
+                results[index].value = await fn(item)
+            except Exception as e:
+                logger.error(f"Batch item {index} failed, reason: {repr(e)}")
+                results[index].error = e
+
+    await asyncio.gather(*(one(i, item) for i, item in enumerate(items)))
+    return results
+
+
+__all__ = ["get_loop", "interrupted", "map_concurrent", "run", "submit"]
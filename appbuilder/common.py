@@ -13,12 +13,14 @@
 # limitations under the License.
 
 
+import asyncio
 import logging
-import os
+import types
+import typing as tg
 
-import appbuilder
-
-from ..config import QIANFAN_CONFIG, reload_config
+from ..clients import get_client
+from ..credentials import Credential, get_pool
+from ..model_catalog import get_catalog
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -32,46 +34,72 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def set_env():
-    """Set environment vars"""
-    reload_config()
-
-    os.environ["APPBUILDER_TOKEN"] = QIANFAN_CONFIG.get("appbuilder_api_key")
+def sdk() -> types.ModuleType:
+    """Import AppBuilder SDK on first use, so registering nodes stays light"""
+    import appbuilder
 
+    return appbuilder
 
-set_env()
 
+DEFAULT_MODEL_LIST = [
+    "ERNIE-4.0-8K",
+    "ERNIE-3.5-8K",
+    "ERNIE-Speed-8K",
+    "ERNIE-Speed-128K（预览版）",
+    "ERNIE-Lite-8K",
+    "ERNIE-Tiny-8K",
+    "ERNIE-Character-8K",
+    "ERNIE-Functions-8K",
+    "ERNIE Speed-AppBuilder",
+    "ERNIE-Bot 4.0",
+    "ERNIE-Bot",
+    "ERNIE-Speed",
+    "EB-turbo-AppBuilder专用版",
+]
 
-def get_model_list(api_type_filter=list[str]) -> list[str]:
-    """Get model list from AppBuilder"""
-    set_env()
 
-    res = [
-        "ERNIE-4.0-8K",
-        "ERNIE-3.5-8K",
-        "ERNIE-Speed-8K",
-        "ERNIE-Speed-128K（预览版）",
-        "ERNIE-Lite-8K",
-        "ERNIE-Tiny-8K",
-        "ERNIE-Character-8K",
-        "ERNIE-Functions-8K",
-        "ERNIE Speed-AppBuilder",
-        "ERNIE-Bot 4.0",
-        "ERNIE-Bot",
-        "ERNIE-Speed",
-        "EB-turbo-AppBuilder专用版",
-    ]
+def get_model_list(api_type_filter: list[str]) -> list[str]:
+    """Get model list from AppBuilder, served from cache without blocking"""
 
-    try:
-        return sorted(
-            model
-            for model in appbuilder.get_model_list(
-                api_type_filter=api_type_filter, is_available=True
+    def fetch() -> list[str]:
+        pool = get_pool()
+        cred = pool.acquire("appbuilder")
+        try:
+            return sorted(
+                sdk().get_model_list(
+                    secret_key=cred.appbuilder_api_key,
+                    api_type_filter=api_type_filter,
+                    is_available=True,
+                )
             )
-        )
-    except Exception as e:
-        logging.warn(
-            f"Failed to get model list, will return default model list, reason: {repr(e)}"
-        )
+        finally:
+            pool.release(cred)
+
+    name = "appbuilder:" + ",".join(api_type_filter)
+    return get_catalog(name, fetch, DEFAULT_MODEL_LIST).get()
+
+
+def get_component(name: str, cred: Credential, **kwargs: str) -> tg.Any:
+    """
+    Get a shared AppBuilder component client, e.g. Playground, of a credential set,
+    constructed with `kwargs`
+    """
+    return get_client(
+        f"appbuilder.{name}@{cred.name}",
+        tuple(sorted(kwargs.items())),
+        lambda: getattr(sdk(), name)(secret_key=cred.appbuilder_api_key, **kwargs),
+        (cred.appbuilder_api_key,),
+    )
+
+
+async def acall(component: tg.Any, *args: tg.Any, **kwargs: tg.Any) -> tg.Any:
+    """
+    Call an AppBuilder component without blocking the event loop: natively if it
+    implements `arun`, else on the dispatch pool (most components only inherit
+    the `arun` stub).
+    """
+    from appbuilder.core.component import Component
 
-    return res
+    if type(component).arun is not Component.arun:
+        return await component.arun(*args, **kwargs)
+    return await asyncio.to_thread(component, *args, **kwargs)
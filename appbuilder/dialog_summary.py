@@ -12,12 +12,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
-import json
+import re
+import typing as tg
+import zlib
 
-import appbuilder
-
-from .common import get_model_list, set_env
+from ..aio import map_concurrent, run
+from ..broker import brokered
+from ..credentials import Credential
+from ..extraction import FieldExtractor, extract_fields
+from ..metrics import annotate, record_usage, track
+from ..rate_limit import arate_limited
+from ..response_cache import acached_call, make_key
+from ..streaming import stream_text
+from ..tokens import count_tokens, history_budget
+from .common import acall, get_component, get_model_list, sdk
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -30,6 +40,294 @@ formatter = logging.Formatter(
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+SUMMARY_FIELDS = ("诉求", "回应", "解决情况")
+# upstream calls repeated when no summary field can be recovered from the reply
+EXTRACT_RETRIES = 1
+
+# windows of a long dialog summarized at once
+CHUNK_MAX_IN_FLIGHT = 8
+# a window may end early at a turn whose hash is a multiple of this, once it
+# holds half its budget, so an edit only moves the boundaries near it
+CHUNK_BOUNDARY_MODULUS = 4
+
+REDUCE_PROMPT = (
+    "以下是一段长对话按顺序分段后各段的总结：\n\n{summaries}\n\n"
+    "请将它们合并为整段对话的总结，只输出JSON，包含"
+    '"诉求"、"回应"、"解决情况"三个字段。'
+)
+
+_turn_re = re.compile(r"^\s*[^\s:：]{1,16}\s*[:：]")
+_sentence_re = re.compile(r"(?<=[。！？!?；;\n])")
+
+
+def split_turns(dialog: str) -> list[str]:
+    """Split a dialog into speaker turns, lines without a `speaker:` prefix continue the turn"""
+    turns: list[str] = []
+    for line in dialog.splitlines():
+        if not line.strip():
+            continue
+        if turns and not _turn_re.match(line):
+            turns[-1] += "\n" + line
+        else:
+            turns.append(line)
+    return turns
+
+
+def _fitting_prefix(text: str, budget: int) -> int:
+    """Get the length of the longest prefix of `text` within `budget`, at least 1"""
+    # token counts only grow with the prefix
+    lo, hi = 1, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _split_long(turn: str, budget: int) -> list[str]:
+    """Split one turn longer than `budget` on sentence ends, or hard if a sentence is too long"""
+    pieces: list[str] = []
+    for sentence in _sentence_re.split(turn):
+        while count_tokens(sentence) > budget:
+            end = _fitting_prefix(sentence, budget)
+            pieces.append(sentence[:end])
+            sentence = sentence[end:]
+        if pieces and count_tokens(pieces[-1] + sentence) <= budget:
+            pieces[-1] += sentence
+        elif sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def chunk_dialog(dialog: str, budget: int) -> list[str]:
+    """
+    Pack the turns of a dialog into windows of at most `budget` tokens.
+    Boundaries depend on turn content, not only on the position, so windows
+    away from an edit stay the same and keep their cached summaries.
+    """
+    # (separator before the piece, piece), pieces of a split turn are rejoined as they were
+    pieces: list[tuple[str, str]] = []
+    for turn in split_turns(dialog):
+        parts = _split_long(turn, budget) if count_tokens(turn) > budget else [turn]
+        pieces.extend(("\n" if i == 0 else "", part) for i, part in enumerate(parts))
+
+    chunks: list[str] = []
+    window: list[tuple[str, str]] = []
+    size = 0
+
+    def flush() -> None:
+        nonlocal window, size
+        chunks.append(window[0][1] + "".join(sep + piece for sep, piece in window[1:]))
+        window, size = [], 0
+
+    for sep, piece in pieces:
+        tokens = count_tokens(piece)
+        if window and size + tokens > budget:
+            flush()
+        window.append((sep, piece))
+        size += tokens
+        if (
+            size >= budget // 2
+            and zlib.crc32(piece.encode("utf-8")) % CHUNK_BOUNDARY_MODULUS == 0
+        ):
+            flush()
+    if window:
+        flush()
+    return chunks
+
+
+async def _request(
+    model: str,
+    dialog: str,
+    extractor: FieldExtractor,
+    stream: bool = False,
+    unique_id: str | None = None,
+) -> str:
+    """Call the DialogSummary component, streamed text is fed to `extractor`"""
+    if stream:
+        messages = []
+
+        def start_stream(cred: Credential) -> tg.Awaitable[str]:
+            component = get_component("DialogSummary", cred, model=model)
+
+            def start() -> tg.Iterable[str]:
+                messages.append(component(sdk().Message(dialog), stream=True))
+                for chunk in messages[-1].content:
+                    for field in extractor.feed(chunk):
+                        logger.debug(f"DialogSummary {field} complete")
+                    yield chunk
+
+            # the SDK streams through a blocking generator, consume it off the loop
+            return asyncio.to_thread(stream_text, start, unique_id)
+
+        content = await arate_limited(
+            f"appbuilder:{model}", start_stream, dialog, "appbuilder"
+        )
+        record_usage(messages[-1])
+        return content
+
+    resp = await arate_limited(
+        f"appbuilder:{model}",
+        lambda cred: acall(
+            get_component("DialogSummary", cred, model=model),
+            sdk().Message(dialog),
+            stream=False,
+        ),
+        dialog,
+        "appbuilder",
+    )
+    record_usage(resp)
+    return resp.content
+
+
+async def _summarize(
+    request: tg.Callable[[FieldExtractor], tg.Awaitable[str]],
+) -> tuple[str, str, str, str]:
+    """
+    Get summary fields and the raw reply of `request`, asking again if no field
+    is found. Fields are empty if the reply still has none.
+    """
+    for attempt in range(EXTRACT_RETRIES + 1):
+        extractor = FieldExtractor(SUMMARY_FIELDS)
+        content = await request(extractor)
+
+        # fields completed while streaming need no second pass
+        fields = (
+            extractor.values
+            if extractor.done
+            else extract_fields(content, SUMMARY_FIELDS)
+        )
+        if fields is not None:
+            return (*(fields[f] for f in SUMMARY_FIELDS), content)
+
+        if attempt < EXTRACT_RETRIES:
+            logger.warning(f"No summary fields in reply, retrying: {content}")
+            annotate(retries=1)
+
+    logger.error(f"Failed to parse json: {content}")
+    return ("", "", "", content)
+
+
+def _has_fields(res: tuple[str, ...]) -> bool:
+    """Check whether a summary has fields, a reply without any is not cached so it can be retried"""
+    return any(res[: len(SUMMARY_FIELDS)])
+
+
+def _format_partials(partials: list[tuple[str, ...]]) -> str:
+    return "\n".join(
+        f"第{i + 1}段 " + "；".join(f"{f}：{v}" for f, v in zip(SUMMARY_FIELDS, p))
+        for i, p in enumerate(partials)
+    )
+
+
+def _join(partials: list[tuple[str, ...]]) -> tuple[str, str, str, str]:
+    """Concatenate window summaries field by field, the fallback of a failed merge"""
+    fields = [
+        "；".join(dict.fromkeys(p[i] for p in partials if p[i]))
+        for i in range(len(SUMMARY_FIELDS))
+    ]
+    return (*fields, "\n".join(p[-1] for p in partials))
+
+
+async def _merge(model: str, partials: list[tuple[str, ...]]) -> tuple[str, ...]:
+    """Merge summaries of consecutive windows with one PlayGround call"""
+    if len(partials) == 1:
+        return partials[0]
+    summaries = _format_partials(partials)
+
+    async def request(extractor: FieldExtractor) -> str:
+        resp = await arate_limited(
+            f"appbuilder:{model}",
+            lambda cred: acall(
+                get_component(
+                    "Playground", cred, prompt_template=REDUCE_PROMPT, model=model
+                ),
+                sdk().Message({"summaries": summaries}),
+                stream=False,
+            ),
+            summaries,
+            "appbuilder",
+        )
+        record_usage(resp)
+        return resp.content
+
+    key = make_key("dialog_summary_merge", model=model, summaries=summaries)
+    res = await acached_call(key, lambda: _summarize(request), True, cacheable=_has_fields)
+    return res if _has_fields(res) else _join(partials)
+
+
+async def _reduce(
+    model: str, partials: list[tuple[str, ...]], budget: int
+) -> tuple[str, ...]:
+    """Merge window summaries, in rounds over groups that fit `budget` if there are many"""
+    budget -= count_tokens(REDUCE_PROMPT)
+    while len(partials) > 1:
+        groups: list[list[tuple[str, ...]]] = [[]]
+        for partial in partials:
+            if groups[-1] and count_tokens(_format_partials(groups[-1] + [partial])) > budget:
+                groups.append([])
+            groups[-1].append(partial)
+        if len(groups) == len(partials):
+            # summaries too long to pair up, merge them all at once
+            groups = [partials]
+
+        partials = list(await asyncio.gather(*(_merge(model, g) for g in groups)))
+    return partials[0]
+
+
+async def _summarize_chunks(model: str, chunks: list[str], budget: int) -> tuple[str, ...]:
+    """Summarize the windows of a long dialog concurrently, then reduce their summaries"""
+
+    async def one(chunk: str) -> tuple[str, ...]:
+        key = make_key("dialog_summary", model=model, dialog=chunk)
+        return await acached_call(
+            key,
+            lambda: _summarize(lambda e: _request(model, chunk, e)),
+            True,
+            cacheable=_has_fields,
+        )
+
+    results = await map_concurrent(one, chunks, CHUNK_MAX_IN_FLIGHT)
+    for r in results:
+        if not r.ok:
+            raise r.error
+    return await _reduce(model, [r.value for r in results], budget)
+
+
+@brokered("dialog_summary")
+async def _dialog_summary(
+    *,
+    model: str,
+    dialog: str,
+    use_cache: bool = False,
+    stream: bool = False,
+    chunk_tokens: int = 0,
+    unique_id: str | None = None,
+) -> tuple[str, ...]:
+    """Get the fields and content of the summary of `dialog`"""
+    budget = chunk_tokens or history_budget(model)
+    if budget < 1:
+        raise ValueError(
+            f"no tokens left for the dialog: history_output_reserve is not below the "
+            f"context size of {model}, lower it, set model_context_tokens or chunk_tokens"
+        )
+    chunks = chunk_dialog(dialog, budget) if count_tokens(dialog) > budget else []
+
+    async def call() -> tuple[str, ...]:
+        if len(chunks) > 1:
+            logger.info(f"Summarizing dialog in {len(chunks)} windows")
+            return await _summarize_chunks(model, chunks, budget)
+        return await _summarize(
+            lambda extractor: _request(model, dialog, extractor, stream, unique_id)
+        )
+
+    key = make_key("dialog_summary", model=model, dialog=dialog)
+    if len(chunks) > 1:
+        key = make_key("dialog_summary", model=model, dialog=dialog, chunk_tokens=budget)
+    return await acached_call(key, call, use_cache, cacheable=_has_fields)
+
 
 class DialogSummary:
     """
@@ -59,46 +357,72 @@ class DialogSummary:
                     },
                 ),
             },
+            "optional": {
+                "use_cache": ("BOOLEAN", {"default": False}),
+                "stream": ("BOOLEAN", {"default": False}),
+                "chunk_tokens": ("INT", {"default": 0, "min": 0, "max": 131072}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: str,
+        dialog: str,
+        use_cache: bool = False,
+        stream: bool = False,
+        chunk_tokens: int = 0,
+        unique_id: str | None = None,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of inputs"""
+        return make_key(
+            "dialog_summary", model=model, dialog=dialog, chunk_tokens=chunk_tokens
+        )
+
     RETURN_TYPES = (
         "STRING",
         "STRING",
         "STRING",
         "STRING",
+        "STRING",
     )
     RETURN_NAMES = (
         "needs",
         "response",
         "solution",
         "raw_response",
+        "stats",
     )
 
     FUNCTION = "dialog_summary"
 
     CATEGORY = "QianFan/AppBuilder"
 
-    def dialog_summary(
+    def dialog_summary(self, **kwargs: tg.Any) -> tuple[str, str, str, str, str]:
+        """Execute appbuilder dialog_summary model, blocking until `adialog_summary` finishes"""
+        return run(self.adialog_summary(**kwargs))
+
+    async def adialog_summary(
         self,
         model: str,
         dialog: str,
-    ) -> tuple[str, str, str, str]:
-        """Execute appbuilder dialog_summary model"""
-        set_env()
-
-        ds = appbuilder.DialogSummary(model=model)
-        params = appbuilder.Message(dialog)
-        resp: appbuilder.core.message.Message = ds(params, stream=False)
-
-        try:
-            data = json.loads(resp.content)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse json: {resp.content}, reason: {repr(e)}")
-            data = {}
-
-        return (
-            data.get("诉求", ""),
-            data.get("回应", ""),
-            data.get("解决情况", ""),
-            resp.content,
-        )
+        use_cache: bool = False,
+        stream: bool = False,
+        chunk_tokens: int = 0,
+        unique_id: str | None = None,
+    ) -> tuple[str, str, str, str, str]:
+        """Execute appbuilder dialog_summary model, map-reduce over windows of a long dialog"""
+        with track("dialog_summary", f"appbuilder:{model}") as rec:
+            res = await _dialog_summary(
+                model=model,
+                dialog=dialog,
+                use_cache=use_cache,
+                stream=stream,
+                chunk_tokens=chunk_tokens,
+                unique_id=unique_id,
+            )
+
+        return (*res, rec.to_json())
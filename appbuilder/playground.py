@@ -12,12 +12,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import typing as tg
 
-import appbuilder
-import yaml
+from ..aio import map_concurrent, run
+from ..broker import brokered
+from ..credentials import Credential
+from ..dispatch import ItemResult
+from ..metrics import record_usage, track
+from ..parsing import load_text
+from ..rate_limit import arate_limited
+from ..response_cache import acached_call, make_key
+from ..streaming import stream_text
+from ..templates import compile_template, expand_params
+from .common import acall, get_component, get_model_list, sdk
 
-from .common import get_model_list, set_env
+DEFAULT_MAX_IN_FLIGHT = 8
+
+
+@brokered("playground")
+async def _generate(
+    *,
+    model: str,
+    prompt_template: str,
+    params: dict[str, tg.Any],
+    use_cache: bool = False,
+    stream: bool = False,
+    unique_id: str | None = None,
+) -> str:
+    """Render the template with `params` and generate from it"""
+    template = compile_template(prompt_template)
+    prompt = template.render(params)
+    message = sdk().Message(prompt)
+
+    def get_play(cred: Credential) -> tg.Any:
+        # rendered locally, so one component per model serves every template
+        return get_component("Playground", cred, model=model)
+
+    async def call() -> tuple[str]:
+        if stream:
+            messages = []
+
+            def start_stream(cred: Credential) -> tg.Awaitable[str]:
+                play = get_play(cred)
+
+                def start() -> tg.Iterable[str]:
+                    messages.append(play(message, stream=True))
+                    return messages[-1].content
+
+                # the SDK streams through a blocking generator, consume it off the loop
+                return asyncio.to_thread(stream_text, start, unique_id)
+
+            res = await arate_limited(
+                f"appbuilder:{model}", start_stream, prompt, "appbuilder"
+            )
+            record_usage(messages[-1])
+            return (res,)
+
+        resp = await arate_limited(
+            f"appbuilder:{model}",
+            lambda cred: acall(get_play(cred), message, stream=False),
+            prompt,
+            "appbuilder",
+        )
+        record_usage(resp)
+        return (resp.content,)
+
+    key = make_key(
+        "playground", model=model, prompt_template=template.text, params=params
+    )
+    # the rendered prompts of a template are mostly the same text, compare parameters instead
+    similar = (
+        (
+            make_key("playground", model=model, prompt_template=template.text),
+            [str(params[name]) for name in template.fields],
+        )
+        if template.fields
+        else None
+    )
+    return (await acached_call(key, call, use_cache, similar))[0]
 
 
 class PlayGround:
@@ -86,19 +159,41 @@ class PlayGround:
                     },
                 ),
             },
+            "optional": {
+                "use_cache": ("BOOLEAN", {"default": False}),
+                "stream": ("BOOLEAN", {"default": False}),
+                "max_in_flight": (
+                    "INT",
+                    {"default": DEFAULT_MAX_IN_FLIGHT, "min": 1, "max": 256},
+                ),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
         }
 
     # INPUT_IS_LIST = True
 
-    # @classmethod
-    # def IS_CHANGED(
-    #     s,
-    #     model: str,
-    #     prompt_template: str,
-    #     params_yaml: str,
-    # ) -> tg.Hashable:
-    #     """self defined input change detection function"""
-    #     pass
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: str,
+        prompt_template: str,
+        params_yaml: str,
+        use_cache: bool = False,
+        stream: bool = False,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        unique_id: str | None = None,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of parsed inputs"""
+        try:
+            params = load_text(params_yaml, copy=False)
+        except Exception:
+            params = {"raw": params_yaml}
+
+        return make_key(
+            "playground", model=model, prompt_template=prompt_template, params=params
+        )
 
     @classmethod
     def VALIDATE_INPUTS(
@@ -107,17 +202,30 @@ class PlayGround:
         prompt_template: str,
         params_yaml: str,
     ) -> tg.Literal[True] | str:
-        """self defined validation function"""
+        """self defined validation function, every rendering must fill all placeholders"""
+        try:
+            template = compile_template(prompt_template)
+        except ValueError as e:
+            return f"error parsing prompt_template: {e}"
+
         try:
-            _ = yaml.safe_load(params_yaml)
+            params = load_text(params_yaml, copy=False)
+            renderings = expand_params(params, template)
         except Exception as e:
             return f"error parsing params_yaml: {repr(e)}"
 
+        for i, rendering in enumerate(renderings or [params]):
+            missing = template.missing(rendering)
+            if missing:
+                where = f"rendering {i}" if renderings is not None else "params_yaml"
+                return f"{where} has no value for {', '.join(missing)}"
+
         return True
 
-    RETURN_TYPES = ("STRING",)
-    # RETURN_NAMES = ("image_output_name",)
-    # OUTPUT_IS_LIST = (True, )
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("result", "stats", "errors")
+    # one result per rendering of a params sweep, in order
+    OUTPUT_IS_LIST = (True, False, True)
 
     FUNCTION = "playground"
 
@@ -125,16 +233,54 @@ class PlayGround:
 
     CATEGORY = "QianFan/AppBuilder"
 
-    def playground(
+    def playground(self, **kwargs: tg.Any) -> tuple[list[str], str, list[str]]:
+        """Execute appbuilder playground model, blocking until `aplayground` finishes"""
+        return run(self.aplayground(**kwargs))
+
+    async def aplayground(
         self,
         model: str,
         prompt_template: str,
         params_yaml: str,
-    ) -> tuple[str]:
-        """Execute appbuilder playground model"""
-        set_env()
+        use_cache: bool = False,
+        stream: bool = False,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        unique_id: str | None = None,
+    ) -> tuple[list[str], str, list[str]]:
+        """
+        Execute appbuilder playground model, once per rendering of a params sweep.
+        A failed rendering of a sweep outputs an empty string and its error.
+        """
+        template = compile_template(prompt_template)
+        params = load_text(params_yaml)
+        sweep = expand_params(params, template)
 
-        play = appbuilder.Playground(prompt_template=prompt_template, model=model)
-        params = appbuilder.Message(yaml.safe_load(params_yaml))
-        resp = play(params, stream=False)
-        return (resp.content,)
+        with track("playground", f"appbuilder:{model}") as rec:
+            if sweep is None:
+                res = await _generate(
+                    model=model,
+                    prompt_template=template.text,
+                    params=params,
+                    use_cache=use_cache,
+                    stream=stream,
+                    unique_id=unique_id,
+                )
+                results = [ItemResult(value=res)]
+            else:
+                # streamed renderings would overwrite each other's preview
+                results = await map_concurrent(
+                    lambda p: _generate(
+                        model=model,
+                        prompt_template=template.text,
+                        params=p,
+                        use_cache=use_cache,
+                    ),
+                    sweep,
+                    max_in_flight,
+                )
+
+        return (
+            [r.value if r.ok else "" for r in results],
+            rec.to_json(),
+            ["" if r.ok else repr(r.error) for r in results],
+        )
@@ -0,0 +1,458 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import asyncio
+import collections
+import dataclasses
+import json
+import logging
+import os
+import sys
+import time
+import typing as tg
+
+from .aio import run
+from .appbuilder.dialog_summary import DialogSummary
+from .appbuilder.playground import PlayGround
+from .qianfan import Chat, Completion
+from .response_cache import make_key
+from .streaming import send_progress
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+JOB_KINDS = ["playground", "chat", "completion", "dialog_summary"]
+
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# finished lines held back to keep the output in input order, per in-flight request
+REORDER_WINDOW = 4
+
+# seconds between checkpoint writes
+CHECKPOINT_INTERVAL = 1.0
+
+Handler = tg.Callable[[dict], tg.Awaitable[str | list[str]]]
+
+
+@dataclasses.dataclass
+class Checkpoint:
+    """
+    Progress of a job. Output up to `output_offset` holds the results of input
+    up to `input_offset`, anything written after it is redone on resume.
+    """
+
+    input_path: str
+    input_offset: int = 0
+    output_offset: int = 0
+    lines: int = 0
+    done: int = 0
+    failed: int = 0
+    complete: bool = False
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint | None":
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring broken checkpoint {path}, reason: {repr(e)}")
+            return None
+
+    def save(self, path: str) -> None:
+        """Write atomically, a crash leaves either the old or the new checkpoint"""
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dataclasses.asdict(self), f)
+        os.replace(tmp, path)
+
+
+def checkpoint_path(output_path: str) -> str:
+    return output_path + ".ckpt"
+
+
+def default_output_path(input_path: str) -> str:
+    root, _ = os.path.splitext(input_path)
+    return root + ".out.jsonl"
+
+
+def make_handler(
+    kind: str,
+    model: str,
+    prompt_template: str = "",
+    endpoint: str = "",
+    use_cache: bool = False,
+) -> Handler:
+    """
+    Get the coroutine turning one input record into result text. Records give
+    the node input of `kind` (params, messages, prompt or dialog) and may
+    override `model` / `prompt_template` per line.
+    """
+    match kind:
+        case "playground":
+            playground = PlayGround()
+
+            async def handle(record: dict) -> str | list[str]:
+                params = record.get("params", record)
+                results, _, errors = await playground.aplayground(
+                    model=record.get("model", model),
+                    prompt_template=record.get("prompt_template", prompt_template),
+                    params_yaml=json.dumps(params, ensure_ascii=False),
+                    use_cache=use_cache,
+                )
+                for error in errors:
+                    if error:
+                        raise RuntimeError(error)
+                # a params sweep in one record gives a list of results
+                return results if len(results) > 1 else results[0]
+
+        case "chat":
+            chat = Chat()
+
+            async def handle(record: dict) -> str:
+                messages = record["messages"]
+                if not isinstance(messages, str):
+                    messages = json.dumps(messages, ensure_ascii=False)
+                res = await chat.achat(
+                    model=record.get("model", model),
+                    messages_yaml=messages,
+                    endpoint=endpoint,
+                    history_yaml=None,
+                    use_cache=use_cache,
+                )
+                return res[0]
+
+        case "completion":
+            completion = Completion()
+
+            async def handle(record: dict) -> str:
+                res = await completion.acompletion(
+                    model=record.get("model", model),
+                    prompt=record["prompt"],
+                    endpoint=endpoint,
+                    use_cache=use_cache,
+                )
+                return res[0]
+
+        case "dialog_summary":
+            dialog_summary = DialogSummary()
+
+            async def handle(record: dict) -> str:
+                res = await dialog_summary.adialog_summary(
+                    model=record.get("model", model),
+                    dialog=record["dialog"],
+                    use_cache=use_cache,
+                )
+                # raw json response
+                return res[3]
+
+        case _:
+            raise ValueError(f"unknown job kind: {kind}")
+
+    return handle
+
+
+async def run_job(
+    input_path: str,
+    output_path: str,
+    handle: Handler,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    resume: bool = True,
+    on_progress: tg.Callable[[Checkpoint, float], None] | None = None,
+    overwrite: bool = False,
+) -> Checkpoint:
+    """
+    Stream JSONL `input_path` through `handle` with at most `max_in_flight`
+    requests running, appending one result line per input line to
+    `output_path` in input order. Progress is checkpointed next to the output,
+    with `resume` an interrupted job continues after the last checkpoint.
+    Starting over replaces an existing output only with `overwrite`.
+    """
+    input_path = os.path.abspath(input_path)
+    ckpt_path = checkpoint_path(output_path)
+
+    ckpt = Checkpoint.load(ckpt_path) if resume else None
+    if (
+        ckpt is None
+        or ckpt.input_path != input_path
+        or not os.path.exists(output_path)
+        or os.path.getsize(output_path) < ckpt.output_offset
+    ):
+        if not overwrite and os.path.exists(output_path) and os.path.getsize(output_path):
+            raise FileExistsError(
+                f"{output_path} already exists and is not resumed from a checkpoint, "
+                "set overwrite to replace it or choose another output path"
+            )
+        ckpt = Checkpoint(input_path)
+    elif ckpt.complete:
+        logger.info(f"Job {output_path} already complete, {ckpt.done} lines")
+        return ckpt
+    else:
+        logger.info(f"Resuming job {output_path} after input line {ckpt.lines}")
+
+    input_size = os.path.getsize(input_path)
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+    window_size = max(1, max_in_flight) * REORDER_WINDOW
+
+    async def one(line_no: int, raw: bytes) -> dict:
+        out: dict[str, tg.Any] = {"line": line_no}
+        async with semaphore:
+            try:
+                record = json.loads(raw)
+                if not isinstance(record, dict):
+                    raise ValueError("input line must be a json object")
+                if "id" in record:
+                    out["id"] = record["id"]
+                out["result"] = await handle(record)
+            except Exception as e:
+                logger.error(f"Job line {line_no} failed, reason: {repr(e)}")
+                out["error"] = repr(e)
+        return out
+
+    # (input line, input offset after it, task or None for a blank line)
+    window: collections.deque[tuple[int, int, asyncio.Task | None]] = (
+        collections.deque()
+    )
+
+    with open(input_path, "rb") as fin, open(
+        output_path, "r+b" if os.path.exists(output_path) else "wb"
+    ) as fout:
+        fout.truncate(ckpt.output_offset)
+        fout.seek(ckpt.output_offset)
+        fin.seek(ckpt.input_offset)
+        last_save = time.monotonic()
+
+        def save() -> None:
+            fout.flush()
+            ckpt.output_offset = fout.tell()
+            ckpt.save(ckpt_path)
+            if on_progress is not None:
+                on_progress(ckpt, ckpt.input_offset / input_size if input_size else 1.0)
+
+        async def write_head() -> None:
+            nonlocal last_save
+            line_no, offset, task = window[0]
+            if task is not None:
+                out = await task
+                fout.write((json.dumps(out, ensure_ascii=False) + "\n").encode("utf-8"))
+                ckpt.done += 1
+                ckpt.failed += "error" in out
+            window.popleft()
+            ckpt.lines, ckpt.input_offset = line_no, offset
+
+            if time.monotonic() - last_save >= CHECKPOINT_INTERVAL:
+                save()
+                last_save = time.monotonic()
+
+        line_no = ckpt.lines
+        try:
+            for raw in fin:
+                line_no += 1
+                while len(window) >= window_size:
+                    await write_head()
+                task = asyncio.ensure_future(one(line_no, raw)) if raw.strip() else None
+                window.append((line_no, fin.tell(), task))
+
+            while window:
+                await write_head()
+            ckpt.complete = True
+        finally:
+            for _, _, task in window:
+                if task is not None:
+                    task.cancel()
+            save()
+
+    logger.info(
+        f"Job {output_path} complete, {ckpt.done} lines, {ckpt.failed} failed"
+    )
+    return ckpt
+
+
+class BatchJob:
+    """
+    QianFan Batch Job Node
+    Run a node over every line of a JSONL file, writing results to an output
+    JSONL as they finish. Re-running resumes an interrupted job.
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "input_path": ("STRING", {"default": ""}),
+                "kind": (JOB_KINDS,),
+                "model": ("STRING", {"default": "ERNIE-Speed-8K"}),
+                "prompt_template": (
+                    "STRING",
+                    {
+                        "multiline": True,
+                        "default": "请想象一幅包含 {object} 的画面，并描述这幅画面。",
+                    },
+                ),
+            },
+            "optional": {
+                "output_path": ("STRING", {"default": ""}),
+                "endpoint": ("STRING", {"default": ""}),
+                "max_in_flight": (
+                    "INT",
+                    {"default": DEFAULT_MAX_IN_FLIGHT, "min": 1, "max": 256},
+                ),
+                "use_cache": ("BOOLEAN", {"default": False}),
+                "resume": ("BOOLEAN", {"default": True}),
+                "overwrite": ("BOOLEAN", {"default": False}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
+        }
+
+    @classmethod
+    def IS_CHANGED(s, input_path: str, **kwargs: tg.Any) -> tg.Hashable:
+        """self defined input change detection function, also reruns if the input file changed"""
+        try:
+            stat = os.stat(input_path)
+            file_key = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_key = None
+        kwargs.pop("unique_id", None)
+        return make_key("batch_job", input_path=input_path, file=file_key, inputs=kwargs)
+
+    @classmethod
+    def VALIDATE_INPUTS(s, input_path: str, kind: str) -> tg.Literal[True] | str:
+        """self defined validation function"""
+        if not os.path.isfile(input_path):
+            return f"input file not found: {input_path}"
+        if kind not in JOB_KINDS:
+            return f"unknown job kind: {kind}"
+
+        return True
+
+    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_NAMES = ("output_path", "stats")
+
+    FUNCTION = "batch_job"
+
+    OUTPUT_NODE = True
+
+    CATEGORY = "QianFan"
+
+    def batch_job(
+        self,
+        input_path: str,
+        kind: str,
+        model: str,
+        prompt_template: str,
+        output_path: str = "",
+        endpoint: str = "",
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        use_cache: bool = False,
+        resume: bool = True,
+        overwrite: bool = False,
+        unique_id: str | None = None,
+    ) -> tuple[str, str]:
+        """Run the job, blocking until it completes or the prompt is interrupted"""
+        output_path = output_path or default_output_path(input_path)
+
+        def on_progress(ckpt: Checkpoint, fraction: float) -> None:
+            send_progress(
+                unique_id,
+                f"{fraction:.1%} of input, {ckpt.done} lines done, {ckpt.failed} failed",
+            )
+
+        ckpt = run(
+            run_job(
+                input_path,
+                output_path,
+                make_handler(kind, model, prompt_template, endpoint, use_cache),
+                max_in_flight,
+                resume,
+                on_progress,
+                overwrite,
+            )
+        )
+        send_progress(unique_id, f"{ckpt.done} lines done, {ckpt.failed} failed", done=True)
+
+        return (output_path, json.dumps(dataclasses.asdict(ckpt), ensure_ascii=False))
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Command line entry point, see `python cli.py batch-job --help`"""
+    parser = argparse.ArgumentParser(
+        prog="batch-job", description="Run a node over every line of a JSONL file"
+    )
+    parser.add_argument("input", help="input JSONL, one json object per line")
+    parser.add_argument("-o", "--output", help="output JSONL, default <input>.out.jsonl")
+    parser.add_argument("--kind", choices=JOB_KINDS, default="playground")
+    parser.add_argument("--model", default="ERNIE-Speed-8K")
+    parser.add_argument("--template", default="", help="prompt template of playground jobs")
+    parser.add_argument("--endpoint", default="")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--use-cache", action="store_true")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="replace an output that cannot be resumed"
+    )
+    args = parser.parse_args(argv)
+
+    def on_progress(ckpt: Checkpoint, fraction: float) -> None:
+        print(
+            f"\r{fraction:6.1%}  {ckpt.done} done  {ckpt.failed} failed",
+            end="",
+            file=sys.stderr,
+            flush=True,
+        )
+
+    try:
+        ckpt = run(
+            run_job(
+                args.input,
+                args.output or default_output_path(args.input),
+                make_handler(
+                    args.kind, args.model, args.template, args.endpoint, args.use_cache
+                ),
+                args.max_in_flight,
+                not args.restart,
+                on_progress,
+                args.overwrite,
+            )
+        )
+    except FileExistsError as e:
+        parser.error(str(e))
+    print(file=sys.stderr)
+    return 0 if ckpt.complete else 1
+
+
+_NODE_CLASS_MAPPINGS = {
+    "QianFan Batch Job": BatchJob,
+}
+
+_NODE_DISPLAY_NAME_MAPPINGS = {
+    "QianFan Batch Job": "QianFan Batch Job",
+}
+
+__all__ = ["_NODE_CLASS_MAPPINGS", "_NODE_DISPLAY_NAME_MAPPINGS"]
@@ -0,0 +1,60 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared helpers for benchmark scripts"""
+
+import importlib
+import pathlib
+import sys
+import time
+import types
+import typing as tg
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+PACKAGE_NAME = "comfyui_qianfan_llm"
+
+
+def load_package() -> types.ModuleType:
+    """
+    Register the repo as an importable package without running its `__init__.py`,
+    so submodules can be imported one by one without pulling in the SDKs.
+
+    The repo root is not put on sys.path, since the `qianfan` and `appbuilder`
+    subpackages would shadow the SDKs of the same name.
+    """
+    if PACKAGE_NAME not in sys.modules:
+        pkg = types.ModuleType(PACKAGE_NAME)
+        pkg.__path__ = [str(ROOT)]
+        sys.modules[PACKAGE_NAME] = pkg
+
+    return sys.modules[PACKAGE_NAME]
+
+
+def import_module(name: str) -> types.ModuleType:
+    """Import `name` relative to the repo package"""
+    load_package()
+    return importlib.import_module(f"{PACKAGE_NAME}.{name}")
+
+
+def timeit(fn: tg.Callable[[], tg.Any], number: int) -> float:
+    """Return mean seconds per call of `fn` over `number` calls"""
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+def report(name: str, seconds: float) -> None:
+    """Print one benchmark line"""
+    print(f"{name:<48} {seconds * 1e6:>12.2f} us/call")
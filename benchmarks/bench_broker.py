@@ -0,0 +1,228 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+N node processes calling Chat (Batch) against the local stub server, either
+each on its own or all through one broker: aggregate throughput, upstream
+requests and throttled requests. Clients draw prompts from a shared pool, and
+the stub enforces a QPS quota that every process is configured for, like
+several ComfyUI instances sharing one API key.
+
+Usage: python benchmarks/bench_broker.py [--clients 4] [--calls 100] [--distinct 100]
+    [--rpm 1200] [--latency-ms 200] [--max-in-flight 8]
+"""
+
+import argparse
+import json
+import pathlib
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.request
+
+import yaml
+
+import run as bench
+from _util import import_module
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+
+def configure(port: int, tmp: pathlib.Path, rpm: int, broker: str | None) -> None:
+    """Point this process at the stub, with the quota as client-side rate limit"""
+    bench.setup_env(port, tmp)
+    config = import_module("config")
+    data = yaml.safe_load(config.config_path.read_text())
+    data["rate_limits"] = {"default": {"rpm": rpm}} if rpm else {}
+    data["broker"] = broker
+    config.config_path.write_text(yaml.safe_dump(data))
+    config.reload_config(force=True)
+
+
+def serve_broker(args) -> None:
+    configure(args.port, pathlib.Path(args.tmp), args.rpm, None)
+    broker = import_module("broker")
+    aio = import_module("aio")
+    aio.run(broker.serve(args.broker))
+
+
+def run_client(args) -> None:
+    configure(args.port, pathlib.Path(args.tmp), args.rpm, args.broker or None)
+    qianfan_nodes = import_module("qianfan")
+    batch = qianfan_nodes.ChatBatch()
+
+    rng = random.Random(args.seed)
+    # consecutive slices of the pool, clients overlap once it wraps around
+    prompts = [(args.seed * args.calls + i) % args.distinct for i in range(args.calls)]
+    rng.shuffle(prompts)
+    messages = [f"- role: user\n  content: 第 {i} 个问题，请描述春天。" for i in prompts]
+
+    print("READY", flush=True)
+    sys.stdin.readline()
+    start = time.perf_counter()
+    _, _, errors = batch.chat_batch(
+        model=["DEFAULT"],
+        messages_yaml=messages,
+        use_cache=[True],
+        max_in_flight=[args.max_in_flight],
+    )
+    print(
+        json.dumps(
+            {"wall": time.perf_counter() - start, "errors": sum(1 for e in errors if e)}
+        ),
+        flush=True,
+    )
+
+
+def stub_stats(port: int) -> dict[str, int]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stub/stats") as resp:
+        return json.load(resp)
+
+
+def wait_for_socket(path: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect(path)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"broker did not start listening on {path}")
+
+
+def run_mode(args, port: int, tmp: pathlib.Path, broker: str | None) -> dict:
+    """Start the clients together, return aggregate stats"""
+    before = stub_stats(port)
+    clients = []
+    for i in range(args.clients):
+        client_tmp = tmp / f"client-{'broker' if broker else 'direct'}-{i}"
+        client_tmp.mkdir()
+        clients.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    str(HERE / "bench_broker.py"),
+                    "--role", "client",
+                    "--port", str(port),
+                    "--tmp", str(client_tmp),
+                    "--broker", broker or "",
+                    "--seed", str(i),
+                    "--calls", str(args.calls),
+                    "--distinct", str(args.distinct),
+                    "--rpm", str(args.rpm),
+                    "--max-in-flight", str(args.max_in_flight),
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            )
+        )
+
+    for proc in clients:
+        if proc.stdout.readline().strip() != "READY":
+            raise RuntimeError("benchmark client failed to start")
+    start = time.perf_counter()
+    for proc in clients:
+        proc.stdin.write("GO\n")
+        proc.stdin.flush()
+    results = [json.loads(proc.stdout.readline()) for proc in clients]
+    wall = time.perf_counter() - start
+    for proc in clients:
+        proc.wait()
+
+    after = stub_stats(port)
+    calls = args.clients * args.calls
+    return {
+        "wall": wall,
+        "throughput": calls / wall,
+        "slowest_client": max(r["wall"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+        "upstream": after["requests"] - before["requests"],
+        "throttled": after["throttled"] - before["throttled"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--calls", type=int, default=100, help="per client")
+    parser.add_argument("--distinct", type=int, default=100, help="prompts in the shared pool")
+    parser.add_argument("--rpm", type=int, default=1200, help="quota, 0 for none")
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    # internal, the broker and client subprocesses
+    parser.add_argument("--role", choices=["main", "broker", "client"], default="main")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--tmp")
+    parser.add_argument("--broker")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.role == "broker":
+        return serve_broker(args)
+    if args.role == "client":
+        return run_client(args)
+
+    proc, port = bench.start_stub(
+        types.SimpleNamespace(
+            latency_ms=args.latency_ms, jitter_ms=0, error_rate=0.0, qps=args.rpm / 60
+        )
+    )
+    broker = None
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            results = {"independent": run_mode(args, port, tmp, None)}
+
+            address = str(tmp / "broker.sock")
+            broker_tmp = tmp / "broker"
+            broker_tmp.mkdir()
+            broker = subprocess.Popen(
+                [
+                    sys.executable,
+                    str(HERE / "bench_broker.py"),
+                    "--role", "broker",
+                    "--port", str(port),
+                    "--tmp", str(broker_tmp),
+                    "--broker", f"unix:{address}",
+                    "--rpm", str(args.rpm),
+                ],
+                stderr=subprocess.DEVNULL,
+            )
+            wait_for_socket(address)
+            results["broker"] = run_mode(args, port, tmp, f"unix:{address}")
+    finally:
+        if broker is not None:
+            broker.kill()
+        proc.kill()
+
+    print(
+        f"{args.clients} clients x {args.calls} chat calls, {args.distinct} distinct prompts, "
+        f"quota {args.rpm} rpm, stub latency {args.latency_ms:.0f} ms"
+    )
+    for mode, r in results.items():
+        print(
+            f"{mode:<12} {r['throughput']:>8.1f} calls/s  wall {r['wall']:>6.2f} s  "
+            f"upstream {r['upstream']:>5}  throttled {r['throttled']:>5}  errors {r['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-call overhead of config reloading
+
+Usage: python benchmarks/bench_config.py [-n NUMBER]
+"""
+
+import argparse
+import pathlib
+import tempfile
+
+import yaml
+
+from _util import import_module, report, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = import_module("config")
+        config.config_path = pathlib.Path(tmp) / "config.yaml"
+        config.config_path.write_text(
+            yaml.safe_dump(
+                {
+                    "appbuilder_api_key": "key",
+                    "iam_ak": "ak",
+                    "iam_sk": "sk",
+                }
+            )
+        )
+
+        def full_parse():
+            with open(config.config_path, "r") as f:
+                yaml.safe_load(f)
+
+        report("before: open + yaml.safe_load", timeit(full_parse, args.number))
+        report("after: reload_config (unchanged)", timeit(config.reload_config, args.number))
+        report(
+            "after: reload_config(force=True)",
+            timeit(lambda: config.reload_config(force=True), args.number),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Embedding node throughput against the local stub server: texts per second with
+a cold vector store (every batch requested) and a warm one (read from disk),
+requests made, and the size of the store
+
+Usage: python benchmarks/bench_embedding.py [--sizes 1000 10000 100000] [--latency-ms 200]
+    [--max-in-flight 8]
+Exits with status 1 if a warm run makes requests or returns different vectors.
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+import run as bench
+from _util import import_module
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    proc, port = bench.start_stub(
+        types.SimpleNamespace(latency_ms=args.latency_ms, jitter_ms=0, error_rate=0.0)
+    )
+    failed = False
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench.setup_env(port, pathlib.Path(tmp))
+            embedding_store = import_module("embedding_store")
+            embedding_store.store_dir = pathlib.Path(tmp) / "embeddings"
+            qianfan_nodes = import_module("qianfan")
+            node = qianfan_nodes.Embedding()
+            batch = qianfan_nodes.DEFAULT_EMBEDDING_BATCH_SIZE
+
+            for size in args.sizes:
+                # a distinct model per size, so each cold run starts with an empty store
+                model = ["Embedding-V1", "bge-large-zh", "bge-large-en"][
+                    args.sizes.index(size) % 3
+                ]
+                embedding_store._stores.clear()
+                for path in embedding_store.store_dir.glob("*"):
+                    path.unlink()
+                texts = [f"第 {i} 段文本：春暖花开，溪水潺潺。" for i in range(size)]
+
+                runs = {}
+                for label in ("cold", "warm"):
+                    start = time.perf_counter()
+                    vectors, stats = node.embed(
+                        model=[model],
+                        texts=texts,
+                        one_per_line=[False],
+                        max_in_flight=[args.max_in_flight],
+                    )
+                    runs[label] = (time.perf_counter() - start, vectors, stats)
+
+                cold_s, cold, cold_stats = runs["cold"]
+                warm_s, warm, warm_stats = runs["warm"]
+                store = embedding_store.get_store(model).stats()
+                ideal = -(-size // batch) / args.max_in_flight * args.latency_ms / 1000
+                print(
+                    f"{size:>7} texts {cold.shape} {cold.dtype}: "
+                    f"cold {size / cold_s:>9.0f} texts/s ({cold_s:.2f} s, "
+                    f"{-(-size // batch)} requests, ideal {ideal:.2f} s), "
+                    f"warm {size / warm_s:>9.0f} texts/s ({warm_s:.3f} s), "
+                    f"store {store['bytes'] / 2**20:.1f} MiB"
+                )
+                if not (cold.flags.c_contiguous and np.array_equal(cold, warm)):
+                    print(f"{size} texts: warm vectors differ from cold ones")
+                    failed = True
+                if '"cache_hit": true' not in warm_stats:
+                    print(f"{size} texts: warm run made requests: {warm_stats}")
+                    failed = True
+    finally:
+        proc.kill()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
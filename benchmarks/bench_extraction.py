@@ -0,0 +1,125 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+DialogSummary field extraction over a corpus of malformed model replies:
+fields recovered by plain json.loads versus the tolerant extractor, extraction
+time, and how early each field completes when the reply is streamed
+
+Usage: python benchmarks/bench_extraction.py [-n NUMBER] [--chunk 4]
+Exits with status 1 if any reply of the corpus is not recovered.
+"""
+
+import argparse
+import json
+import sys
+
+from _util import import_module, report, timeit
+
+extraction = import_module("extraction")
+
+FIELDS = ("诉求", "回应", "解决情况")
+EXPECTED = {"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决"}
+VALID = json.dumps(EXPECTED, ensure_ascii=False)
+
+CORPUS = {
+    "valid": VALID,
+    "pretty": json.dumps(EXPECTED, ensure_ascii=False, indent=2),
+    "fenced": f"```json\n{VALID}\n```",
+    "fenced no lang": f"```\n{VALID}\n```",
+    "unterminated fence": f"```json\n{VALID}",
+    "leading text": f"以下是对话总结：\n{VALID}",
+    "trailing text": f"{VALID}\n\n希望对您有帮助！",
+    "fenced with text": f"好的，总结如下：\n```json\n{VALID}\n```\n如需调整请告诉我。",
+    "trailing comma": '{"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决",}',
+    "single quotes": "{'诉求': '用户查询话费', '回应': '坐席告知余额87.49元', '解决情况': '已解决'}",
+    "curly quotes": "{“诉求”：“用户查询话费”，“回应”：“坐席告知余额87.49元”，“解决情况”：“已解决”}",
+    "unquoted keys": '{诉求: "用户查询话费", 回应: "坐席告知余额87.49元", 解决情况: "已解决"}',
+    "unquoted values": "{诉求: 用户查询话费, 回应: 坐席告知余额87.49元, 解决情况: 已解决}",
+    "missing commas": '{\n"诉求": "用户查询话费"\n"回应": "坐席告知余额87.49元"\n"解决情况": "已解决"\n}',
+    "truncated": '{"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决',
+    "unclosed object": '{"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决"',
+    "raw newline": '{"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决\n"}',
+    "nested": json.dumps({"summary": EXPECTED}, ensure_ascii=False),
+    "key lines": "诉求：用户查询话费\n回应：坐席告知余额87.49元\n解决情况：已解决",
+    "markdown lines": "- 诉求: 用户查询话费\n- 回应: 坐席告知余额87.49元\n- 解决情况: 已解决",
+    "two objects": VALID + "\n" + json.dumps({"备注": "无"}, ensure_ascii=False),
+}
+
+
+def recovered(fields: dict[str, str] | None) -> bool:
+    return fields is not None and all(
+        fields.get(k, "").strip() == v for k, v in EXPECTED.items()
+    )
+
+
+def plain(text: str) -> dict[str, str] | None:
+    """What DialogSummary did before: json.loads or nothing"""
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return {k: data.get(k, "") for k in FIELDS}
+
+
+def streamed(text: str, chunk: int) -> tuple[dict[str, str], dict[str, int]]:
+    """Feed the reply in chunks, get the fields and the offset each completed at"""
+    extractor = extraction.FieldExtractor(FIELDS)
+    completed_at = {}
+    for i in range(0, len(text), chunk):
+        for field in extractor.feed(text[i : i + chunk]):
+            completed_at[field] = min(i + chunk, len(text))
+    for field in extractor.finish().keys() - completed_at.keys():
+        completed_at[field] = len(text)
+    return extractor.values, completed_at
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=2000)
+    parser.add_argument("--chunk", type=int, default=4)
+    args = parser.parse_args()
+
+    failed = []
+    for name, text in CORPUS.items():
+        fields = extraction.extract_fields(text, FIELDS)
+        stream_fields, completed_at = streamed(text, args.chunk)
+        ok = recovered(fields)
+        if not ok:
+            failed.append(name)
+        early = ", ".join(f"{completed_at.get(f, '-')}" for f in FIELDS)
+        print(
+            f"{name:<20} json.loads: {'ok' if recovered(plain(text)) else 'LOST':<5}"
+            f" extractor: {'ok' if ok else 'FAIL':<5}"
+            f" streamed: {'ok' if recovered(stream_fields) else '-':<3}"
+            f" fields done at chars {early} of {len(text)}"
+        )
+
+    print()
+    print(f"recovered {len(CORPUS) - len(failed)} / {len(CORPUS)}")
+    print(f"json.loads recovered {sum(recovered(plain(t)) for t in CORPUS.values())} / {len(CORPUS)}")
+    for name in ("valid", "fenced with text", "unquoted values", "truncated"):
+        text = CORPUS[name]
+        report(
+            f"extract_fields {name}",
+            timeit(lambda: extraction.extract_fields(text, FIELDS), args.number),
+        )
+
+    if failed:
+        print(f"not recovered: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
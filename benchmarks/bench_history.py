@@ -0,0 +1,76 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cost of carrying history through a chain of Chat nodes, excluding the remote call
+
+Usage: python benchmarks/bench_history.py [--turns 10 100 1000]
+"""
+
+import argparse
+import time
+
+import yaml
+
+from _util import import_module
+
+history_mod = import_module("qianfan.history")
+
+
+def turn(i: int) -> tuple[dict, dict]:
+    """One user message and its assistant reply"""
+    return (
+        {"role": "user", "content": f"第 {i} 轮：请想象一幅包含 春暖花开 的画面。"},
+        {"role": "assistant", "content": f"第 {i} 轮回答：" + "画面描述。" * 20},
+    )
+
+
+def chain_yaml(turns: int) -> float:
+    """Old behavior: parse history_yaml, concat, re-dump on every turn"""
+    start = time.perf_counter()
+    history_yaml = ""
+    for i in range(turns):
+        user, assistant = turn(i)
+        messages = [user]
+        if history_yaml:
+            messages = yaml.safe_load(history_yaml) + messages
+        history_yaml = yaml.safe_dump(messages + [assistant], allow_unicode=True)
+    return time.perf_counter() - start
+
+
+def chain_native(turns: int) -> float:
+    """New behavior: extend History and flatten for the request payload"""
+    start = time.perf_counter()
+    history = history_mod.History()
+    for i in range(turns):
+        user, assistant = turn(i)
+        _ = history.to_list() + [user]
+        history = history.extend([user, assistant])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f"{'turns':>8} {'yaml (s)':>12} {'native (s)':>12} {'speedup':>10}")
+    for turns in args.turns:
+        old = chain_yaml(turns)
+        new = chain_native(turns)
+        print(f"{turns:>8} {old:>12.4f} {new:>12.4f} {old / new:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
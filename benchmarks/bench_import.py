@@ -0,0 +1,99 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Import time of the node package, as ComfyUI sees it at startup
+
+Fails (exit code 1) if registering the nodes imports the qianfan / appbuilder SDKs,
+or if the package import takes longer than `--max-ms`.
+
+Usage: python benchmarks/bench_import.py [--max-ms MS] [--top N]
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+from _util import PACKAGE_NAME, ROOT
+
+SDK_MODULES = ("qianfan", "appbuilder")
+
+# import the package root like ComfyUI does, then list the SDK modules it pulled in
+SCRIPT = f"""
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location(
+    {PACKAGE_NAME!r}, {str(ROOT / "__init__.py")!r},
+    submodule_search_locations=[{str(ROOT)!r}],
+)
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(
+    name for name in sys.modules if name.split(".")[0] in {SDK_MODULES!r}
+)]))
+"""
+
+# import time: self [us] | cumulative | imported package
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-ms", type=float, default=300.0)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        # run away from the repo, so the SDKs are not shadowed by ./qianfan, ./appbuilder
+        cwd=ROOT.parent,
+    )
+    if proc.returncode:
+        print(proc.stderr)
+        sys.exit(proc.returncode)
+
+    elapsed, sdk_modules = json.loads(proc.stdout.strip().splitlines()[-1])
+    total_ms = elapsed * 1000
+
+    # top-level entries (indent of one space), minus interpreter startup
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m and len(m[3]) == 1:
+            entries.append((int(m[2]), m[4]))
+    entries = entries[[name for _, name in entries].index("site") + 1 :]
+
+    print(f"package import: {total_ms:.1f} ms (limit {args.max_ms:.0f} ms)")
+    print("slowest top-level imports:")
+    for cum, name in sorted(entries, reverse=True)[: args.top]:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if sdk_modules:
+        print(f"FAIL: SDK modules imported at registration: {', '.join(sdk_modules[:5])}")
+        failed = True
+    if total_ms > args.max_ms:
+        print(f"FAIL: package import exceeds {args.max_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
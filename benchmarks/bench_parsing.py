@@ -0,0 +1,90 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cost of parsing the history_yaml input of one Chat run, which IS_CHANGED,
+VALIDATE_INPUTS and execution each parse, before and after the shared parse cache
+
+Usage: python benchmarks/bench_parsing.py [--turns 10 100 1000] [-n NUMBER]
+"""
+
+import argparse
+import json
+
+import yaml
+
+from _util import import_module, report, timeit
+
+parsing = import_module("parsing")
+history_mod = import_module("qianfan.history")
+
+
+def history(turns: int) -> list[dict]:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"第 {i} 轮：请想象一幅包含 春暖花开 的画面。"})
+        messages.append({"role": "assistant", "content": f"第 {i} 轮回答：" + "画面描述。" * 20})
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("-n", "--number", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"libyaml: {parsing.Loader is not yaml.SafeLoader}")
+    for turns in args.turns:
+        messages = history(turns)
+        texts = {
+            "yaml": yaml.safe_dump(messages, allow_unicode=True),
+            "json": json.dumps(messages, ensure_ascii=False),
+        }
+        for fmt, text in texts.items():
+            cache = parsing.get_parse_cache()
+
+            def before():
+                # VALIDATE_INPUTS, IS_CHANGED, execution each parsed the input
+                for _ in range(3):
+                    yaml.safe_load(text)
+
+            def after():
+                parsing.load_text(text, copy=False)
+                history_mod.History.from_text(text)
+                history_mod.History.from_text(text)
+
+            def after_cold():
+                cache.clear()
+                after()
+
+            report(f"{turns} turns {fmt}, before: 3x yaml.safe_load", timeit(before, args.number))
+            report(f"{turns} turns {fmt}, after: new input", timeit(after_cold, args.number))
+            report(f"{turns} turns {fmt}, after: unchanged input", timeit(after, args.number))
+            report(
+                f"{turns} turns {fmt}, after: load_text copy",
+                timeit(lambda: parsing.load_text(text), args.number),
+            )
+
+        report(
+            f"{turns} turns, before: yaml.safe_dump",
+            timeit(lambda: yaml.safe_dump(messages, allow_unicode=True), args.number),
+        )
+        report(
+            f"{turns} turns, after: dump_yaml",
+            timeit(lambda: parsing.dump_yaml(messages), args.number),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Semantic cache at scale: insert time, lookup latency, hit rate of trivially
+changed prompts, false hits of unrelated prompts, index memory and save / load.
+Then prompts rendered from one PlayGround template, where changing one
+parameter must not hit, compared as whole prompts and per parameter, and
+Chat conversations sharing a long history whose last question differs, compared
+as whole transcripts and by last message within the history
+
+Usage: python benchmarks/bench_semantic_cache.py [--entries 100000] [--scopes 4] [--lookups 2000]
+"""
+
+import argparse
+import pathlib
+import random
+import tempfile
+import time
+
+from _util import import_module
+
+semantic_cache = import_module("semantic_cache")
+templates = import_module("templates")
+
+WORDS = [
+    "春天", "秋天", "山谷", "河流", "城市", "夜晚", "星空", "森林", "海边", "雪山",
+    "猫", "狗", "少女", "老人", "机器人", "古堡", "花园", "雨天", "灯塔", "沙漠",
+    "castle", "forest", "river", "sunset", "portrait", "robot", "garden", "ocean",
+]
+
+
+def prompt(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=12)
+    return f"请想象一幅画面，包含{'、'.join(words)}，风格 {rng.randrange(10**6)}。"
+
+
+def perturb(text: str, rng: random.Random) -> str:
+    """Whitespace, punctuation and width changes that keep the meaning"""
+    text = text.replace("，", ", ").replace("。", "")
+    return "  " + text.replace("、", rng.choice([" ", "，", "/"])) + "！"
+
+
+TEMPLATE = "请想象一幅包含 {object} 的画面，风格为 {style}，并描述这幅画面。"
+COLORS = ["红色", "蓝色", "绿色", "黄色", "白色", "黑色", "red", "blue", "green"]
+NOUNS = ["花", "车", "猫", "房子", "气球", "裙子", "car", "flower", "house"]
+STYLES = ["水彩", "油画", "素描", "赛博朋克", "watercolor", "oil painting"]
+
+
+def same_template(rng: random.Random) -> None:
+    """False hits of renderings one parameter apart, hits of perturbed parameters"""
+    template = templates.compile_template(TEMPLATE)
+    # threshold 0 returns the best similarity, compared against each threshold below
+    whole = semantic_cache.SemanticCache(threshold=0.0)
+    parts = semantic_cache.SemanticCache(threshold=0.0)
+
+    def sep(noun: str) -> str:
+        return " " if noun.isascii() else "的"
+
+    def best(cache, text) -> float:
+        found = cache.get("scope", text)
+        return found[1] if found else 0.0
+
+    # every other color is stored, the others are one parameter away from a stored rendering
+    stored = []
+    for color in COLORS[::2]:
+        for noun in NOUNS:
+            for style in STYLES:
+                params = {"object": f"{color}{sep(noun)}{noun}", "style": style}
+                whole.put("scope", template.render(params), params["object"])
+                parts.put("scope", list(params.values()), params["object"])
+                stored.append((color, noun, style))
+
+    lookups = rng.sample(stored, min(500, len(stored)))
+    changed: dict[str, list[float]] = {"whole prompt": [], "per parameter": []}
+    perturbed = []
+    for color, noun, style in lookups:
+        params = {"object": f"{rng.choice(COLORS[1::2])}{sep(noun)}{noun}", "style": style}
+        changed["whole prompt"].append(best(whole, template.render(params)))
+        changed["per parameter"].append(best(parts, list(params.values())))
+
+        params = {"object": f" {color}{sep(noun)}{noun.upper()}。", "style": style + "！"}
+        perturbed.append(best(parts, list(params.values())))
+
+    print(f"same template, {len(stored)} renderings: {TEMPLATE}")
+    for threshold in (0.9, semantic_cache.DEFAULT_THRESHOLD):
+        rates = ", ".join(
+            f"{name} {sum(s >= threshold for s in sims) / len(sims):.1%}"
+            for name, sims in changed.items()
+        )
+        hits = sum(s >= threshold for s in perturbed) / len(perturbed)
+        print(
+            f"threshold {threshold}: one parameter changed, false hit rate: {rates}; "
+            f"parameters perturbed, hit rate per parameter {hits:.1%}"
+        )
+
+
+HISTORY = [
+    ("user", "我想写一首关于季节的诗，先给我一些灵感。"),
+    ("assistant", "可以从景物、气温、节日和心情入手，比如落叶、初雪、花开和蝉鸣。"),
+    ("user", "请用比较含蓄的语气，不要太直白。"),
+    ("assistant", "好的，我会用意象代替直接的描述，让读者自己体会季节的变化。"),
+    ("user", "每段四行，押韵即可，不必拘泥格律。"),
+]
+QUESTIONS = [
+    "那么请写一首关于{}的诗。",
+    "请描写{}清晨的景色。",
+    "{}适合穿什么颜色的衣服？",
+    "用三个词形容{}的心情。",
+    "{}的价格是{}元还是{}元？",
+]
+SEASONS = ["春天", "夏天", "秋天", "冬天"]
+
+
+def same_history(rng: random.Random) -> None:
+    """False hits of conversations with the same history and a different last question"""
+    whole = semantic_cache.SemanticCache(threshold=0.0)
+    last = semantic_cache.SemanticCache(threshold=0.0)
+
+    def transcript(question: str) -> str:
+        turns = [*HISTORY, ("assistant", "好的。"), ("user", question)]
+        return "\n".join(f"{role}: {content}" for role, content in turns)
+
+    def best(cache, text) -> float:
+        found = cache.get("scope", text)
+        return found[1] if found else 0.0
+
+    def ask(template: str, season: str, price: str) -> str:
+        return template.format(season, price, price.replace(".", ""))
+
+    # one stored conversation per question, looked up with another season or price
+    changed: dict[str, list[float]] = {"whole transcript": [], "last message": []}
+    for template in QUESTIONS:
+        whole.clear()
+        last.clear()
+        question = ask(template, SEASONS[0], "1.5")
+        whole.put("scope", transcript(question), question)
+        last.put("scope", question, question)
+        for season, price in [(s, "1.5") for s in SEASONS[1:]] + [(SEASONS[0], "15")]:
+            if season == SEASONS[0] and "{}元" not in template:
+                continue
+            question = ask(template, season, price)
+            changed["whole transcript"].append(best(whole, transcript(question)))
+            changed["last message"].append(best(last, question))
+
+    print(f"same history of {len(HISTORY)} messages, last question changed")
+    for threshold in (0.9, semantic_cache.DEFAULT_THRESHOLD):
+        rates = ", ".join(
+            f"{name} {sum(s >= threshold for s in sims) / len(sims):.1%}"
+            for name, sims in changed.items()
+        )
+        print(f"threshold {threshold}: false hit rate: {rates}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--scopes", type=int, default=4)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    path = pathlib.Path(tempfile.mkdtemp()) / "semantic_cache.npz"
+    cache = semantic_cache.SemanticCache(max_entries=args.entries, path=path)
+
+    prompts = [(f"scope-{i % args.scopes}", prompt(rng)) for i in range(args.entries)]
+    start = time.perf_counter()
+    for scope, text in prompts:
+        cache.put(scope, text, "x" * 200)
+    put_us = (time.perf_counter() - start) / len(prompts) * 1e6
+
+    near = rng.sample(prompts, args.lookups)
+    for scope, text in near:
+        cache.get(scope, perturb(text, rng))
+    hits = cache.stats()
+
+    for _ in range(args.lookups):
+        cache.get(f"scope-{rng.randrange(args.scopes)}", prompt(rng))
+    after = cache.stats()
+    false_hits = after["hits"] - hits["hits"]
+
+    start = time.perf_counter()
+    cache.save()
+    save_s = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded = semantic_cache.SemanticCache(max_entries=args.entries, path=path)
+    load_s = time.perf_counter() - start
+
+    print(f"entries: {after['entries']} in {args.scopes} scopes, threshold {cache.threshold}")
+    print(f"put: {put_us:.1f} us/entry")
+    print(f"lookup: {after['lookup_ms']:.3f} ms mean")
+    print(f"near-duplicate hit rate: {hits['hits'] / args.lookups:.1%}")
+    print(f"unrelated false hit rate: {false_hits / args.lookups:.2%}")
+    print(f"index memory: {after['memory_bytes'] / 2**20:.1f} MiB")
+    print(
+        f"save: {save_s:.2f} s ({path.stat().st_size / 2**20:.1f} MiB), "
+        f"load: {load_s:.2f} s ({loaded.stats()['entries']} entries)"
+    )
+    print()
+    same_template(rng)
+    print()
+    same_history(rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-turn cost of a long conversation through the Chat node against the local
+stub server: history carried through the history_yaml output and input,
+versus a stored session. Reports latency and peak allocation of a turn as the
+conversation grows, the size of the history_yaml the node outputs, and loading
+the session once it is no longer in memory
+
+Usage: python benchmarks/bench_sessions.py [--turns 1000] [--checkpoints 10 100 1000]
+"""
+
+import argparse
+import pathlib
+import statistics
+import tempfile
+import time
+import tracemalloc
+import types
+
+import run as bench
+from _util import import_module, timeit
+
+# turns averaged before each checkpoint
+WINDOW = 5
+
+
+def message(i: int) -> str:
+    return f"- role: user\n  content: 第 {i} 轮：请想象一幅包含 春暖花开 的画面。"
+
+
+def converse(chat, turns: int, checkpoints: set[int], session_id: str) -> dict[int, dict]:
+    """Run a conversation, measure the turns before each checkpoint"""
+    history_yaml = ""
+    results = {}
+    latencies = []
+    for i in range(1, turns + 1):
+        traced = i in checkpoints
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        _, out_yaml, _, _ = chat.chat(
+            model="DEFAULT",
+            messages_yaml=message(i),
+            endpoint="",
+            history_yaml="" if session_id else history_yaml,
+            session_id=session_id,
+            # carried as yaml the history has to be dumped, a session does not need it
+            yaml_output=not session_id,
+        )
+        latencies.append(time.perf_counter() - start)
+        history_yaml = out_yaml
+
+        if traced:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[i] = {
+                # the traced turn itself is slowed down by tracing
+                "ms": statistics.fmean(latencies[-WINDOW - 1 : -1]) * 1000,
+                "peak_kb": peak / 1024,
+                "output_kb": len(out_yaml.encode("utf-8")) / 1024,
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--checkpoints", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+    checkpoints = {c for c in args.checkpoints if c <= args.turns}
+
+    proc, port = bench.start_stub(
+        types.SimpleNamespace(latency_ms=0, jitter_ms=0, error_rate=0.0)
+    )
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench.setup_env(port, pathlib.Path(tmp))
+            sessions = import_module("qianfan.sessions")
+            sessions.sqlite_path = pathlib.Path(tmp) / "sessions.sqlite3"
+            qianfan_nodes = import_module("qianfan")
+            chat = qianfan_nodes.Chat()
+
+            yaml_results = converse(chat, args.turns, checkpoints, "")
+            session_results = converse(chat, args.turns, checkpoints, "bench")
+
+            # a new process, or the session evicted from the hot sessions
+            store = sessions.SessionStore()
+            start = time.perf_counter()
+            history = store.load("bench")
+            cold_ms = (time.perf_counter() - start) * 1000
+            hot_ms = timeit(lambda: store.load("bench"), 100) * 1000
+            db_kb = sum(
+                p.stat().st_size for p in pathlib.Path(tmp).glob("sessions.sqlite3*")
+            ) / 1024
+    finally:
+        proc.kill()
+
+    print(
+        f"{'turn':>6} {'yaml ms':>9} {'session ms':>11} "
+        f"{'yaml peak KB':>13} {'session peak KB':>16} {'history_yaml KB':>16}"
+    )
+    for turn in sorted(checkpoints):
+        y, s = yaml_results[turn], session_results[turn]
+        print(
+            f"{turn:>6} {y['ms']:>9.2f} {s['ms']:>11.2f} "
+            f"{y['peak_kb']:>13.1f} {s['peak_kb']:>16.1f} {y['output_kb']:>16.1f}"
+        )
+    print(
+        f"session of {len(history)} messages: load from disk {cold_ms:.2f} ms, "
+        f"from memory {hot_ms:.3f} ms, {db_kb:.0f} KB on disk"
+    )
+
+
+if __name__ == "__main__":
+    main()
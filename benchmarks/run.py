@@ -0,0 +1,410 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline benchmark of the nodes against the local stub server
+
+Usage:
+    python benchmarks/run.py [--latency-ms 200] [--calls 50] [--error-rate 0.0]
+        [--scenarios cold warm clients stream batch history concurrent]
+        [--output results.json] [--compare previous.json]
+
+Requires the SDKs from requirements.txt. The stub server runs in a subprocess,
+so CPU time and allocations are those of the nodes and SDKs only.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing as tg
+
+import yaml
+
+from _util import ROOT, import_module
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+ALL_SCENARIOS = [
+    "cold",
+    "warm",
+    "clients",
+    "stream",
+    "batch",
+    "history",
+    "concurrent",
+]
+
+
+def start_stub(args) -> tuple[subprocess.Popen, int]:
+    """Start stub server subprocess, return it and its port"""
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            str(HERE / "stub_server.py"),
+            "--latency-ms",
+            str(args.latency_ms),
+            "--jitter-ms",
+            str(args.jitter_ms),
+            "--error-rate",
+            str(args.error_rate),
+            "--qps",
+            str(getattr(args, "qps", 0.0)),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = proc.stdout.readline().split()
+    if not line or line[0] != "READY":
+        proc.kill()
+        raise RuntimeError("stub server failed to start")
+    return proc, int(line[1])
+
+
+def setup_env(port: int, tmp: pathlib.Path) -> None:
+    """Point SDKs at the stub and nodes at a temporary config"""
+    base_url = f"http://127.0.0.1:{port}"
+    os.environ["QIANFAN_BASE_URL"] = base_url
+    os.environ["QIANFAN_CONSOLE_API_BASE_URL"] = base_url
+    os.environ["GATEWAY_URL"] = base_url
+
+    config = import_module("config")
+    config.config_path = tmp / "config.yaml"
+    config.config_path.write_text(
+        yaml.safe_dump(
+            {
+                "appbuilder_api_key": "stub-appbuilder-key",
+                "iam_ak": "stub-ak",
+                "iam_sk": "stub-sk",
+                "rate_limit_backoff_base": 0.05,
+            }
+        )
+    )
+    config.reload_config(force=True)
+
+    model_catalog = import_module("model_catalog")
+    model_catalog.catalog_path = tmp / "model_catalog.json"
+
+
+def summarize(
+    latencies: list[float],
+    wall: float,
+    cpu: float,
+    errors: int,
+    alloc_peak: int,
+    stub_latency: float,
+) -> dict[str, float]:
+    """Build the stats record of one benchmark"""
+    ordered = sorted(latencies)
+
+    def pct(p: float) -> float:
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    calls = len(latencies)
+    mean = statistics.fmean(latencies) if latencies else 0.0
+    return {
+        "calls": calls,
+        "errors": errors,
+        "p50_ms": pct(50) * 1000,
+        "p95_ms": pct(95) * 1000,
+        "p99_ms": pct(99) * 1000,
+        "mean_ms": mean * 1000,
+        "overhead_ms": (mean - stub_latency) * 1000,
+        "throughput_per_s": calls / wall if wall else 0.0,
+        "cpu_ms_per_call": cpu / calls * 1000 if calls else 0.0,
+        "alloc_peak_kb_per_call": alloc_peak / 1024,
+    }
+
+
+def measure(
+    fn: tg.Callable[[int], tg.Any],
+    calls: int,
+    stub_latency: float,
+    concurrency: int = 1,
+    alloc_calls: int = 5,
+) -> dict[str, float]:
+    """Run `fn(i)` `calls` times over `concurrency` threads and collect stats"""
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    counter = iter(range(calls))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                fn(i)
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    # separate pass, tracing slows every call down
+    alloc_peak = 0
+    tracemalloc.start()
+    for i in range(alloc_calls):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        try:
+            fn(calls + i)
+        except Exception:
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        alloc_peak = max(alloc_peak, peak - base)
+    tracemalloc.stop()
+
+    return summarize(latencies, wall, cpu, errors, alloc_peak, stub_latency)
+
+
+def node_calls(qianfan_nodes, appbuilder_nodes) -> dict[str, tg.Callable[[int], tg.Any]]:
+    """Single-item node invocations with unique inputs per call"""
+    chat = qianfan_nodes.Chat()
+    completion = qianfan_nodes.Completion()
+    playground = appbuilder_nodes.PlayGround()
+    dialog_summary = appbuilder_nodes.DialogSummary()
+
+    return {
+        "chat": lambda i: chat.chat(
+            model="DEFAULT",
+            messages_yaml=f"- role: user\n  content: 第 {i} 个问题，请描述春天。",
+            endpoint="",
+            history_yaml="",
+        ),
+        "completion": lambda i: completion.completion(
+            model="DEFAULT", prompt=f"第 {i} 个问题，请描述春天。", endpoint=""
+        ),
+        "playground": lambda i: playground.playground(
+            model="ERNIE-Speed-8K",
+            prompt_template="请想象一幅包含 {object} 的画面，并描述这幅画面。",
+            params_yaml=f"object: 春暖花开 {i}",
+        ),
+        "dialog_summary": lambda i: dialog_summary.dialog_summary(
+            model="ERNIE-Speed-8K",
+            dialog=f"用户:喂我想查一下我的话费 {i}\n坐席:好的女士您话费余额还有87.49元钱",
+        ),
+    }
+
+
+def run(args) -> dict:
+    """Run selected scenarios, return results record"""
+    stub_latency = args.latency_ms / 1000
+    results: dict[str, dict] = {}
+
+    proc, port = start_stub(args)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            setup_env(port, pathlib.Path(tmp))
+
+            start = time.perf_counter()
+            qianfan_nodes = import_module("qianfan")
+            appbuilder_nodes = import_module("appbuilder")
+            import_time = time.perf_counter() - start
+
+            calls = node_calls(qianfan_nodes, appbuilder_nodes)
+
+            if "cold" in args.scenarios:
+                results["cold/import"] = summarize(
+                    [import_time], import_time, 0.0, 0, 0, 0.0
+                )
+                for name, fn in calls.items():
+                    results[f"cold/{name}"] = measure(
+                        fn, 1, stub_latency, alloc_calls=0
+                    )
+
+            if "warm" in args.scenarios:
+                for name, fn in calls.items():
+                    results[f"warm/{name}"] = measure(fn, args.calls, stub_latency)
+
+            if "clients" in args.scenarios:
+                clients = import_module("clients")
+                for name in ("chat", "playground"):
+                    fn = calls[name]
+                    results[f"clients/{name}_fresh"] = measure(
+                        lambda i: (clients.invalidate_clients(), fn(i)),
+                        args.calls,
+                        stub_latency,
+                    )
+                    results[f"clients/{name}_reused"] = measure(
+                        fn, args.calls, stub_latency
+                    )
+
+            if "stream" in args.scenarios:
+                chat = qianfan_nodes.Chat()
+                results["stream/chat"] = measure(
+                    lambda i: chat.chat(
+                        model="DEFAULT",
+                        messages_yaml=f"- role: user\n  content: 流式问题 {i}",
+                        endpoint="",
+                        history_yaml="",
+                        stream=True,
+                    ),
+                    args.calls,
+                    stub_latency,
+                )
+
+            if "batch" in args.scenarios:
+                chat_batch = qianfan_nodes.ChatBatch()
+                size = args.batch_size
+                stats = measure(
+                    lambda i: chat_batch.chat_batch(
+                        model=["DEFAULT"],
+                        messages_yaml=[
+                            f"- role: user\n  content: 批量问题 {i}-{j}"
+                            for j in range(size)
+                        ],
+                        max_in_flight=[args.concurrency],
+                    ),
+                    max(1, args.calls // size),
+                    stub_latency,
+                    alloc_calls=1,
+                )
+                stats["items_per_s"] = stats["throughput_per_s"] * size
+                results[f"batch/chat_x{size}"] = stats
+
+            if "history" in args.scenarios:
+                history_mod = sys.modules[f"{qianfan_nodes.__name__}.history"]
+                chat = qianfan_nodes.Chat()
+                for turns in (10, 100, 1000):
+                    history = history_mod.History(
+                        message
+                        for t in range(turns)
+                        for message in (
+                            {"role": "user", "content": f"第 {t} 轮问题"},
+                            {"role": "assistant", "content": f"第 {t} 轮回答"},
+                        )
+                    )
+                    results[f"history/chat_{turns}_turns"] = measure(
+                        lambda i: chat.chat(
+                            model="DEFAULT",
+                            messages_yaml=f"- role: user\n  content: 新问题 {i}",
+                            endpoint="",
+                            history_yaml="",
+                            history=history,
+                        ),
+                        args.calls,
+                        stub_latency,
+                    )
+
+            if "concurrent" in args.scenarios:
+                for name, fn in calls.items():
+                    results[f"concurrent/{name}"] = measure(
+                        fn, args.calls, stub_latency, concurrency=args.concurrency
+                    )
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": _git_revision(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except Exception:
+        return ""
+
+
+def print_results(record: dict, previous: dict | None) -> None:
+    """Print results table, with change against a previous run if given"""
+    old = (previous or {}).get("results", {})
+    print(
+        f"{'benchmark':<32} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'ovh ms':>8} {'req/s':>8} {'cpu ms':>8} {'alloc KB':>9} {'err':>4}"
+        + (f" {'p50 vs prev':>12}" if previous else "")
+    )
+    for name, stats in record["results"].items():
+        line = (
+            f"{name:<32} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+            f"{stats['p99_ms']:>9.2f} {stats['overhead_ms']:>8.2f} "
+            f"{stats['throughput_per_s']:>8.2f} {stats['cpu_ms_per_call']:>8.2f} "
+            f"{stats['alloc_peak_kb_per_call']:>9.1f} {stats['errors']:>4}"
+        )
+        if previous:
+            before = old.get(name, {}).get("p50_ms")
+            if before:
+                line += f" {(stats['p50_ms'] - before) / before * 100:>+11.1f}%"
+            else:
+                line += f" {'n/a':>12}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=ALL_SCENARIOS, default=ALL_SCENARIOS
+    )
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--compare", type=pathlib.Path)
+    args = parser.parse_args()
+
+    previous = json.loads(args.compare.read_text()) if args.compare else None
+    record = run(args)
+    print_results(record, previous)
+
+    if args.output:
+        record["meta"]["args"] = {
+            k: str(v) if isinstance(v, pathlib.Path) else v
+            for k, v in record["meta"]["args"].items()
+        }
+        args.output.write_text(json.dumps(record, indent=2))
+        print(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
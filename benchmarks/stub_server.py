@@ -0,0 +1,288 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local HTTP stub imitating the QianFan and AppBuilder endpoints used by the nodes
+
+Usage: python benchmarks/stub_server.py [--port 0] [--latency-ms 200] [--error-rate 0.0] [--qps 0]
+
+Prints `READY <port>` once listening. `GET /stub/stats` returns the request
+and throttle counts, `--qps` throttles requests over a quota like the real API. Point the SDKs at it with
+QIANFAN_BASE_URL / QIANFAN_CONSOLE_API_BASE_URL / GATEWAY_URL=http://127.0.0.1:<port>.
+"""
+
+import argparse
+import collections
+import hashlib
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+REPLY = "画面中，春风拂过山谷，桃花与杏花竞相开放，溪水潺潺流过青石。"
+
+MODELS = ["ERNIE-4.0-8K", "ERNIE-3.5-8K", "ERNIE-Speed-8K", "ERNIE-Lite-8K"]
+
+EMBEDDING_DIM = 384
+
+DIALOG_SUMMARY_REPLY = json.dumps(
+    {"诉求": "用户查询话费", "回应": "坐席告知余额87.49元", "解决情况": "已解决"},
+    ensure_ascii=False,
+)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Answer every POST with a QianFan or AppBuilder shaped response"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    # set by main()
+    latency = 0.2
+    jitter = 0.0
+    error_rate = 0.0
+    chunks = 8
+    qps = 0.0
+    requests = 0
+    throttled = 0
+    # start times of requests within the last second, for the qps quota
+    window: collections.deque = collections.deque()
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, data: dict, status: int = 200) -> None:
+        self._send_body(json.dumps(data, ensure_ascii=False).encode("utf-8"), status)
+
+    def _send_body(self, body: bytes, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, frames: list[dict], delay: float) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for frame in frames:
+            time.sleep(delay)
+            data = f"data: {json.dumps(frame, ensure_ascii=False)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == "/stub/stats":
+            with self.lock:
+                self._send_json({"requests": self.requests, "throttled": self.throttled})
+            return
+        self._send_json({})
+
+    def _over_quota(self) -> bool:
+        if not self.qps:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.window and self.window[0] <= now - 1.0:
+                self.window.popleft()
+            if len(self.window) >= self.qps:
+                StubHandler.throttled += 1
+                return True
+            self.window.append(now)
+        return False
+
+    def do_POST(self):
+        with self.lock:
+            StubHandler.requests += 1
+
+        request = self._read_json()
+        path = self.path.split("?", 1)[0]
+
+        if "token" in path:
+            self._send_json({"access_token": "stub-token", "expires_in": 2592000})
+            return
+
+        if self._over_quota():
+            self._send_json(
+                {"error_code": 18, "error_msg": "Open api qps request limit reached"}
+            )
+            return
+
+        latency = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+        if random.random() < self.error_rate:
+            time.sleep(latency / 4)
+            if random.random() < 0.5:
+                self._send_json(
+                    {"error_code": 18, "error_msg": "Open api qps request limit reached"}
+                )
+            else:
+                self._send_json({"code": 429, "message": "Too Many Requests"}, 429)
+            return
+
+        if "service/list" in path:
+            self._send_json(
+                {
+                    "result": {
+                        "common": [
+                            {
+                                "name": name,
+                                "url": f"/chat/{name.lower()}",
+                                "apiType": "chat",
+                                "chargeStatus": "OPENED",
+                                "versionList": [],
+                            }
+                            for name in MODELS
+                        ],
+                        "custom": [],
+                    }
+                }
+            )
+            return
+
+        if "/embeddings/" in path:
+            time.sleep(latency)
+            texts = request.get("input") or []
+            tokens = sum(len(t) for t in texts)
+            data = ",".join(
+                f'{{"object":"embedding","embedding":{_embedding(t)},"index":{i}}}'
+                for i, t in enumerate(texts)
+            )
+            # assembled as text, encoding the vectors on every request would make the stub the bottleneck
+            self._send_body(
+                f'{{"id":"as-{uuid.uuid4().hex[:10]}","object":"embedding_list",'
+                f'"created":{int(time.time())},"data":[{data}],'
+                f'"usage":{{"prompt_tokens":{tokens},"total_tokens":{tokens}}}}}'.encode()
+            )
+            return
+
+        qianfan_api = "wenxinworkshop" in path
+        reply = DIALOG_SUMMARY_REPLY if "dialog_summary" in path else REPLY
+
+        if request.get("stream") or request.get("response_mode") == "streaming":
+            step = max(1, len(reply) // self.chunks)
+            parts = [reply[i : i + step] for i in range(0, len(reply), step)]
+            delay = latency / max(1, len(parts))
+            if qianfan_api:
+                frames = [
+                    {
+                        "id": f"as-{uuid.uuid4().hex[:10]}",
+                        "sentence_id": i,
+                        "is_end": i == len(parts) - 1,
+                        "result": part,
+                        "usage": _usage(request, reply),
+                    }
+                    for i, part in enumerate(parts)
+                ]
+            else:
+                frames = [{"answer": part} for part in parts]
+                frames[-1]["usage"] = _usage(request, reply)
+            self._send_stream(frames, delay)
+            return
+
+        time.sleep(latency)
+        if qianfan_api:
+            self._send_json(
+                {
+                    "id": f"as-{uuid.uuid4().hex[:10]}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "result": reply,
+                    "is_truncated": False,
+                    "need_clear_history": False,
+                    "usage": _usage(request, reply),
+                }
+            )
+        else:
+            self._send_json({"answer": reply, "usage": _usage(request, reply)})
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """Threading server that ignores clients hanging up mid-stream"""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def _embedding(text: str) -> str:
+    """Deterministic pseudo embedding of `text`, as JSON, picked from a pool of vectors"""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return _EMBEDDING_POOL[int.from_bytes(digest, "little") % len(_EMBEDDING_POOL)]
+
+
+_EMBEDDING_POOL = [
+    json.dumps([round(rng.uniform(-1, 1), 6) for _ in range(EMBEDDING_DIM)])
+    for rng in (random.Random(i) for i in range(1024))
+]
+
+
+def _usage(request: dict, reply: str) -> dict[str, int]:
+    prompt = request.get("prompt") or request.get("query") or "".join(
+        str(m.get("content", "")) for m in request.get("messages") or []
+    )
+    return {
+        "prompt_tokens": len(prompt),
+        "completion_tokens": len(reply),
+        "total_tokens": len(prompt) + len(reply),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--chunks", type=int, default=8)
+    parser.add_argument("--qps", type=float, default=0.0, help="0 for no quota")
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency_ms / 1000
+    StubHandler.jitter = args.jitter_ms / 1000
+    StubHandler.error_rate = args.error_rate
+    StubHandler.chunks = args.chunks
+    StubHandler.qps = args.qps
+
+    server = StubServer(("127.0.0.1", args.port), StubHandler)
+    print(f"READY {server.server_address[1]}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"requests: {StubHandler.requests}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sidecar broker shared by several ComfyUI processes
+
+With `broker` set in config.yaml, upstream calls of the nodes are forwarded to
+one broker process, which owns the SDK clients, response cache, in-flight
+deduplication and rate limits for all of them. Start it with
+`python cli.py broker`.
+
+Requests and replies are JSON lines over one connection per process, matched
+by id, so concurrent calls of a process share the connection. Over TCP the
+first line of a connection must carry `broker_token` of config.yaml, the
+broker refuses to listen on TCP without one.
+"""
+
+import argparse
+import asyncio
+import functools
+import hashlib
+import hmac
+import importlib
+import itertools
+import json
+import logging
+import os
+import time
+import typing as tg
+
+from .aio import run
+from .config import QIANFAN_CONFIG, reload_config
+from .metrics import annotate, current_record, track
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+F = tg.TypeVar("F", bound=tg.Callable[..., tg.Awaitable[tg.Any]])
+
+# seconds calls run locally after the broker could not be reached
+RETRY_INTERVAL = 5.0
+
+# largest request or reply line, long dialogs and sweeps exceed asyncio's 64 KiB default
+MAX_MESSAGE_BYTES = 64 * 2**20
+
+# seconds a TCP client has to send its token
+HANDSHAKE_TIMEOUT = 10.0
+
+# modules registering brokered operations, imported by the broker process
+OP_MODULES = ("qianfan", "appbuilder")
+
+# call record fields measured in the broker, reported back to the calling node
+REMOTE_FIELDS = (
+    "queue_wait",
+    "prompt_tokens",
+    "completion_tokens",
+    "cache_hit",
+    "cache_similarity",
+    "deduplicated",
+    "retries",
+    "credential",
+    "failovers",
+    "hedges",
+    "served_by",
+)
+
+# operation name -> coroutine function, registered by `brokered`
+_ops: dict[str, tg.Callable[..., tg.Awaitable[tg.Any]]] = {}
+
+# set in the broker process itself, where operations always run locally
+_serving = False
+
+
+class BrokerError(RuntimeError):
+    """An operation failed in the broker"""
+
+
+def parse_address(address: str) -> tuple[str, tg.Any]:
+    """Parse `unix:<path>`, a socket path, or `[tcp:][<host>]:<port>`, the host defaults to loopback"""
+    if address.startswith("unix:"):
+        return "unix", address.removeprefix("unix:")
+    if address.startswith("tcp:"):
+        address = address.removeprefix("tcp:")
+    elif "/" in address or ":" not in address:
+        return "unix", address
+
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+
+
+def _token_matches(token: tg.Any, expected: str) -> bool:
+    if not isinstance(token, str):
+        return False
+    # digests have the same length, compare_digest leaks nothing about the token
+    return hmac.compare_digest(
+        hashlib.sha256(token.encode("utf-8")).digest(),
+        hashlib.sha256(expected.encode("utf-8")).digest(),
+    )
+
+
+async def _open(
+    address: str, token: str | None = None
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Connect to the broker, authenticating with `token` over TCP"""
+    kind, where = parse_address(address)
+    if kind == "unix":
+        return await asyncio.open_unix_connection(where, limit=MAX_MESSAGE_BYTES)
+
+    if not token:
+        raise PermissionError("broker_token is not set, it is required for a TCP broker")
+    reader, writer = await asyncio.open_connection(*where, limit=MAX_MESSAGE_BYTES)
+    try:
+        writer.write(_encode({"token": token}))
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), HANDSHAKE_TIMEOUT)
+        reply = json.loads(line) if line else {}
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        writer.close()
+        raise ConnectionError(f"broker handshake failed: {repr(e)}") from e
+    if not reply.get("ok"):
+        writer.close()
+        raise PermissionError(f"broker refused the connection: {reply.get('error', 'closed')}")
+    return reader, writer
+
+
+class _Connection:
+    """One connection to the broker, replies are routed to waiting calls by id"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._reader_task = asyncio.get_running_loop().create_task(self._read(reader))
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        error: Exception = ConnectionResetError("broker closed the connection")
+        try:
+            while line := await reader.readline():
+                reply = json.loads(line)
+                future = self._pending.pop(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (OSError, ValueError, KeyError) as e:
+            error = ConnectionResetError(f"broker connection lost: {repr(e)}")
+        finally:
+            self.writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def request(self, message: dict) -> dict:
+        """Send one request and wait for its reply, a cancelled call is cancelled in the broker too"""
+        id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[id] = future
+        try:
+            self.writer.write(_encode({"id": id, **message}))
+            await self.writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            if self._pending.pop(id, None) is not None and not self.closed:
+                self.writer.write(_encode({"id": id, "cancel": True}))
+            raise
+        except OSError:
+            self._pending.pop(id, None)
+            raise
+
+
+class BrokerClient:
+    """Connection of this process to the broker at `address`, opened on first use"""
+
+    def __init__(self, address: str, token: str | None = None):
+        self.address = address
+        self.token = token
+        # calls run locally until then after a connection failure
+        self.down_until = 0.0
+        self._conn: _Connection | None = None
+        self._lock: asyncio.Lock | None = None
+
+    async def _connection(self) -> _Connection:
+        if self._conn is not None and not self._conn.closed:
+            return self._conn
+
+        # created here, so it belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = _Connection(*await _open(self.address, self.token))
+                logger.info(f"Connected to broker {self.address}")
+            return self._conn
+
+    async def call(self, op: str, args: dict[str, tg.Any]) -> dict:
+        """Run operation `op` in the broker, get its reply"""
+        rec = current_record()
+        conn = await self._connection()
+        return await conn.request(
+            {"op": op, "args": args, "target": rec.target if rec else op}
+        )
+
+
+_client: BrokerClient | None = None
+
+
+def broker_address() -> str | None:
+    """Get the broker address from `broker` in config.yaml, None to run calls locally"""
+    if _serving:
+        return None
+    reload_config()
+    return QIANFAN_CONFIG.get("broker") or None
+
+
+def broker_token() -> str | None:
+    """Get the shared secret of TCP connections, `broker_token` in config.yaml"""
+    return QIANFAN_CONFIG.get("broker_token") or None
+
+
+def get_broker_client(address: str, token: str | None = None) -> BrokerClient:
+    """Get the client of this process, replaced when the configured address or token changes"""
+    global _client
+    if _client is None or (_client.address, _client.token) != (address, token):
+        _client = BrokerClient(address, token)
+    return _client
+
+
+def brokered(name: str) -> tg.Callable[[F], F]:
+    """
+    Register a coroutine function as operation `name`, forwarded to the broker
+    when one is configured. Arguments are keyword-only and, like the result,
+    must be JSON: tuples come back as lists. Streamed calls show progress on the
+    calling node, they always run locally. If the broker cannot be reached,
+    calls run locally for `RETRY_INTERVAL` seconds before trying again.
+    """
+
+    def decorate(fn: F) -> F:
+        _ops[name] = fn
+
+        @functools.wraps(fn)
+        async def wrapper(**kwargs: tg.Any) -> tg.Any:
+            address = broker_address()
+            if address is None or kwargs.get("stream"):
+                return await fn(**kwargs)
+
+            client = get_broker_client(address, broker_token())
+            if time.monotonic() < client.down_until:
+                return await fn(**kwargs)
+            try:
+                reply = await client.call(name, kwargs)
+            except OSError as e:
+                logger.warning(
+                    f"Broker {address} unreachable, running calls locally for "
+                    f"{RETRY_INTERVAL:.0f}s, reason: {repr(e)}"
+                )
+                client.down_until = time.monotonic() + RETRY_INTERVAL
+                return await fn(**kwargs)
+
+            record = reply.get("record") or {}
+            annotate(
+                **{
+                    k: v
+                    for k, v in record.items()
+                    if k in REMOTE_FIELDS and v not in (None, False, 0)
+                }
+            )
+            if "error" in reply:
+                raise BrokerError(reply["error"])
+            return reply["result"]
+
+        return tg.cast(F, wrapper)
+
+    return decorate
+
+
+async def _authenticate(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, token: str
+) -> bool:
+    """Check the token a TCP client sends first, refuse the connection otherwise"""
+    try:
+        line = await asyncio.wait_for(reader.readline(), HANDSHAKE_TIMEOUT)
+        ok = _token_matches(json.loads(line).get("token"), token)
+    except (OSError, ValueError, AttributeError, asyncio.TimeoutError):
+        ok = False
+
+    peer = writer.get_extra_info("peername")
+    if not ok:
+        logger.warning(f"Refusing broker connection from {peer}, wrong or missing token")
+        writer.write(_encode({"ok": False, "error": "wrong or missing broker_token"}))
+    else:
+        writer.write(_encode({"ok": True}))
+    try:
+        await writer.drain()
+    except OSError:
+        return False
+    return ok
+
+
+async def _handle(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    token: str | None = None,
+) -> None:
+    """Serve one node process, its requests run concurrently"""
+    if token is not None and not await _authenticate(reader, writer, token):
+        writer.close()
+        return
+
+    tasks: dict[int, asyncio.Task] = {}
+
+    async def run_op(id: int, op: str, args: dict[str, tg.Any], target: str) -> None:
+        try:
+            with track(op, target) as rec:
+                if op not in _ops:
+                    raise KeyError(f"unknown operation {op}")
+                reply = {"id": id, "result": await _ops[op](**args)}
+        except Exception as e:
+            reply = {"id": id, "error": repr(e)}
+        finally:
+            tasks.pop(id, None)
+
+        reply["record"] = {f: getattr(rec, f) for f in REMOTE_FIELDS}
+        if not writer.is_closing():
+            writer.write(_encode(reply))
+            await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if message.get("cancel"):
+                task = tasks.get(message["id"])
+                if task is not None:
+                    task.cancel()
+                continue
+            tasks[message["id"]] = asyncio.create_task(
+                run_op(
+                    message["id"],
+                    message["op"],
+                    message.get("args") or {},
+                    message.get("target") or message["op"],
+                )
+            )
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Dropping broker connection, reason: {repr(e)}")
+    finally:
+        # nobody is left to read the results
+        for task in list(tasks.values()):
+            task.cancel()
+        writer.close()
+
+
+async def serve(address: str, token: str | None = None) -> None:
+    """
+    Serve brokered operations at `address` until cancelled, a TCP address
+    requires `token`, which clients have to send first
+    """
+    global _serving
+    kind, where = parse_address(address)
+    if kind == "tcp" and not token:
+        raise ValueError(
+            f"refusing to listen on {address} without a token, set broker_token "
+            "in config.yaml or listen on a unix socket"
+        )
+
+    _serving = True
+    for name in OP_MODULES:
+        importlib.import_module(f"{__package__}.{name}")
+
+    if kind == "unix":
+        if os.path.exists(where):
+            try:
+                _, writer = await _open(address)
+            except OSError:
+                # left behind by a broker that did not shut down cleanly
+                os.unlink(where)
+            else:
+                writer.close()
+                raise RuntimeError(f"a broker is already listening on {address}")
+        server = await asyncio.start_unix_server(_handle, where, limit=MAX_MESSAGE_BYTES)
+    else:
+        server = await asyncio.start_server(
+            functools.partial(_handle, token=token), *where, limit=MAX_MESSAGE_BYTES
+        )
+
+    logger.info(f"Broker listening on {address}, operations: {', '.join(sorted(_ops))}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if kind == "unix" and os.path.exists(where):
+            os.unlink(where)
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="cli.py broker",
+        description="Serve the upstream calls of several ComfyUI processes",
+    )
+    parser.add_argument(
+        "--listen",
+        help="unix:<path> or [<host>]:<port>, the host defaults to 127.0.0.1, TCP "
+        "requires broker_token in config.yaml, default `broker` in config.yaml",
+    )
+    args = parser.parse_args(argv)
+
+    reload_config()
+    address = args.listen or QIANFAN_CONFIG.get("broker")
+    if not address:
+        parser.error("no address to listen on, pass --listen or set broker in config.yaml")
+
+    token = broker_token()
+    if parse_address(address)[0] == "tcp" and not token:
+        parser.error(
+            "listening on TCP requires broker_token in config.yaml, "
+            "or pass --listen unix:<path>"
+        )
+
+    try:
+        run(serve(address, token))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+__all__ = ["BrokerClient", "BrokerError", "brokered", "get_broker_client", "main", "serve"]
@@ -0,0 +1,66 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Command line entry point, runs the nodes outside ComfyUI
+
+Usage: python cli.py <command> [args...]
+
+Commands:
+    batch-job   run a node over every line of a JSONL file, see batch_job.py
+    broker      serve the upstream calls of several ComfyUI processes, see broker.py
+"""
+
+import importlib
+import pathlib
+import sys
+import types
+
+ROOT = pathlib.Path(__file__).resolve().parent
+PACKAGE_NAME = "comfyui_qianfan_llm"
+
+# command -> module with a `main(argv) -> int`
+COMMANDS = {
+    "batch-job": "batch_job",
+    "broker": "broker",
+}
+
+
+def load_package() -> types.ModuleType:
+    """
+    Register the repo as a package without running its `__init__.py`, so modules
+    using relative imports can be loaded without ComfyUI
+    """
+    if PACKAGE_NAME not in sys.modules:
+        pkg = types.ModuleType(PACKAGE_NAME)
+        pkg.__path__ = [str(ROOT)]
+        sys.modules[PACKAGE_NAME] = pkg
+    return sys.modules[PACKAGE_NAME]
+
+
+def main() -> int:
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(__doc__, file=sys.stderr)
+        return 2
+
+    # ./qianfan and ./appbuilder of the repo would shadow the SDKs
+    sys.path = [p for p in sys.path if pathlib.Path(p or ".").resolve() != ROOT]
+
+    load_package()
+    module = importlib.import_module(f"{PACKAGE_NAME}.{COMMANDS[sys.argv[1]]}")
+    return module.main(sys.argv[2:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
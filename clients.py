@@ -0,0 +1,127 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import hashlib
+import logging
+import threading
+import typing as tg
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+T = tg.TypeVar("T")
+
+DEFAULT_MAX_CLIENTS = 64
+
+
+def credentials_version(*credentials: str | None) -> str:
+    """Short digest identifying a set of credentials, without keeping them in keys"""
+    digest = hashlib.sha256("\0".join(c or "" for c in credentials).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ClientRegistry:
+    """
+    Long-lived SDK client instances keyed by (kind, key, credentials version).
+
+    Reusing a client keeps its HTTP session (keep-alive connections) and the access
+    token cached by the SDK. Entries created with other credentials of the same kind
+    are dropped as soon as new credentials are seen.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_CLIENTS):
+        self.max_size = max_size
+        self._clients: collections.OrderedDict[tuple, tg.Any] = (
+            collections.OrderedDict()
+        )
+        self._versions: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        kind: str,
+        key: tg.Hashable,
+        factory: tg.Callable[[], T],
+        credentials: tuple[str | None, ...],
+    ) -> T:
+        """Get the client for (kind, key), creating it with `factory` if missing"""
+        version = credentials_version(*credentials)
+        full_key = (kind, key, version)
+
+        with self._lock:
+            if self._versions.get(kind) != version:
+                if kind in self._versions:
+                    logger.debug(f"Credentials changed, dropping {kind} clients")
+                self._drop(kind)
+                self._versions[kind] = version
+
+            client = self._clients.get(full_key)
+            if client is not None:
+                self._clients.move_to_end(full_key)
+                return client
+
+            client = factory()
+            self._clients[full_key] = client
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+
+            return client
+
+    def invalidate(self, kind: str | None = None) -> None:
+        """Drop clients of `kind`, or all clients"""
+        with self._lock:
+            if kind is None:
+                self._clients.clear()
+                self._versions.clear()
+            else:
+                self._drop(kind)
+                self._versions.pop(kind, None)
+
+    def _drop(self, kind: str) -> None:
+        for full_key in [k for k in self._clients if k[0] == kind]:
+            del self._clients[full_key]
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+_registry = ClientRegistry()
+
+
+def get_client(
+    kind: str,
+    key: tg.Hashable,
+    factory: tg.Callable[[], T],
+    credentials: tuple[str | None, ...],
+) -> T:
+    """Get a client from the shared registry"""
+    return _registry.get(kind, key, factory, credentials)
+
+
+def invalidate_clients(kind: str | None = None) -> None:
+    """Drop clients from the shared registry"""
+    _registry.invalidate(kind)
+
+
+__all__ = ["ClientRegistry", "get_client", "invalidate_clients"]
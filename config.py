@@ -13,30 +13,97 @@
 # limitations under the License.
 
 
+import collections.abc
+import os
 import pathlib
+import threading
+import typing as tg
 
 import yaml
 
 # Load or create yaml config
 config_path = pathlib.Path(__file__).parent / "config.yaml"
 
-QIANFAN_CONFIG = {}
 
+class _Config(collections.abc.Mapping):
+    """
+    Read-only view of the parsed config. A reload swaps the whole dict behind
+    it, so readers on other threads see the old or the new config, never a
+    partial one, and `from .config import QIANFAN_CONFIG` stays valid.
+    """
 
-def reload_config():
-    """Reload config from yaml file"""
-    global QIANFAN_CONFIG
+    def __init__(self):
+        self._data: dict[str, tg.Any] = {}
 
-    if not config_path.exists():
-        QIANFAN_CONFIG = {
-            "appbuilder_api_key": "your appbuilder API key",
-            "iam_ak": "your iam ak",
-            "iam_sk": "your iam sk",
-        }
-        config_path.write_text(yaml.safe_dump(QIANFAN_CONFIG, sort_keys=False))
-    else:
-        with open(config_path, "r") as f:
-            QIANFAN_CONFIG = yaml.safe_load(f)
+    def __getitem__(self, key: str) -> tg.Any:
+        return self._data[key]
+
+    def __iter__(self) -> tg.Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return repr(self._data)
+
+
+QIANFAN_CONFIG = _Config()
+
+# bumped every time the parsed content changes, returned by reload_config
+_version = 0
+
+_lock = threading.Lock()
+_last_stat: tuple[int, int] | None = None
+
+
+def _stat_key() -> tuple[int, int] | None:
+    """Get (mtime_ns, size) of config file, None if missing"""
+    try:
+        st = os.stat(config_path)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_mtime_ns, st.st_size)
+
+
+def reload_config(force: bool = False) -> int:
+    """
+    Reload config from yaml file, only re-parse when the file changed on disk
+    (mtime or size) or when `force` is set.
+
+    Returns the current config version.
+    """
+    global _version, _last_stat
+
+    stat = _stat_key()
+    if not force and stat is not None and stat == _last_stat:
+        return _version
+
+    with _lock:
+        stat = _stat_key()
+        if not force and stat is not None and stat == _last_stat:
+            return _version
+
+        if stat is None:
+            new_config = {
+                "appbuilder_api_key": "your appbuilder API key",
+                "iam_ak": "your iam ak",
+                "iam_sk": "your iam sk",
+            }
+            config_path.write_text(yaml.safe_dump(new_config, sort_keys=False))
+            stat = _stat_key()
+        else:
+            with open(config_path, "r") as f:
+                new_config = yaml.safe_load(f) or {}
+
+        if new_config != QIANFAN_CONFIG._data:
+            QIANFAN_CONFIG._data = new_config
+            _version += 1
+
+        _last_stat = stat
+
+    return _version
 
 
 reload_config()
@@ -0,0 +1,226 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import logging
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# name of the credential set built from top-level iam_ak / iam_sk / appbuilder_api_key
+DEFAULT_NAME = "default"
+
+STRATEGIES = ("least_loaded", "round_robin")
+DEFAULT_STRATEGY = "least_loaded"
+
+# seconds a throttled credential is skipped, doubled on every consecutive throttle
+DEFAULT_COOLDOWN = 30.0
+MAX_COOLDOWN = 600.0
+
+
+@dataclasses.dataclass(eq=False)
+class Credential:
+    """One credential set from config, plus its load and health counters"""
+
+    name: str
+    iam_ak: str | None = dataclasses.field(default=None, repr=False)
+    iam_sk: str | None = dataclasses.field(default=None, repr=False)
+    appbuilder_api_key: str | None = dataclasses.field(default=None, repr=False)
+    weight: float = 1.0
+    rate_limits: dict = dataclasses.field(default_factory=dict, repr=False)
+
+    in_flight: int = 0
+    calls: int = 0
+    throttled: int = 0
+    consecutive_throttles: int = 0
+    open_until: float = 0.0
+    # smooth weighted round robin state
+    current_weight: float = 0.0
+
+    def serves(self, service: str) -> bool:
+        """Check whether this set has keys for `service`, qianfan or appbuilder"""
+        match service:
+            case "qianfan":
+                return bool(self.iam_ak and self.iam_sk)
+            case "appbuilder":
+                return bool(self.appbuilder_api_key)
+            case _:
+                return False
+
+    @property
+    def identity(self) -> tuple[str | None, str | None, str | None]:
+        """The keys of the set, a set reloaded with the same keys is the same set"""
+        return (self.iam_ak, self.iam_sk, self.appbuilder_api_key)
+
+    def is_open(self, now: float) -> bool:
+        """Whether the circuit is open, i.e. the set is cooling down after throttling"""
+        return self.open_until > now
+
+
+def _load_credentials(config: tg.Mapping[str, tg.Any]) -> list[Credential]:
+    """Build credential sets from `credentials` in config, or the legacy single keys"""
+    entries: list[dict] = config.get("credentials") or [
+        {
+            "name": DEFAULT_NAME,
+            "iam_ak": config.get("iam_ak"),
+            "iam_sk": config.get("iam_sk"),
+            "appbuilder_api_key": config.get("appbuilder_api_key"),
+        }
+    ]
+
+    creds = []
+    for i, entry in enumerate(entries):
+        creds.append(
+            Credential(
+                name=str(entry.get("name") or f"credential-{i}"),
+                iam_ak=entry.get("iam_ak"),
+                iam_sk=entry.get("iam_sk"),
+                appbuilder_api_key=entry.get("appbuilder_api_key"),
+                weight=max(float(entry.get("weight", 1.0)), 1e-6),
+                rate_limits=entry.get("rate_limits") or {},
+            )
+        )
+    return creds
+
+
+class CredentialPool:
+    """
+    Route calls across the credential sets of config.yaml.
+
+    `acquire` picks a set by `credential_strategy`, either least in-flight calls
+    per weight or smooth weighted round robin. A set reported as throttled is
+    skipped for `credential_cooldown` seconds (doubled while it keeps being
+    throttled), unless every set is cooling down.
+    """
+
+    def __init__(self):
+        self._creds: list[Credential] = []
+        self._config_version = -1
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        version = reload_config()
+        if version == self._config_version:
+            return
+
+        # sets whose keys did not change keep their load and circuit, calls in
+        # flight are released on the same object
+        old = {c.identity: c for c in self._creds}
+        creds = []
+        for new in _load_credentials(QIANFAN_CONFIG):
+            cred = old.pop(new.identity, None)
+            if cred is None:
+                creds.append(new)
+                continue
+            cred.name, cred.weight = new.name, new.weight
+            cred.rate_limits = new.rate_limits
+            creds.append(cred)
+
+        self._creds = creds
+        self._config_version = version
+
+    def _pick(self, candidates: list[Credential]) -> Credential:
+        match QIANFAN_CONFIG.get("credential_strategy", DEFAULT_STRATEGY):
+            case "round_robin":
+                total = sum(c.weight for c in candidates)
+                for c in candidates:
+                    c.current_weight += c.weight
+                best = max(candidates, key=lambda c: c.current_weight)
+                best.current_weight -= total
+                return best
+            case _:
+                return min(
+                    candidates,
+                    key=lambda c: (c.in_flight / c.weight, c.calls / c.weight),
+                )
+
+    def acquire(self, service: str) -> Credential:
+        """Pick a credential set for one call of `service`, `release` it afterwards"""
+        with self._lock:
+            self._refresh()
+            candidates = [c for c in self._creds if c.serves(service)]
+            if not candidates:
+                raise ValueError(f"no {service} credentials in config.yaml")
+
+            now = time.monotonic()
+            healthy = [c for c in candidates if not c.is_open(now)]
+            cred = (
+                self._pick(healthy)
+                if healthy
+                else min(candidates, key=lambda c: c.open_until)
+            )
+            cred.in_flight += 1
+            cred.calls += 1
+            return cred
+
+    def release(self, cred: Credential, throttled: bool = False) -> None:
+        """End a call on `cred`, opening its circuit if it was throttled"""
+        cooldown = float(QIANFAN_CONFIG.get("credential_cooldown", DEFAULT_COOLDOWN))
+        with self._lock:
+            cred.in_flight -= 1
+            if not throttled:
+                cred.consecutive_throttles = 0
+                return
+
+            cred.throttled += 1
+            cred.consecutive_throttles += 1
+            delay = min(MAX_COOLDOWN, cooldown * 2 ** (cred.consecutive_throttles - 1))
+            cred.open_until = time.monotonic() + delay
+
+        logger.warning(f"Credential {cred.name} throttled, skipping it for {delay:.0f}s")
+
+    def available(self, service: str) -> bool:
+        """Check whether any credential set of `service` is not cooling down"""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh()
+            return any(c.serves(service) and not c.is_open(now) for c in self._creds)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Get load and health counters per credential set"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                c.name: {
+                    "in_flight": c.in_flight,
+                    "calls": c.calls,
+                    "throttled": c.throttled,
+                    "cooldown": max(0.0, c.open_until - now),
+                }
+                for c in self._creds
+            }
+
+
+_pool = CredentialPool()
+
+
+def get_pool() -> CredentialPool:
+    """Get the process-wide credential pool"""
+    return _pool
+
+
+__all__ = ["Credential", "CredentialPool", "get_pool"]
@@ -0,0 +1,101 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import concurrent.futures
+import dataclasses
+import logging
+import threading
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+T = tg.TypeVar("T")
+R = tg.TypeVar("R")
+
+DEFAULT_MAX_WORKERS = 16
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class ItemResult(tg.Generic[R]):
+    """Outcome of one batch item, either `value` or `error` is set"""
+
+    value: R | None = None
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Get the process-wide dispatch thread pool"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            reload_config()
+            max_workers = int(
+                QIANFAN_CONFIG.get("dispatch_max_workers", DEFAULT_MAX_WORKERS)
+            )
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="qianfan-dispatch"
+            )
+        return _executor
+
+
+def _as_list(value: tg.Any) -> list:
+    """Wrap a scalar input into a list, None becomes an empty list"""
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def broadcast(**columns: tg.Any) -> list[dict[str, tg.Any]]:
+    """
+    Zip list inputs into per-item kwargs, shorter lists repeat their last element
+    the same way ComfyUI maps list inputs. Empty or missing lists become None.
+    """
+    lists = {name: _as_list(col) for name, col in columns.items()}
+    length = max((len(col) for col in lists.values()), default=0)
+    return [
+        {
+            name: (col[min(i, len(col) - 1)] if col else None)
+            for name, col in lists.items()
+        }
+        for i in range(length)
+    ]
+
+
+def first(value: tg.Any, default: T) -> T:
+    """Get the first element of a list input, `default` if missing"""
+    values = _as_list(value)
+    return values[0] if values and values[0] is not None else default
+
+
+__all__ = ["ItemResult", "broadcast", "first", "get_executor"]
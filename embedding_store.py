@@ -0,0 +1,256 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+import typing as tg
+import uuid
+
+import numpy as np
+
+from .model_catalog import cache_dir
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+store_dir = cache_dir / "embeddings"
+
+DIGEST_SIZE = 16
+
+
+def text_digest(text: str) -> bytes:
+    """Key of a text in the store"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=DIGEST_SIZE).digest()
+
+
+@contextlib.contextmanager
+def _file_lock(path: pathlib.Path) -> tg.Iterator[None]:
+    """Hold an exclusive lock on `path` across processes"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                # LK_LOCK gives up after 10 attempts, keep waiting
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk vectors of one embedding model, keyed by text digest.
+
+    Row i of `<name>.f32` holds the float32 vector of the i-th digest in
+    `<name>.keys`, vectors are read through a memory map so only the rows
+    looked up are paged in. Only the digest index is kept in memory.
+
+    Processes may share a store: appends hold a lock on `<name>.lock` and
+    number rows by the files, the index picks up rows appended by others
+    before every use.
+    """
+
+    def __init__(self, name: str, directory: pathlib.Path | None = None):
+        directory = directory or store_dir
+        stem = re.sub(r"[^\w.-]", "_", name)
+        self.keys_path = directory / f"{stem}.keys"
+        self.vectors_path = directory / f"{stem}.f32"
+        self.meta_path = directory / f"{stem}.json"
+        self.lock_path = directory / f"{stem}.lock"
+        self.dim = 0
+        # changes when the store starts over, e.g. after a model change
+        self._generation: str | None = None
+        self._meta_stat: tuple[int, int] | None = None
+        self._rows: dict[bytes, int] = {}
+        # rows of the files read into the index
+        self._count = 0
+        self._map: np.memmap | None = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _refresh(self) -> None:
+        """Index rows appended since the last refresh, by this or another process"""
+        try:
+            st = self.meta_path.stat()
+            meta_stat = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            meta_stat = None
+        if meta_stat != self._meta_stat:
+            self._meta_stat = meta_stat
+            try:
+                meta = json.loads(self.meta_path.read_text())
+                dim, generation = int(meta["dim"]), meta.get("generation")
+            except (OSError, ValueError, KeyError):
+                dim, generation = 0, None
+            if (dim, generation) != (self.dim, self._generation):
+                self.dim, self._generation = dim, generation
+                self._rows, self._count, self._map = {}, 0, None
+
+        if not self.dim:
+            return
+        try:
+            keys_size = self.keys_path.stat().st_size
+            vector_rows = self.vectors_path.stat().st_size // (self.dim * 4)
+        except OSError:
+            return
+        # a row is complete once its digest is written, vectors are written first
+        count = min(keys_size // DIGEST_SIZE, vector_rows)
+        if count <= self._count:
+            return
+
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._count * DIGEST_SIZE)
+            keys = f.read((count - self._count) * DIGEST_SIZE)
+        for i in range(len(keys) // DIGEST_SIZE):
+            digest = keys[i * DIGEST_SIZE : (i + 1) * DIGEST_SIZE]
+            self._rows.setdefault(digest, self._count + i)
+        self._count += len(keys) // DIGEST_SIZE
+
+    def _repair(self) -> None:
+        """Drop a row half written by an interrupted append, under the file lock only"""
+        keys_size = self.keys_path.stat().st_size
+        vectors_size = self.vectors_path.stat().st_size
+        if (keys_size, vectors_size) == (
+            self._count * DIGEST_SIZE,
+            self._count * self.dim * 4,
+        ):
+            return
+
+        logger.warning(f"Truncating {self.keys_path.name} to {self._count} complete rows")
+        with open(self.keys_path, "r+b") as f:
+            f.truncate(self._count * DIGEST_SIZE)
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(self._count * self.dim * 4)
+
+    def _reset(self, dim: int) -> None:
+        """Start over with vectors of `dim`, e.g. after the model behind a name changed, under the file lock only"""
+        if self.dim:
+            logger.warning(f"Embedding size changed to {dim}, clearing {self.vectors_path.name}")
+        self.keys_path.parent.mkdir(parents=True, exist_ok=True)
+        generation = uuid.uuid4().hex
+        # new files instead of truncating, other processes may still map the old vectors
+        for path, data in (
+            (self.keys_path, b""),
+            (self.vectors_path, b""),
+            (self.meta_path, json.dumps({"dim": dim, "generation": generation}).encode()),
+        ):
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+
+        self.dim, self._generation = dim, generation
+        st = self.meta_path.stat()
+        self._meta_stat = (st.st_mtime_ns, st.st_size)
+        self._rows, self._count, self._map = {}, 0, None
+
+    def lookup(self, digests: list[bytes]) -> list[int | None]:
+        """Get the row of each digest, None if it is not stored"""
+        with self._lock:
+            self._refresh()
+            return [self._rows.get(d) for d in digests]
+
+    def read(self, rows: list[int]) -> np.ndarray:
+        """Get stored vectors by row, as a (len(rows), dim) float32 array"""
+        with self._lock:
+            if self._map is None or len(self._map) < self._count:
+                self._map = np.memmap(
+                    self.vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(self._count, self.dim),
+                )
+            return self._map[rows]
+
+    def add(self, digests: list[bytes], vectors: np.ndarray) -> None:
+        """Append vectors of new digests, digests already stored are skipped"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, _file_lock(self.lock_path):
+            self._refresh()
+            if vectors.shape[1] != self.dim:
+                self._reset(vectors.shape[1])
+            else:
+                self._repair()
+
+            new = [i for i, d in enumerate(digests) if d not in self._rows]
+            new = list({digests[i]: i for i in new}.values())
+            if not new:
+                return
+
+            # vectors first, a crash before the keys are written leaves an orphan row
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors[new].tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(digests[i] for i in new))
+
+            for i in new:
+                self._rows[digests[i]] = self._count
+                self._count += 1
+
+    def stats(self) -> dict[str, int]:
+        """Get row count, vector size and bytes on disk"""
+        with self._lock:
+            return {
+                "rows": self._count,
+                "dim": self.dim,
+                "bytes": self._count * (self.dim * 4 + DIGEST_SIZE),
+            }
+
+    def __len__(self) -> int:
+        return self._count
+
+
+_stores: dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(name: str) -> EmbeddingStore:
+    """Get the shared store of embedding model or endpoint `name`"""
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = EmbeddingStore(name)
+        return _stores[name]
+
+
+__all__ = ["EmbeddingStore", "get_store", "text_digest"]
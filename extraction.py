@@ -0,0 +1,315 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import re
+import typing as tg
+
+# opening quote -> quotes that may close it, models mix ascii and full-width quotes
+QUOTES = {'"': '"”', "'": "'’", "“": '”"', "‘": "’'"}
+
+_FENCE = re.compile(r"```[\w-]*[ \t]*\n?(.*?)(?:```|$)", re.S)
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_LITERALS = {
+    "true": "true",
+    "True": "true",
+    "false": "false",
+    "False": "false",
+    "null": "null",
+    "None": "null",
+}
+_BARE_KEY = re.compile(r"[^\s{}\[\],:，：]+")
+_BARE_VALUE = re.compile(r"[^,}\]\n，]+")
+# what may follow the closing quote of a string, anything else is a stray quote
+_AFTER_STRING = ",:}]，："
+_CONTROL = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+def _scan_string(text: str, i: int, final: bool) -> tuple[str, int] | None:
+    """
+    Scan the quoted string starting at `text[i]` into a JSON string body,
+    escaping stray quotes and raw control characters. Returns the body and the
+    index after the closing quote, None if the string may not be complete yet.
+    With `final`, an unterminated string ends at the end of text.
+    """
+    closers = QUOTES[text[i]]
+    body: list[str] = []
+    j, n = i + 1, len(text)
+    while j < n:
+        c = text[j]
+        if c == "\\":
+            if j + 1 >= n:
+                break
+            # \' is valid in single quoted strings only
+            body.append("'" if text[j + 1] == "'" else text[j : j + 2])
+            j += 2
+            continue
+
+        if c in closers:
+            k = j + 1
+            while k < n and text[k] in " \t\r":
+                k += 1
+            if k >= n:
+                if final:
+                    return "".join(body), j + 1
+                return None
+            # a newline before the next token ends the string too, e.g. a missing comma
+            if text[k] in _AFTER_STRING or text[k] == "\n":
+                return "".join(body), j + 1
+
+        if c == '"':
+            body.append('\\"')
+        elif c in _CONTROL:
+            body.append(_CONTROL[c])
+        elif c < " ":
+            body.append(f"\\u{ord(c):04x}")
+        else:
+            body.append(c)
+        j += 1
+
+    if final:
+        return "".join(body), n
+    return None
+
+
+def _decode(body: str) -> str:
+    """Decode a JSON string body, keeping it as-is if its escapes are invalid"""
+    try:
+        return json.loads(f'"{body}"')
+    except ValueError:
+        return body
+
+
+def strip_fences(text: str) -> str:
+    """Get the content of the first markdown code block, or the text itself"""
+    m = _FENCE.search(text)
+    return m.group(1) if m else text
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrite the almost-JSON object at the start of `text` into valid JSON:
+    single / full-width quotes and punctuation, unquoted keys and values, python
+    literals, missing or trailing commas, unterminated strings and brackets.
+    Text after the outermost object is dropped.
+    """
+    out: list[str] = []
+    stack: list[str] = []
+    # whether the last token ends a value, so a following value needs a comma
+    value_end = False
+
+    def emit_value(token: str) -> None:
+        nonlocal value_end
+        if value_end:
+            out.append(",")
+        out.append(token)
+        value_end = True
+
+    def strip_comma() -> None:
+        if out and out[-1] == ",":
+            out.pop()
+
+    i, n = text.find("{"), len(text)
+    if i < 0:
+        return ""
+    while i < n:
+        c = text[i]
+        if c in QUOTES:
+            body, i = _scan_string(text, i, final=True)
+            emit_value(f'"{body}"')
+            continue
+
+        if c in "{[":
+            emit_value(c)
+            stack.append("}" if c == "{" else "]")
+            value_end = False
+        elif c in "}]":
+            if c in stack:
+                while stack:
+                    closer = stack.pop()
+                    strip_comma()
+                    if out and out[-1] == ":":
+                        out.append("null")
+                    out.append(closer)
+                    if closer == c:
+                        break
+                value_end = True
+                if not stack:
+                    break
+        elif c in ",，":
+            if value_end:
+                out.append(",")
+                value_end = False
+        elif c in ":：":
+            out.append(":")
+            value_end = False
+        elif not c.isspace():
+            in_value = bool(out) and (
+                out[-1] == ":" or (stack[-1:] == ["]"] and out[-1] in ("[", ","))
+            )
+            m = (_BARE_VALUE if in_value else _BARE_KEY).match(text, i)
+            word = m.group().strip()
+            i = m.end()
+            if word in _LITERALS:
+                emit_value(_LITERALS[word])
+            elif _NUMBER.fullmatch(word):
+                emit_value(word)
+            else:
+                emit_value(json.dumps(word, ensure_ascii=False))
+            continue
+        i += 1
+
+    strip_comma()
+    if out and out[-1] == ":":
+        out.append("null")
+    while stack:
+        out.append(stack.pop())
+    return "".join(out)
+
+
+def load_object(text: str) -> tg.Any | None:
+    """Parse the JSON object in a model reply, repairing it if needed, None if there is none"""
+    text = strip_fences(text)
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    try:
+        return json.JSONDecoder().raw_decode(text, start)[0]
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair_json(text[start:]))
+    except ValueError:
+        return None
+
+
+def _as_text(value: tg.Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _find_fields(data: tg.Any, fields: tg.Sequence[str]) -> dict[str, tg.Any]:
+    """Get `fields` of the first dict holding any of them, searching nested values"""
+    if isinstance(data, dict):
+        found = {f: data[f] for f in fields if f in data}
+        if found:
+            return found
+        data = list(data.values())
+    if isinstance(data, list):
+        for item in data:
+            found = _find_fields(item, fields)
+            if found:
+                return found
+    return {}
+
+
+class FieldExtractor:
+    """
+    Pick fields out of a JSON-ish model reply while it streams in. A field is
+    reported by `feed` as soon as its value is complete, the reply does not
+    need to be valid JSON, e.g. fenced, with trailing text or `key: value` lines.
+    """
+
+    def __init__(self, fields: tg.Sequence[str]):
+        self.fields = tuple(fields)
+        self.values: dict[str, str] = {}
+        self.text = ""
+        self._keys = {
+            f: re.compile(
+                rf"(?:^|(?<=[\s{{,\"'“‘]))[\"'“‘]?{re.escape(f)}[\"'”’]?\s*[:：]\s*"
+            )
+            for f in self.fields
+        }
+        self._starts: dict[str, int] = {}
+
+    @property
+    def done(self) -> bool:
+        return len(self.values) == len(self.fields)
+
+    def feed(self, chunk: str) -> dict[str, str]:
+        """Add a chunk of the reply, get the fields it completed"""
+        self.text += chunk
+        return self._scan(final=False)
+
+    def finish(self) -> dict[str, str]:
+        """End the reply, get all fields found"""
+        self._scan(final=True)
+        return self.values
+
+    def _scan(self, final: bool) -> dict[str, str]:
+        new = {}
+        for field in self.fields:
+            if field in self.values:
+                continue
+
+            start = self._starts.get(field)
+            if start is None:
+                m = self._keys[field].search(self.text)
+                if m is None or (m.end() == len(self.text) and not final):
+                    continue
+                start = self._starts[field] = m.end()
+
+            value = self._scan_value(start, final)
+            if value is not None:
+                self.values[field] = new[field] = value
+        return new
+
+    def _scan_value(self, i: int, final: bool) -> str | None:
+        text = self.text
+        if i >= len(text):
+            return "" if final else None
+
+        if text[i] in QUOTES:
+            scanned = _scan_string(text, i, final)
+            return None if scanned is None else _decode(scanned[0])
+
+        if text[i] in "{[":
+            if not final:
+                return None
+            try:
+                value = json.JSONDecoder().raw_decode(text, i)[0]
+            except ValueError:
+                value = load_object(text[i:]) if text[i] == "{" else None
+            return text[i:].strip() if value is None else _as_text(value)
+
+        m = _BARE_VALUE.match(text, i)
+        if m is None:
+            return ""
+        if m.end() == len(text) and not final:
+            return None
+        word = m.group().strip()
+        return "" if word in ("null", "None") else word
+
+
+def extract_fields(text: str, fields: tg.Sequence[str]) -> dict[str, str] | None:
+    """
+    Get `fields` from a model reply as text, repairing malformed JSON without
+    another model call. None if none of the fields can be found.
+    """
+    data = load_object(text)
+    found = _find_fields(data, fields) if data is not None else {}
+    if not found:
+        extractor = FieldExtractor(fields)
+        extractor.feed(strip_fences(text))
+        found = extractor.finish()
+    if not found:
+        return None
+    return {f: _as_text(found.get(f)) for f in fields}
+
+
+__all__ = ["FieldExtractor", "extract_fields", "load_object", "repair_json", "strip_fences"]
@@ -0,0 +1,189 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+from .metrics import annotate
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+R = tg.TypeVar("R")
+
+# latencies kept per target for the hedge threshold
+LATENCY_WINDOW = 256
+# no hedging until a target has this many successful calls
+HEDGE_MIN_SAMPLES = 20
+
+DEFAULT_HEDGE_QUANTILE = 0.95
+DEFAULT_HEDGE_MIN_DELAY = 1.0
+
+
+class LatencyTracker:
+    """Recent successful call latencies per target, in seconds"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: dict[str, collections.deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, name: str, q: float) -> float | None:
+        """Get the `q` quantile of recent latencies, None if there are too few"""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Get sample count, p50 and p95 per target"""
+        with self._lock:
+            snapshot = {name: sorted(s) for name, s in self._samples.items()}
+        return {
+            name: {
+                "count": len(s),
+                "p50": s[len(s) // 2],
+                "p95": s[min(len(s) - 1, int(0.95 * len(s)))],
+            }
+            for name, s in snapshot.items()
+            if s
+        }
+
+
+_tracker = LatencyTracker()
+
+
+def get_latency_tracker() -> LatencyTracker:
+    """Get the process-wide per-target latency tracker"""
+    return _tracker
+
+
+def fallback_chain(name: str) -> list[str]:
+    """Get `name` followed by its fallbacks from `fallbacks` in config.yaml"""
+    reload_config()
+    fallbacks: dict = QIANFAN_CONFIG.get("fallbacks") or {}
+    chain = [name]
+    for fallback in fallbacks.get(name) or []:
+        if fallback not in chain:
+            chain.append(str(fallback))
+    return chain
+
+
+def hedge_delay(name: str) -> float | None:
+    """
+    Get how long to wait on `name` before hedging to the next target, None if
+    hedging is off or there are not enough latency samples yet
+    """
+    if not QIANFAN_CONFIG.get("hedge", False):
+        return None
+    q = float(QIANFAN_CONFIG.get("hedge_quantile", DEFAULT_HEDGE_QUANTILE))
+    latency = _tracker.quantile(name, q)
+    if latency is None:
+        return None
+    return max(
+        latency, float(QIANFAN_CONFIG.get("hedge_min_delay", DEFAULT_HEDGE_MIN_DELAY))
+    )
+
+
+async def run_chain(
+    chain: list[str],
+    fn: tg.Callable[[str], tg.Awaitable[R]],
+    hedge: bool = True,
+) -> R:
+    """
+    Await `fn` on the first target of `chain`, moving on to the next target when
+    a call fails. With `hedge`, a call slower than the target's hedge delay gets a
+    duplicate request to the next target, the first successful result wins and
+    the other requests are cancelled.
+    """
+    tasks: dict[asyncio.Task, tuple[str, float]] = {}
+    next_index = 0
+    error: BaseException | None = None
+
+    def launch() -> None:
+        nonlocal next_index
+        name = chain[next_index]
+        next_index += 1
+        tasks[asyncio.ensure_future(fn(name))] = (name, time.perf_counter())
+
+    launch()
+    try:
+        while tasks:
+            delay = None
+            if hedge and next_index < len(chain):
+                delay = hedge_delay(chain[next_index - 1])
+
+            done, _ = await asyncio.wait(
+                tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                logger.info(
+                    f"{chain[next_index - 1]} slower than {delay:.2f}s, "
+                    f"hedging to {chain[next_index]}"
+                )
+                annotate(hedges=1)
+                launch()
+                continue
+
+            for task in done:
+                name, start = tasks.pop(task)
+                if task.exception() is None:
+                    _tracker.observe(name, time.perf_counter() - start)
+                    if name != chain[0]:
+                        annotate(served_by=name)
+                    return task.result()
+
+                error = task.exception()
+                logger.warning(f"Call to {name} failed, reason: {repr(error)}")
+
+            if next_index < len(chain):
+                logger.info(f"Failing over to {chain[next_index]}")
+                annotate(failovers=1)
+                launch()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    assert error is not None
+    raise error
+
+
+__all__ = [
+    "LatencyTracker",
+    "fallback_chain",
+    "get_latency_tracker",
+    "hedge_delay",
+    "run_chain",
+]
@@ -0,0 +1,309 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import bisect
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+@dataclasses.dataclass
+class CallRecord:
+    """
+    Measurements of one node call, filled in by the layers it goes through.
+    Connection time is part of `latency`, the SDKs connect without trace hooks.
+    """
+
+    kind: str
+    target: str
+    latency: float = 0.0
+    queue_wait: float = 0.0
+    ttft: float | None = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hit: bool = False
+    cache_similarity: float | None = None
+    deduplicated: bool = False
+    retries: int = 0
+    credential: str | None = None
+    failovers: int = 0
+    hedges: int = 0
+    served_by: str | None = None
+    error: str | None = None
+
+    def to_json(self) -> str:
+        """Serialize for the STATS node output"""
+        return json.dumps(dataclasses.asdict(self), ensure_ascii=False)
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: tg.Any) -> str:
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """In-process counters, gauges and histograms, e.g. labelled by (kind, target)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+
+    def inc(self, name: str, labels: tuple, value: float = 1) -> None:
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, labels: tuple, value: float) -> None:
+        with self._lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        with self._lock:
+            key = (name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def record(self, rec: CallRecord) -> None:
+        """Account a finished call"""
+        labels = (("kind", rec.kind), ("target", rec.target))
+        status = "error" if rec.error else "ok"
+        self.inc("qianfan_calls_total", labels + (("status", status),))
+        self.observe("qianfan_call_latency_seconds", labels, rec.latency)
+        self.observe("qianfan_queue_wait_seconds", labels, rec.queue_wait)
+        if rec.ttft is not None:
+            self.observe("qianfan_time_to_first_token_seconds", labels, rec.ttft)
+        if rec.prompt_tokens:
+            self.inc("qianfan_tokens_total", labels + (("type", "prompt"),), rec.prompt_tokens)
+        if rec.completion_tokens:
+            self.inc(
+                "qianfan_tokens_total",
+                labels + (("type", "completion"),),
+                rec.completion_tokens,
+            )
+        if rec.cache_hit:
+            self.inc("qianfan_cache_hits_total", labels)
+        if rec.cache_similarity is not None:
+            self.inc("qianfan_semantic_cache_hits_total", labels)
+        if rec.deduplicated:
+            self.inc("qianfan_deduplicated_total", labels)
+        if rec.retries:
+            self.inc("qianfan_retries_total", labels, rec.retries)
+
+    def snapshot(self) -> dict[str, tg.Any]:
+        """Get a JSON-friendly copy of all metrics"""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.gauges.items()
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": hist.count,
+                        "sum": hist.sum,
+                    }
+                    for (name, labels), hist in self.histograms.items()
+                ],
+            }
+
+    def render_prometheus(self) -> str:
+        """Render all metrics in Prometheus text exposition format"""
+
+        def fmt(labels: tuple) -> str:
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+        lines: list[str] = []
+        with self._lock:
+            seen: set[str] = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} gauge")
+                    seen.add(name)
+                lines.append(f"{name}{fmt(labels)} {value}")
+
+            for (name, labels), hist in sorted(
+                self.histograms.items(), key=lambda item: item[0]
+            ):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), hist.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"{name}_bucket{fmt(labels + (('le', le),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+                lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+_current: contextvars.ContextVar[CallRecord | None] = contextvars.ContextVar(
+    "qianfan_call_record", default=None
+)
+
+
+def get_registry() -> MetricsRegistry:
+    """Get the process-wide metrics registry"""
+    return _registry
+
+
+@contextlib.contextmanager
+def track(kind: str, target: str) -> tg.Iterator[CallRecord]:
+    """Measure one node call, inner layers annotate the yielded record"""
+    rec = CallRecord(kind=kind, target=target)
+    token = _current.set(rec)
+    start = time.perf_counter()
+    try:
+        yield rec
+    except Exception as e:
+        rec.error = repr(e)
+        raise
+    finally:
+        rec.latency = time.perf_counter() - start
+        _current.reset(token)
+        _registry.record(rec)
+
+
+def current_record() -> CallRecord | None:
+    """Get the record of the call being tracked, if any"""
+    return _current.get()
+
+
+def annotate(**fields: tg.Any) -> None:
+    """Set fields of the current call record, numeric fields accumulate"""
+    rec = _current.get()
+    if rec is None:
+        return
+
+    for name, value in fields.items():
+        old = getattr(rec, name)
+        if isinstance(old, (int, float)) and not isinstance(old, bool):
+            value = old + value
+        setattr(rec, name, value)
+
+
+def record_usage(resp: tg.Any) -> None:
+    """
+    Add token usage of a QianFan response or an AppBuilder message, once per
+    upstream call, so calls of sweeps and map-reduce add up
+    """
+    usage = getattr(resp, "token_usage", None)
+    if usage is None:
+        try:
+            usage = resp["usage"]
+        except Exception:
+            usage = None
+    if not usage:
+        return
+
+    rec = _current.get()
+    if rec is None:
+        return
+    rec.prompt_tokens += int(usage.get("prompt_tokens", 0) or 0)
+    rec.completion_tokens += int(usage.get("completion_tokens", 0) or 0)
+
+
+def _register_endpoint() -> None:
+    """Serve metrics at /qianfan/metrics on the ComfyUI server if enabled"""
+    reload_config()
+    if not QIANFAN_CONFIG.get("metrics_endpoint", False):
+        return
+
+    try:
+        from aiohttp import web
+        from server import PromptServer
+    except ImportError:
+        return
+
+    instance = getattr(PromptServer, "instance", None)
+    if instance is None:
+        return
+
+    @instance.routes.get("/qianfan/metrics")
+    async def metrics_handler(request):
+        return web.Response(
+            text=_registry.render_prometheus(), content_type="text/plain"
+        )
+
+    logger.info("Serving QianFan metrics at /qianfan/metrics")
+
+
+_register_endpoint()
+
+__all__ = [
+    "CallRecord",
+    "MetricsRegistry",
+    "annotate",
+    "current_record",
+    "get_registry",
+    "record_usage",
+    "track",
+]
@@ -0,0 +1,193 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+cache_dir = pathlib.Path(__file__).parent / "cache"
+catalog_path = cache_dir / "model_catalog.json"
+
+DEFAULT_TTL = 24 * 60 * 60
+
+# seconds before retrying a failed refresh, doubled on every further failure up to the TTL
+RETRY_DELAY = 30.0
+
+_disk_lock = threading.Lock()
+
+
+def _get_ttl() -> float:
+    """Get catalog TTL in seconds from config"""
+    reload_config()
+    return float(QIANFAN_CONFIG.get("model_catalog_ttl", DEFAULT_TTL))
+
+
+def _read_disk() -> dict[str, dict]:
+    """Read all catalogs from disk cache"""
+    try:
+        with open(catalog_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Failed to read model catalog cache, reason: {repr(e)}")
+        return {}
+
+    return data if isinstance(data, dict) else {}
+
+
+def _write_disk(name: str, models: list[str], timestamp: float) -> None:
+    """Write one catalog into disk cache, atomically replacing the file"""
+    with _disk_lock:
+        data = _read_disk()
+        data[name] = {"timestamp": timestamp, "models": models}
+
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = catalog_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(
+                json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8"
+            )
+            os.replace(tmp_path, catalog_path)
+        except Exception as e:
+            logger.warning(f"Failed to write model catalog cache, reason: {repr(e)}")
+
+
+class ModelCatalog:
+    """
+    Model list with in-memory cache, on-disk JSON cache with TTL and
+    stale-while-revalidate background refresh. A failed refresh is retried
+    after an exponential delay, capped at the TTL.
+
+    `get` never blocks on the network: it returns the cached list (fresh or stale)
+    or the fallback list, and refreshes in a background thread when needed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: tg.Callable[[], list[str]],
+        fallback: list[str],
+    ):
+        self.name = name
+        self.fetch = fetch
+        self.fallback = list(fallback)
+
+        self._lock = threading.Lock()
+        self._models: list[str] | None = None
+        self._timestamp = 0.0
+        self._refreshing = False
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def get(self) -> list[str]:
+        """Get model list, trigger a background refresh if missing or expired"""
+        with self._lock:
+            if self._models is None:
+                entry = _read_disk().get(self.name)
+                if entry and entry.get("models"):
+                    self._models = list(entry["models"])
+                    self._timestamp = float(entry.get("timestamp", 0.0))
+
+            models = self._models
+            now = time.time()
+            expired = now - self._timestamp > _get_ttl()
+            due = now >= self._retry_at
+
+        if (models is None or expired) and due:
+            self.refresh_async()
+
+        return list(models) if models is not None else list(self.fallback)
+
+    def refresh_async(self) -> None:
+        """Start a background refresh unless one is already running"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(
+            target=self.refresh,
+            name=f"model-catalog-{self.name}",
+            daemon=True,
+        ).start()
+
+    def refresh(self) -> list[str] | None:
+        """Fetch model list synchronously and update caches, None on failure"""
+        try:
+            models = list(self.fetch())
+        except Exception as e:
+            logger.warning(
+                f"Failed to refresh model list {self.name}, reason: {repr(e)}"
+            )
+            models = None
+
+        timestamp = time.time()
+        # the retry time is set before another refresh can start
+        with self._lock:
+            self._refreshing = False
+            if not models:
+                self._failures += 1
+                delay = min(_get_ttl(), RETRY_DELAY * 2 ** (self._failures - 1))
+                self._retry_at = timestamp + delay
+            else:
+                self._models = models
+                self._timestamp = timestamp
+                self._failures = 0
+                self._retry_at = 0.0
+
+        if not models:
+            logger.debug(f"Retrying model list {self.name} refresh in {delay:.0f}s")
+            return None
+
+        _write_disk(self.name, models, timestamp)
+        logger.debug(f"Refreshed model list {self.name}: {len(models)} models")
+        return models
+
+
+_catalogs: dict[str, ModelCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(
+    name: str,
+    fetch: tg.Callable[[], list[str]],
+    fallback: list[str],
+) -> ModelCatalog:
+    """Get or create the shared catalog registered under `name`"""
+    with _catalogs_lock:
+        if name not in _catalogs:
+            _catalogs[name] = ModelCatalog(name, fetch, fallback)
+        return _catalogs[name]
+
+
+__all__ = ["ModelCatalog", "get_catalog"]
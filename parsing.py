@@ -0,0 +1,144 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import marshal
+import threading
+import typing as tg
+
+import yaml
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# libyaml bindings are much faster, fall back to pure python if PyYAML was built without
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+DEFAULT_PARSE_CACHE_SIZE = 256
+
+
+def _copy(value: tg.Any) -> tg.Any:
+    """Copy lists and dicts of parsed data"""
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    return value
+
+
+def _freeze(value: tg.Any) -> bytes | None:
+    """
+    Marshal a parsed value, it thaws into a fresh copy faster than copying.
+    None if it holds non-json types, e.g. yaml timestamps
+    """
+    try:
+        return marshal.dumps(value)
+    except ValueError:
+        return None
+
+
+def _parse(text: str) -> tg.Any:
+    """Parse yaml, json input goes through the json parser first"""
+    if text.lstrip()[:1] in ("[", "{"):
+        try:
+            return json.loads(text)
+        except ValueError:
+            # yaml flow style, e.g. unquoted keys
+            pass
+    return yaml.load(text, Loader=Loader)
+
+
+class ParseCache:
+    """
+    Parsed yaml / json inputs in a bounded LRU, so IS_CHANGED, VALIDATE_INPUTS
+    and execution of a node share one parse.
+
+    Entries are keyed by the text itself: str hashes are computed once per
+    object and several times cheaper than a digest, equal texts from different
+    prompts compare by content.
+    """
+
+    def __init__(self):
+        self._entries: collections.OrderedDict[
+            str, tuple[tg.Any, bytes | None]
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, text: str, copy: bool = True) -> tg.Any:
+        """
+        Parse `text`. The result is a copy the caller may modify, unless `copy`
+        is False, then it is shared with other callers and must not be modified.
+        """
+        with self._lock:
+            entry = self._entries.get(text)
+            if entry is not None:
+                self._entries.move_to_end(text)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is None:
+            value = _parse(text)
+            entry = (value, _freeze(value))
+
+            reload_config()
+            max_size = int(
+                QIANFAN_CONFIG.get("parse_cache_size", DEFAULT_PARSE_CACHE_SIZE)
+            )
+            with self._lock:
+                self._entries[text] = entry
+                while len(self._entries) > max_size:
+                    self._entries.popitem(last=False)
+
+        value, frozen = entry
+        if not copy:
+            return value
+        return _copy(value) if frozen is None else marshal.loads(frozen)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Get entry count and hit / miss counters"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_cache = ParseCache()
+
+
+def get_parse_cache() -> ParseCache:
+    """Get the process-wide parse cache"""
+    return _cache
+
+
+def load_text(text: str, copy: bool = True) -> tg.Any:
+    """Parse a yaml or json input through the process-wide parse cache"""
+    return _cache.load(text, copy)
+
+
+def dump_yaml(value: tg.Any) -> str:
+    """Serialize into yaml with the fastest available dumper"""
+    return yaml.dump(value, Dumper=Dumper, allow_unicode=True)
+
+
+__all__ = ["Dumper", "Loader", "ParseCache", "dump_yaml", "get_parse_cache", "load_text"]
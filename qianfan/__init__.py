@@ -12,15 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
-import os
+import types
 import typing as tg
 
-import qianfan
-import qianfan.resources
-import yaml
-
+from ..aio import map_concurrent, run
+from ..broker import brokered
+from ..clients import get_client
 from ..config import QIANFAN_CONFIG, reload_config
+from ..credentials import Credential, get_pool
+from ..dispatch import broadcast, first
+from ..failover import fallback_chain, run_chain
+from ..metrics import annotate, record_usage, track
+from ..model_catalog import get_catalog
+from ..parsing import load_text
+from ..rate_limit import arate_limited
+from ..response_cache import acached_call, make_key
+from ..streaming import astream_text
+from ..tokens import history_budget, messages_tokens, trim_messages
+from .history import HISTORY_TYPE, History, HistoryFromText, HistoryToText
+from .sessions import SessionHistory, get_session_store
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -34,15 +46,212 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def set_env():
-    """Set environment vars"""
-    reload_config()
+def sdk() -> types.ModuleType:
+    """Import qianfan SDK on first use, so registering nodes stays light"""
+    import qianfan
+
+    return qianfan
+
+
+DEFAULT_MODEL_LIST = [
+    "ERNIE-4.0-8K",
+    "ERNIE-3.5-8K",
+    "ERNIE-Speed-8K",
+    "ERNIE-Speed-128K",
+    "ERNIE-Lite-8K",
+    "ERNIE-Tiny-8K",
+]
+
+
+def _target(model: str, endpoint: str | None) -> dict[str, str]:
+    """Get SDK keyword args that select the model or endpoint"""
+    match model:
+        case "DEFAULT":
+            return {}
+        case "ENDPOINT":
+            return {"endpoint": endpoint}
+        case _:
+            return {"model": model}
+
+
+def _target_name(target: dict[str, str]) -> str:
+    """Get rate limit key of the target model or endpoint"""
+    return target.get("endpoint") or target.get("model") or "DEFAULT"
+
+
+def _parse_target(name: str) -> dict[str, str]:
+    """Get SDK keyword args of a fallback entry, `endpoint:<name>` for custom endpoints"""
+    if name.startswith("endpoint:"):
+        return {"endpoint": name.removeprefix("endpoint:")}
+    return _target(name, None)
+
+
+def _fallback_targets(target: dict[str, str]) -> dict[str, dict[str, str]]:
+    """Get the target followed by its fallbacks from config.yaml, by rate limit key"""
+    targets = {_target_name(target): target}
+    for name in fallback_chain(_target_name(target))[1:]:
+        fallback = _parse_target(name)
+        targets.setdefault(_target_name(fallback), fallback)
+    return targets
+
+
+def _get_resource(name: str, target: dict[str, str], cred: Credential) -> tg.Any:
+    """Get a shared SDK resource client, e.g. ChatCompletion, for the target and credential set"""
+    return get_client(
+        f"qianfan.{name}@{cred.name}",
+        tuple(sorted(target.items())),
+        lambda: getattr(sdk(), name)(
+            access_key=cred.iam_ak, secret_key=cred.iam_sk, **target
+        ),
+        (cred.iam_ak, cred.iam_sk),
+    )
+
+
+def _load_turn(
+    messages_yaml: str,
+    history_yaml: str | None,
+    history: History | None = None,
+) -> tuple[History, list[dict]]:
+    """Parse current messages and get the history they follow, native history first"""
+    messages: list[dict] = load_text(messages_yaml)
+    if history is None:
+        history = History.from_text(history_yaml) if history_yaml else History()
+    return history, messages
+
+
+async def _stream_results(
+    chunks: tg.Awaitable[tg.AsyncIterable[tg.Any]],
+) -> tg.AsyncIterator[str]:
+    """Yield result text of streamed chunks, recording token usage of the stream"""
+    last = None
+    async for chunk in await chunks:
+        last = chunk
+        yield chunk["result"]
+    # usage of a chunk counts the whole stream so far
+    if last is not None:
+        record_usage(last)
+
+
+def _fetch_models(api_type: str) -> list[str]:
+    """
+    Fetch preset model services of `api_type` with a credential set of the pool.
+    `Resource.models()` lists them with the global SDK keys and silently falls
+    back to a built-in list, so the service list is requested directly.
+    """
+    pool = get_pool()
+    cred = pool.acquire("qianfan")
+    try:
+        resp = sdk().resources.Service.list(
+            api_type_filter=[api_type], ak=cred.iam_ak, sk=cred.iam_sk
+        )
+    finally:
+        pool.release(cred)
+
+    return sorted(
+        service["name"]
+        for service in resp["result"]["common"]
+        if service.get("apiType", api_type) == api_type
+    )
+
+
+def get_chat_models() -> list[str]:
+    """Get ChatCompletion model list, served from cache without blocking"""
+    return get_catalog(
+        "qianfan:chat", lambda: _fetch_models("chat"), DEFAULT_MODEL_LIST
+    ).get()
+
+
+def get_completion_models() -> list[str]:
+    """Get Completion model list, served from cache without blocking"""
+    return get_catalog(
+        "qianfan:completion", lambda: _fetch_models("completions"), DEFAULT_MODEL_LIST
+    ).get()
 
-    os.environ["QIANFAN_ACCESS_KEY"] = QIANFAN_CONFIG.get("iam_ak")
-    os.environ["QIANFAN_SECRET_KEY"] = QIANFAN_CONFIG.get("iam_sk")
 
+@brokered("chat")
+async def _chat(
+    *,
+    target: dict[str, str],
+    messages: list[dict],
+    use_cache: bool = False,
+    stream: bool = False,
+    unique_id: str | None = None,
+) -> str:
+    """Get the reply to `messages`, trying fallbacks of the target"""
 
-set_env()
+    async def attempt(target: dict[str, str]) -> str:
+        text = "".join(str(m.get("content", "")) for m in messages)
+
+        if stream:
+            return await arate_limited(
+                _target_name(target),
+                lambda cred: astream_text(
+                    lambda: _stream_results(
+                        _get_resource("ChatCompletion", target, cred).ado(
+                            messages=messages, stream=True, **target
+                        )
+                    ),
+                    unique_id,
+                ),
+                text,
+            )
+
+        resp = await arate_limited(
+            _target_name(target),
+            lambda cred: _get_resource("ChatCompletion", target, cred).ado(
+                messages=messages, **target
+            ),
+            text,
+        )
+        record_usage(resp)
+        return resp["result"]
+
+    async def call() -> tuple[str]:
+        targets = _fallback_targets(target)
+        # a hedged stream would send two interleaved previews
+        res: str = await run_chain(
+            list(targets), lambda name: attempt(targets[name]), hedge=not stream
+        )
+        return (res,)
+
+    key = make_key("chat", target=target, messages=messages)
+    # earlier turns must match exactly, only the last message may be a near duplicate
+    similar = (
+        (
+            make_key("chat", target=target, history=messages[:-1]),
+            str(messages[-1].get("content", "")) if messages else "",
+        )
+        if use_cache
+        else None
+    )
+    return (await acached_call(key, call, use_cache, similar))[0]
+
+
+@brokered("completion")
+async def _completion(
+    *, target: dict[str, str], prompt: str, use_cache: bool = False
+) -> str:
+    """Get the completion of `prompt`, trying fallbacks of the target"""
+
+    async def attempt(target: dict[str, str]) -> str:
+        resp = await arate_limited(
+            _target_name(target),
+            lambda cred: _get_resource("Completion", target, cred).ado(
+                prompt=prompt, **target
+            ),
+            prompt,
+        )
+        record_usage(resp)
+        return resp["result"]
+
+    async def call() -> tuple[str]:
+        targets = _fallback_targets(target)
+        res: str = await run_chain(list(targets), lambda name: attempt(targets[name]))
+        return (res,)
+
+    key = make_key("completion", target=target, prompt=prompt)
+    similar = (make_key("completion", target=target), prompt)
+    return (await acached_call(key, call, use_cache, similar))[0]
 
 
 class Chat:
@@ -98,7 +307,7 @@ class Chat:
                 "model": (
                     [
                         "DEFAULT",
-                        *sorted(qianfan.ChatCompletion.models()),
+                        *get_chat_models(),
                         "ENDPOINT",
                     ],
                 ),
@@ -128,11 +337,55 @@ class Chat:
   content: 好的，我会帮助你的，请告诉我你需要怎样的场景。""",
                     },
                 ),
+                "history": (HISTORY_TYPE,),
+                "use_cache": ("BOOLEAN", {"default": False}),
+                "stream": ("BOOLEAN", {"default": False}),
+                "session_id": ("STRING", {"default": ""}),
+                "yaml_output": ("BOOLEAN", {"default": False}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
             },
         }
 
     # INPUT_IS_LIST = True
 
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: str,
+        messages_yaml: str,
+        endpoint: str | None = None,
+        history_yaml: str | None = None,
+        history: History | None = None,
+        use_cache: bool = False,
+        stream: bool = False,
+        unique_id: str | None = None,
+        session_id: str = "",
+        yaml_output: bool = False,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of parsed inputs"""
+        try:
+            # a stored session changes with every turn, count turns instead of loading it
+            turns = get_session_store().turns(session_id) if session_id else 0
+            if turns:
+                return make_key(
+                    "chat",
+                    target=_target(model, endpoint),
+                    session=session_id,
+                    turns=turns,
+                    messages=load_text(messages_yaml, copy=False),
+                )
+            prev, messages = _load_turn(messages_yaml, history_yaml, history)
+        except Exception:
+            return make_key("chat", raw=[messages_yaml, history_yaml, session_id])
+
+        return make_key(
+            "chat",
+            target=_target(model, endpoint),
+            messages=prev.to_list() + messages,
+        )
+
     @classmethod
     def VALIDATE_INPUTS(
         s,
@@ -146,21 +399,21 @@ class Chat:
             return "endpoint model requires an endpoint"
 
         try:
-            _ = yaml.safe_load(messages_yaml)
+            _ = load_text(messages_yaml, copy=False)
         except Exception as e:
             return f"error parsing messages_yaml: {repr(e)}"
 
         if history_yaml:
             try:
-                _ = yaml.safe_load(history_yaml)
+                _ = load_text(history_yaml, copy=False)
             except Exception as e:
                 return f"error parsing history_yaml: {repr(e)}"
 
         return True
 
-    RETURN_TYPES = ("STRING", "STRING")
+    RETURN_TYPES = ("STRING", "STRING", HISTORY_TYPE, "STRING")
 
-    RETURN_NAMES = ("result", "history_yaml")
+    RETURN_NAMES = ("result", "history_yaml", "history", "stats")
     # OUTPUT_IS_LIST = (True, )
 
     FUNCTION = "chat"
@@ -169,39 +422,265 @@ class Chat:
 
     CATEGORY = "QianFan"
 
-    def chat(
+    def chat(self, **kwargs: tg.Any) -> tuple[str, str, History, str]:
+        """Execute chat model, blocking until `achat` finishes on the event loop"""
+        return run(self.achat(**kwargs))
+
+    async def achat(
         self,
         model: str,
         messages_yaml: str,
         endpoint: str | None,
         history_yaml: str | None,
-    ) -> tuple[str]:
-        """Execute appbuilder playground model"""
-        set_env()
+        history: History | None = None,
+        use_cache: bool = False,
+        stream: bool = False,
+        unique_id: str | None = None,
+        session_id: str = "",
+        yaml_output: bool = False,
+    ) -> tuple[str, str, History, str]:
+        """
+        Execute chat model, continuing the stored session `session_id` if given.
+        The history is only dumped to `history_yaml` with `yaml_output`, chained
+        nodes and sessions pass it on as History without serializing it.
+        """
+        store = get_session_store() if session_id else None
+        # SQLite reads and writes stay off the event loop shared by all nodes
+        stored = await asyncio.to_thread(store.load, session_id) if store else History()
+        prev, new_messages = _load_turn(
+            messages_yaml, history_yaml, stored if len(stored) else history
+        )
+        messages = prev.to_list() + new_messages
+        target = _target(model, endpoint)
 
-        chat_comp = qianfan.ChatCompletion()
+        with track("chat", _target_name(target)) as rec:
+            res: str = await _chat(
+                target=target,
+                messages=messages,
+                use_cache=use_cache,
+                stream=stream,
+                unique_id=unique_id,
+            )
 
-        messages: list[dict] = yaml.safe_load(messages_yaml)
-        if history_yaml:
-            history: list[dict] = yaml.safe_load(history_yaml)
-            messages = history + messages
-
-        match model:
-            case "DEFAULT":
-                resp = chat_comp.do(messages=messages)
-            case "ENDPOINT":
-                resp = chat_comp.do(endpoint=endpoint, messages=messages)
-            case _:
-                resp = chat_comp.do(model=model, messages=messages)
+        turn = [*new_messages, {"role": "assistant", "content": res}]
+        if store is None:
+            new_history = prev.extend(turn)
+        else:
+            # a new session starts from the history inputs
+            new_history = await asyncio.to_thread(
+                store.append,
+                session_id,
+                turn if len(stored) else prev.to_list() + turn,
+            )
+
+        history_text = new_history.to_yaml() if yaml_output else ""
+        return (res, history_text, new_history, rec.to_json())
 
-        res: str = resp["result"]
 
-        new_history = messages + [{"role": "assistant", "content": res}]
+DEFAULT_MAX_IN_FLIGHT = 8
+
+
+class ChatBatch(Chat):
+    """
+    QianFan Chat Node, batch mode
+    Accepts lists of inputs and sends them concurrently, at most `max_in_flight` at once.
+    Outputs keep the input order, a failed item outputs empty strings and its error.
+    """
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        input_types = super().INPUT_TYPES()
+        input_types["optional"].pop("history")
+        input_types["optional"].pop("stream")
+        # history_yaml is the only history output of a batch
+        input_types["optional"].pop("yaml_output")
+        # turns of one session follow each other, they cannot be sent concurrently
+        input_types["optional"].pop("session_id")
+        input_types.pop("hidden")
+        input_types["optional"]["max_in_flight"] = (
+            "INT",
+            {"default": DEFAULT_MAX_IN_FLIGHT, "min": 1, "max": 256},
+        )
+        return input_types
+
+    INPUT_IS_LIST = True
+
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: list[str],
+        messages_yaml: list[str],
+        endpoint: list[str] | None = None,
+        history_yaml: list[str] | None = None,
+        use_cache: list[bool] | None = None,
+        max_in_flight: list[int] | None = None,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of parsed inputs"""
+        items = broadcast(
+            model=model,
+            messages_yaml=messages_yaml,
+            endpoint=endpoint,
+            history_yaml=history_yaml,
+        )
+        return make_key("chat_batch", items=[Chat.IS_CHANGED(**kw) for kw in items])
+
+    @classmethod
+    def VALIDATE_INPUTS(
+        s,
+        model: list[str],
+        messages_yaml: list[str],
+        endpoint: list[str] | None = None,
+        history_yaml: list[str] | None = None,
+    ) -> tg.Literal[True] | str:
+        """self defined validation function"""
+        items = broadcast(
+            model=model,
+            messages_yaml=messages_yaml,
+            endpoint=endpoint,
+            history_yaml=history_yaml,
+        )
+        for i, kw in enumerate(items):
+            res = Chat.VALIDATE_INPUTS(**kw)
+            if res is not True:
+                return f"item {i}: {res}"
+
+        return True
+
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+
+    RETURN_NAMES = ("result", "history_yaml", "error")
+    OUTPUT_IS_LIST = (True, True, True)
+
+    FUNCTION = "chat_batch"
+
+    def chat_batch(
+        self,
+        model: list[str],
+        messages_yaml: list[str],
+        endpoint: list[str] | None = None,
+        history_yaml: list[str] | None = None,
+        use_cache: list[bool] | None = None,
+        max_in_flight: list[int] | None = None,
+    ) -> tuple[list[str], list[str], list[str]]:
+        """Execute chat model over every item of the input lists"""
+        items = broadcast(
+            model=model,
+            messages_yaml=messages_yaml,
+            endpoint=endpoint,
+            history_yaml=history_yaml,
+            use_cache=use_cache,
+        )
+        results = run(
+            map_concurrent(
+                lambda kw: self.achat(**kw, yaml_output=True),
+                items,
+                first(max_in_flight, DEFAULT_MAX_IN_FLIGHT),
+            )
+        )
 
         return (
-            res,
-            yaml.safe_dump(new_history, allow_unicode=True),
+            [r.value[0] if r.ok else "" for r in results],
+            [r.value[1] if r.ok else "" for r in results],
+            ["" if r.ok else repr(r.error) for r in results],
+        )
+
+
+SUMMARY_MAX_TOKENS = 256
+
+SUMMARY_PROMPT = "请用不超过300字简要总结以下对话的要点，保留关键事实和结论：\n\n"
+
+
+@brokered("history_summary")
+async def _summarize(*, target: dict[str, str], messages: list[dict]) -> str:
+    """Summarize dropped messages with a chat model, cached by content hash"""
+    dialog = "\n".join(f"{m.get('role')}: {m.get('content')}" for m in messages)
+
+    async def call() -> tuple[str]:
+        resp = await arate_limited(
+            _target_name(target),
+            lambda cred: _get_resource("ChatCompletion", target, cred).ado(
+                messages=[{"role": "user", "content": SUMMARY_PROMPT + dialog}],
+                **target,
+            ),
+            dialog,
         )
+        return (resp["result"],)
+
+    key = make_key("history_summary", target=target, messages=messages)
+    return (await acached_call(key, call, True))[0]
+
+
+class HistoryTrim:
+    """
+    QianFan History Trim Node
+    Fit a QIANFAN_HISTORY into a token budget by dropping the oldest turns,
+    optionally replacing them with a summary generated by the chat model.
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "history": (HISTORY_TYPE,),
+                "model": (["DEFAULT", *get_chat_models()],),
+                "mode": (["truncate", "summarize"],),
+                "max_tokens": (
+                    "INT",
+                    {"default": 0, "min": 0, "max": 1024 * 1024},
+                ),
+            },
+        }
+
+    RETURN_TYPES = (HISTORY_TYPE, "INT")
+
+    RETURN_NAMES = ("history", "tokens_saved")
+
+    FUNCTION = "trim"
+
+    CATEGORY = "QianFan"
+
+    def trim(
+        self,
+        history: History,
+        model: str,
+        mode: str,
+        max_tokens: int,
+    ) -> tuple[History, int]:
+        """Trim history to `max_tokens`, or the model context budget if 0"""
+        budget = max_tokens or history_budget(model)
+        messages = history.to_list()
+        before = messages_tokens(messages)
+        if before <= budget:
+            return (history, 0)
+
+        match mode:
+            case "summarize":
+                kept, dropped = trim_messages(
+                    messages, max(0, budget - SUMMARY_MAX_TOKENS)
+                )
+                if dropped:
+                    summary = run(_summarize(target=_target(model, None), messages=dropped))
+                    kept = [
+                        {"role": "user", "content": f"以下是之前对话的摘要：{summary}"},
+                        {"role": "assistant", "content": "好的，我已了解之前的对话。"},
+                        *kept,
+                    ]
+            case _:
+                kept, _ = trim_messages(messages, budget)
+
+        saved = before - messages_tokens(kept)
+        logger.info(f"History trimmed to {len(kept)} messages, {saved} tokens saved")
+
+        return (History(kept), saved)
 
 
 class Completion:
@@ -257,7 +736,7 @@ class Completion:
                 "model": (
                     [
                         "DEFAULT",
-                        *sorted(qianfan.Completion.models()),
+                        *get_completion_models(),
                         "ENDPOINT",
                     ],
                 ),
@@ -276,11 +755,23 @@ class Completion:
                         "default": "",
                     },
                 ),
+                "use_cache": ("BOOLEAN", {"default": False}),
             },
         }
 
     # INPUT_IS_LIST = True
 
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: str,
+        prompt: str,
+        endpoint: str | None = None,
+        use_cache: bool = False,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of parsed inputs"""
+        return make_key("completion", target=_target(model, endpoint), prompt=prompt)
+
     @classmethod
     def VALIDATE_INPUTS(
         s,
@@ -294,9 +785,9 @@ class Completion:
 
         return True
 
-    RETURN_TYPES = ("STRING",)
+    RETURN_TYPES = ("STRING", "STRING")
 
-    RETURN_NAMES = ("result",)
+    RETURN_NAMES = ("result", "stats")
     # OUTPUT_IS_LIST = (True, )
 
     FUNCTION = "completion"
@@ -305,38 +796,316 @@ class Completion:
 
     CATEGORY = "QianFan"
 
-    def completion(
+    def completion(self, **kwargs: tg.Any) -> tuple[str, str]:
+        """Execute completion model, blocking until `acompletion` finishes on the event loop"""
+        return run(self.acompletion(**kwargs))
+
+    async def acompletion(
         self,
         model: str,
         prompt: str,
         endpoint: str | None,
-    ) -> tuple[str]:
-        """Execute appbuilder playground model"""
-        set_env()
+        use_cache: bool = False,
+    ) -> tuple[str, str]:
+        """Execute completion model"""
+        target = _target(model, endpoint)
+        with track("completion", _target_name(target)) as rec:
+            res: str = await _completion(
+                target=target, prompt=prompt, use_cache=use_cache
+            )
 
-        comp = qianfan.Completion()
+        return (res, rec.to_json())
 
-        match model:
-            case "DEFAULT":
-                resp = comp.do(prompt=prompt)
-            case "ENDPOINT":
-                resp = comp.do(endpoint=endpoint, prompt=prompt)
-            case _:
-                resp = comp.do(model=model, prompt=prompt)
 
-        res: str = resp["result"]
+class CompletionBatch(Completion):
+    """
+    QianFan Completion Node, batch mode
+    Accepts lists of inputs and sends them concurrently, at most `max_in_flight` at once.
+    Outputs keep the input order, a failed item outputs an empty string and its error.
+    """
 
-        return (res,)
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        input_types = super().INPUT_TYPES()
+        input_types["optional"]["max_in_flight"] = (
+            "INT",
+            {"default": DEFAULT_MAX_IN_FLIGHT, "min": 1, "max": 256},
+        )
+        return input_types
+
+    INPUT_IS_LIST = True
+
+    @classmethod
+    def IS_CHANGED(
+        s,
+        model: list[str],
+        prompt: list[str],
+        endpoint: list[str] | None = None,
+        use_cache: list[bool] | None = None,
+        max_in_flight: list[int] | None = None,
+    ) -> tg.Hashable:
+        """self defined input change detection function, hash of parsed inputs"""
+        items = broadcast(model=model, prompt=prompt, endpoint=endpoint)
+        return make_key(
+            "completion_batch", items=[Completion.IS_CHANGED(**kw) for kw in items]
+        )
+
+    @classmethod
+    def VALIDATE_INPUTS(
+        s,
+        model: list[str],
+        prompt: list[str],
+        endpoint: list[str] | None = None,
+    ) -> tg.Literal[True] | str:
+        """self defined validation function"""
+        items = broadcast(model=model, prompt=prompt, endpoint=endpoint)
+        for i, kw in enumerate(items):
+            res = Completion.VALIDATE_INPUTS(**kw)
+            if res is not True:
+                return f"item {i}: {res}"
+
+        return True
+
+    RETURN_TYPES = ("STRING", "STRING")
+
+    RETURN_NAMES = ("result", "error")
+    OUTPUT_IS_LIST = (True, True)
+
+    FUNCTION = "completion_batch"
+
+    def completion_batch(
+        self,
+        model: list[str],
+        prompt: list[str],
+        endpoint: list[str] | None = None,
+        use_cache: list[bool] | None = None,
+        max_in_flight: list[int] | None = None,
+    ) -> tuple[list[str], list[str]]:
+        """Execute completion model over every item of the input lists"""
+        items = broadcast(
+            model=model, prompt=prompt, endpoint=endpoint, use_cache=use_cache
+        )
+        results = run(
+            map_concurrent(
+                lambda kw: self.acompletion(**kw),
+                items,
+                first(max_in_flight, DEFAULT_MAX_IN_FLIGHT),
+            )
+        )
+
+        return (
+            [r.value[0] if r.ok else "" for r in results],
+            ["" if r.ok else repr(r.error) for r in results],
+        )
+
+
+EMBEDDING_TYPE = "QIANFAN_EMBEDDING"
+
+DEFAULT_EMBEDDING_MODEL_LIST = ["Embedding-V1", "bge-large-zh", "bge-large-en", "tao-8k"]
+
+# texts per request accepted by the API
+EMBEDDING_BATCH_SIZES = {"tao-8k": 1}
+DEFAULT_EMBEDDING_BATCH_SIZE = 16
+
+
+def get_embedding_models() -> list[str]:
+    """Get Embedding model list, served from cache without blocking"""
+    return get_catalog(
+        "qianfan:embedding",
+        lambda: _fetch_models("embeddings"),
+        DEFAULT_EMBEDDING_MODEL_LIST,
+    ).get()
+
+
+def _embedding_batch_size(target: dict[str, str]) -> int:
+    """Get texts per request, from `embedding_batch_size` in config.yaml or the API limits"""
+    reload_config()
+    sizes: dict = QIANFAN_CONFIG.get("embedding_batch_size") or {}
+    name = _target_name(target)
+    if name in sizes:
+        return max(1, int(sizes[name]))
+    return EMBEDDING_BATCH_SIZES.get(target.get("model", ""), DEFAULT_EMBEDDING_BATCH_SIZE)
+
+
+async def _embed_batch(target: dict[str, str], texts: list[str]) -> tg.Any:
+    """Embed one request worth of texts into a float32 array"""
+    import numpy as np
+
+    resp = await arate_limited(
+        _target_name(target),
+        lambda cred: _get_resource("Embedding", target, cred).ado(texts=texts, **target),
+        "".join(texts),
+    )
+    record_usage(resp)
+    data = sorted(resp["data"], key=lambda d: d["index"])
+    return np.array([d["embedding"] for d in data], dtype=np.float32)
+
+
+async def aembed(
+    target: dict[str, str],
+    texts: list[str],
+    use_cache: bool = True,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+) -> tg.Any:
+    """
+    Embed `texts` into a contiguous float32 array of shape (len(texts), dim).
+    Texts are deduplicated and packed into batches of the maximum request size,
+    batches run concurrently. With `use_cache`, vectors are kept on disk per text.
+    """
+    import numpy as np
+
+    from ..embedding_store import get_store, text_digest
+
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    unique = list(dict.fromkeys(texts))
+    missing = list(range(len(unique)))
+    cached = None
+    # the store reads files and waits on a lock shared with other processes
+    store = None
+    if use_cache:
+        store = await asyncio.to_thread(get_store, _target_name(target))
+        digests = [text_digest(t) for t in unique]
+        rows = await asyncio.to_thread(store.lookup, digests)
+        hits = [i for i, row in enumerate(rows) if row is not None]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if hits:
+            vectors = await asyncio.to_thread(store.read, [rows[i] for i in hits])
+            cached = (hits, vectors)
+        if not missing:
+            annotate(cache_hit=True)
+
+    size = _embedding_batch_size(target)
+    batches = [missing[i : i + size] for i in range(0, len(missing), size)]
+    results = await map_concurrent(
+        lambda batch: _embed_batch(target, [unique[i] for i in batch]),
+        batches,
+        max_in_flight,
+    )
+
+    fresh = [(batch, r.value) for batch, r in zip(batches, results) if r.ok]
+    if store is not None:
+        for batch, vectors in fresh:
+            await asyncio.to_thread(store.add, [digests[i] for i in batch], vectors)
+    for r in results:
+        if not r.ok:
+            raise r.error
+
+    dim = (cached or fresh[0])[1].shape[1]
+    out = np.empty((len(unique), dim), dtype=np.float32)
+    if cached is not None:
+        out[cached[0]] = cached[1]
+    for batch, vectors in fresh:
+        out[batch] = vectors
+
+    if len(unique) == len(texts):
+        return out
+    position = {t: i for i, t in enumerate(unique)}
+    return out[[position[t] for t in texts]]
+
+
+class Embedding:
+    """
+    QianFan Embedding Node
+    SDK doc: https://cloud.baidu.com/doc/WENXINWORKSHOP/s/alj562vvu
+    Embeds a list of texts, e.g. the results of a batch node, into a float32
+    NumPy array of shape (len(texts), dim), row i embedding text i.
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "model": (["DEFAULT", *get_embedding_models(), "ENDPOINT"],),
+                "texts": (
+                    "STRING",
+                    {
+                        "multiline": True,
+                        "default": "春暖花开\n秋高气爽",
+                    },
+                ),
+            },
+            "optional": {
+                "endpoint": ("STRING", {"default": ""}),
+                "one_per_line": ("BOOLEAN", {"default": True}),
+                "use_cache": ("BOOLEAN", {"default": True}),
+                "max_in_flight": (
+                    "INT",
+                    {"default": DEFAULT_MAX_IN_FLIGHT, "min": 1, "max": 256},
+                ),
+            },
+        }
+
+    INPUT_IS_LIST = True
+
+    RETURN_TYPES = (EMBEDDING_TYPE, "STRING")
+    RETURN_NAMES = ("embeddings", "stats")
+
+    FUNCTION = "embed"
+
+    CATEGORY = "QianFan"
+
+    def embed(self, **kwargs: tg.Any) -> tuple[tg.Any, str]:
+        """Execute embedding model, blocking until `aembed` finishes on the event loop"""
+        return run(self.aembed(**kwargs))
+
+    async def aembed(
+        self,
+        model: list[str],
+        texts: list[str],
+        endpoint: list[str] | None = None,
+        one_per_line: list[bool] | None = None,
+        use_cache: list[bool] | None = None,
+        max_in_flight: list[int] | None = None,
+    ) -> tuple[tg.Any, str]:
+        """Execute embedding model, each non-empty line is a text if `one_per_line`"""
+        target = _target(first(model, "DEFAULT"), first(endpoint, ""))
+        if first(one_per_line, True):
+            texts = [line for text in texts for line in text.splitlines() if line.strip()]
+
+        with track("embedding", _target_name(target)) as rec:
+            vectors = await aembed(
+                target,
+                texts,
+                first(use_cache, True),
+                first(max_in_flight, DEFAULT_MAX_IN_FLIGHT),
+            )
+
+        return (vectors, rec.to_json())
 
 
 _NODE_CLASS_MAPPINGS = {
     "QianFan Chat": Chat,
     "QianFan Completion": Completion,
+    "QianFan Chat Batch": ChatBatch,
+    "QianFan Completion Batch": CompletionBatch,
+    "QianFan History From Text": HistoryFromText,
+    "QianFan History To Text": HistoryToText,
+    "QianFan History Trim": HistoryTrim,
+    "QianFan Embedding": Embedding,
+    "QianFan Session History": SessionHistory,
 }
 
 _NODE_DISPLAY_NAME_MAPPINGS = {
     "QianFan Chat": "QianFan Chat",
     "QianFan Completion": "QianFan Completion",
+    "QianFan Chat Batch": "QianFan Chat (Batch)",
+    "QianFan Completion Batch": "QianFan Completion (Batch)",
+    "QianFan History From Text": "QianFan History From YAML/JSON",
+    "QianFan History To Text": "QianFan History To YAML/JSON",
+    "QianFan History Trim": "QianFan History Trim",
+    "QianFan Embedding": "QianFan Embedding",
+    "QianFan Session History": "QianFan Session History",
 }
 
 __all__ = ["_NODE_CLASS_MAPPINGS", "_NODE_DISPLAY_NAME_MAPPINGS"]
@@ -0,0 +1,173 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import typing as tg
+
+from ..parsing import dump_yaml, load_text
+
+# ComfyUI type name of History values
+HISTORY_TYPE = "QIANFAN_HISTORY"
+
+
+class History:
+    """
+    Immutable chat history passed between nodes without serialization.
+
+    Each History holds the messages of one turn and a pointer to the previous
+    History, so appending a turn is O(1) and shares all earlier messages.
+    """
+
+    __slots__ = ("parent", "messages", "length")
+
+    def __init__(
+        self,
+        messages: tg.Iterable[dict] = (),
+        parent: "History | None" = None,
+    ):
+        self.parent = parent
+        self.messages: tuple[dict, ...] = tuple(dict(m) for m in messages)
+        self.length: int = (parent.length if parent else 0) + len(self.messages)
+
+    def extend(self, messages: tg.Iterable[dict]) -> "History":
+        """Return a new History with `messages` appended"""
+        messages = tuple(messages)
+        if not messages:
+            return self
+        return History(messages, self)
+
+    def to_list(self) -> list[dict]:
+        """Flatten into a new list of message dicts, oldest first"""
+        segments: list[tuple[dict, ...]] = []
+        node: History | None = self
+        while node is not None:
+            segments.append(node.messages)
+            node = node.parent
+
+        return [dict(m) for segment in reversed(segments) for m in segment]
+
+    def to_yaml(self) -> str:
+        """Serialize into the same yaml format as `history_yaml`"""
+        return dump_yaml(self.to_list())
+
+    def to_json(self) -> str:
+        """Serialize into a json list of messages"""
+        return json.dumps(self.to_list(), ensure_ascii=False, indent=2)
+
+    @classmethod
+    def from_text(cls, text: str) -> "History":
+        """Parse a yaml or json list of messages"""
+        # History copies each message itself
+        messages = load_text(text, copy=False) or []
+        if not isinstance(messages, list):
+            raise ValueError("history must be a list of messages")
+        return cls(messages)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> tg.Iterator[dict]:
+        return iter(self.to_list())
+
+    def __repr__(self) -> str:
+        return f"History({self.length} messages)"
+
+
+class HistoryFromText:
+    """
+    Convert a yaml / json message list into QIANFAN_HISTORY
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "history_text": (
+                    "STRING",
+                    {
+                        "multiline": True,
+                        "default": r"""- role: user
+  content: 你是一名幻想家，请帮助我想象一个场景，并描述这个场景。
+- role: assistant
+  content: 好的，我会帮助你的，请告诉我你需要怎样的场景。""",
+                    },
+                ),
+            },
+        }
+
+    @classmethod
+    def VALIDATE_INPUTS(s, history_text: str) -> tg.Literal[True] | str:
+        """self defined validation function"""
+        try:
+            _ = History.from_text(history_text)
+        except Exception as e:
+            return f"error parsing history_text: {repr(e)}"
+
+        return True
+
+    RETURN_TYPES = (HISTORY_TYPE,)
+    RETURN_NAMES = ("history",)
+
+    FUNCTION = "convert"
+
+    CATEGORY = "QianFan"
+
+    def convert(self, history_text: str) -> tuple[History]:
+        """Parse text into History"""
+        return (History.from_text(history_text),)
+
+
+class HistoryToText:
+    """
+    Convert QIANFAN_HISTORY into a yaml / json message list
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "history": (HISTORY_TYPE,),
+                "format": (["yaml", "json"],),
+            },
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("history_text",)
+
+    FUNCTION = "convert"
+
+    CATEGORY = "QianFan"
+
+    def convert(self, history: History, format: str) -> tuple[str]:
+        """Serialize History into text"""
+        match format:
+            case "json":
+                return (history.to_json(),)
+            case _:
+                return (history.to_yaml(),)
+
+
+__all__ = ["HISTORY_TYPE", "History", "HistoryFromText", "HistoryToText"]
@@ -0,0 +1,211 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import logging
+import pathlib
+import sqlite3
+import threading
+import time
+import typing as tg
+
+from ..config import QIANFAN_CONFIG, reload_config
+from ..model_catalog import cache_dir
+from .history import HISTORY_TYPE, History
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+sqlite_path = cache_dir / "sessions.sqlite3"
+
+DEFAULT_CACHE_SIZE = 64
+
+
+class SessionStore:
+    """
+    Conversations kept as an append-only log of turns in SQLite (WAL mode), so
+    processes of a host can share sessions.
+
+    A turn is appended as one row, a session is read back into a History with
+    one node per turn. The histories of the `cache_size` most recently used
+    sessions stay in memory, and only turns appended since, e.g. by another
+    process, are read on their next use.
+    """
+
+    def __init__(
+        self, path: pathlib.Path | None = None, cache_size: int = DEFAULT_CACHE_SIZE
+    ):
+        self.path = path or sqlite_path
+        self.cache_size = cache_size
+        # session -> (history, seq of its last turn)
+        self._hot: collections.OrderedDict[str, tuple[History, int]] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(
+                str(self.path), check_same_thread=False, timeout=30
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # a commit may be lost on power failure, never corrupted
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns (session TEXT NOT NULL, "
+                "seq INTEGER NOT NULL, messages TEXT NOT NULL, created REAL NOT NULL, "
+                "PRIMARY KEY (session, seq)) WITHOUT ROWID"
+            )
+        return self._conn
+
+    def _last_seq(self, conn: sqlite3.Connection, session: str) -> int:
+        row = conn.execute(
+            "SELECT MAX(seq) FROM turns WHERE session = ?", (session,)
+        ).fetchone()
+        return row[0] or 0
+
+    def _sync(self, conn: sqlite3.Connection, session: str) -> tuple[History, int]:
+        """Get the history of `session` with turns appended since it was cached"""
+        history, seq = self._hot.pop(session, (History(), 0))
+        last = self._last_seq(conn, session)
+        if last < seq:
+            # cleared by another process
+            history, seq = History(), 0
+        if last > seq:
+            rows = conn.execute(
+                "SELECT seq, messages FROM turns WHERE session = ? AND seq > ? ORDER BY seq",
+                (session, seq),
+            )
+            for seq, messages in rows:
+                history = history.extend(json.loads(messages))
+
+        self._hot[session] = (history, seq)
+        while len(self._hot) > self.cache_size:
+            self._hot.popitem(last=False)
+        return history, seq
+
+    def load(self, session: str) -> History:
+        """Get the history of `session`, empty if it has no turns yet"""
+        with self._lock:
+            return self._sync(self._connect(), session)[0]
+
+    def turns(self, session: str) -> int:
+        """Get the number of turns of `session`, without loading them"""
+        with self._lock:
+            return self._last_seq(self._connect(), session)
+
+    def append(self, session: str, messages: tg.Sequence[dict]) -> History:
+        """Append a turn to `session`, get its history including the turn"""
+        with self._lock:
+            conn = self._connect()
+            history, seq = self._sync(conn, session)
+            if not messages:
+                return history
+
+            # another process may have appended since, the key makes the insert fail then
+            while True:
+                try:
+                    with conn:
+                        conn.execute(
+                            "INSERT INTO turns (session, seq, messages, created) "
+                            "VALUES (?, ?, ?, ?)",
+                            (
+                                session,
+                                seq + 1,
+                                json.dumps(list(messages), ensure_ascii=False),
+                                time.time(),
+                            ),
+                        )
+                    break
+                except sqlite3.IntegrityError:
+                    history, seq = self._sync(conn, session)
+
+            history = history.extend(messages)
+            self._hot[session] = (history, seq + 1)
+            return history
+
+    def clear(self, session: str) -> None:
+        """Delete all turns of `session`"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM turns WHERE session = ?", (session,))
+            self._hot.pop(session, None)
+
+
+_store: SessionStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+    """Get the shared session store, hot sessions kept from `session_cache_size` in config.yaml"""
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            reload_config()
+            cache_size = QIANFAN_CONFIG.get("session_cache_size", DEFAULT_CACHE_SIZE)
+            _store = SessionStore(cache_size=int(cache_size))
+        return _store
+
+
+class SessionHistory:
+    """
+    Load a stored chat session as QIANFAN_HISTORY, e.g. to show or trim it
+    """
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def INPUT_TYPES(s):
+        """
+        Return a dictionary which contains config for all input fields.
+        """
+        return {
+            "required": {
+                "session_id": ("STRING", {"default": ""}),
+            },
+        }
+
+    @classmethod
+    def IS_CHANGED(s, session_id: str) -> tg.Hashable:
+        """self defined input change detection function, changes with every turn"""
+        return (session_id, get_session_store().turns(session_id))
+
+    RETURN_TYPES = (HISTORY_TYPE, "INT")
+    RETURN_NAMES = ("history", "turns")
+
+    FUNCTION = "load"
+
+    CATEGORY = "QianFan"
+
+    def load(self, session_id: str) -> tuple[History, int]:
+        """Load the history of the session"""
+        store = get_session_store()
+        return (store.load(session_id), store.turns(session_id))
+
+
+__all__ = ["SessionHistory", "SessionStore", "get_session_store"]
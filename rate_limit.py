@@ -0,0 +1,314 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+from .credentials import DEFAULT_NAME, Credential, get_pool
+from .metrics import annotate, get_registry
+from .tokens import count_tokens
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+R = tg.TypeVar("R")
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_CAP = 60.0
+
+# QianFan error codes for QPS / RPM / TPM limits
+THROTTLE_ERROR_CODES = {18, 336501, 336502}
+THROTTLE_MESSAGES = ("429", "rate limit", "qps limit", "too many requests")
+
+
+def is_throttle_error(e: BaseException) -> bool:
+    """Check whether an SDK exception means the request was throttled"""
+    code = getattr(e, "error_code", None) or getattr(e, "code", None)
+    try:
+        if int(code) in THROTTLE_ERROR_CODES or int(code) == 429:
+            return True
+    except (TypeError, ValueError):
+        pass
+
+    message = str(e).lower()
+    return any(m in message for m in THROTTLE_MESSAGES)
+
+
+def completion_tokens(resp: tg.Any) -> int:
+    """Get completion token usage from an SDK response, 0 if unavailable"""
+    try:
+        return int(resp["usage"]["completion_tokens"])
+    except Exception:
+        return 0
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at `per_minute` units per minute.
+
+    `reserve` debits immediately and returns how long the caller has to wait, so
+    callers are served in arrival order and the level may go negative.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Debit `amount` and return seconds to wait until it is covered"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def debit(self, amount: float) -> None:
+        """Debit `amount` after the fact, without waiting"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level -= amount
+
+
+class _Limiter:
+    """Request and token buckets of one model/endpoint, plus its stats"""
+
+    def __init__(self, name: str, rpm: float | None, tpm: float | None):
+        self.name = name
+        self.limits: tuple[float | None, float | None] = (None, None)
+        self.rpm: TokenBucket | None = None
+        self.tpm: TokenBucket | None = None
+        self.configure(rpm, tpm)
+        # config version the limits were resolved at
+        self.version = -1
+        self.queue_depth = 0
+        self.calls = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, rpm: float | None, tpm: float | None) -> None:
+        """Apply limits, only a bucket whose limit changed starts over"""
+        old_rpm, old_tpm = self.limits
+        if rpm != old_rpm:
+            self.rpm = TokenBucket(rpm) if rpm else None
+        if tpm != old_tpm:
+            self.tpm = TokenBucket(tpm) if tpm else None
+        self.limits = (rpm, tpm)
+
+    def reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.rpm is not None:
+            wait = max(wait, self.rpm.reserve(1))
+        if self.tpm is not None and tokens:
+            wait = max(wait, self.tpm.reserve(tokens))
+        return wait
+
+
+class RateScheduler:
+    """
+    Process-wide client-side rate limiting per credential set and model/endpoint key.
+
+    Limits come from `rate_limits` of the credential set, then `rate_limits` in
+    config.yaml, e.g.
+    `{"ERNIE-Speed-8K": {"rpm": 300, "tpm": 300000}, "default": {"rpm": 60}}`.
+    Calls over the limit wait in line instead of failing. Throttled calls are
+    retried on another credential set right away if one is healthy, else with
+    exponential backoff and full jitter.
+    """
+
+    def __init__(self):
+        self._limiters: dict[str, _Limiter] = {}
+        self._lock = threading.Lock()
+
+    def _get_limiter(self, cred: Credential, key: str) -> _Limiter:
+        version = reload_config()
+        # stats keep plain keys for the single legacy credential set
+        name = key if cred.name == DEFAULT_NAME else f"{cred.name}/{key}"
+        with self._lock:
+            limiter = self._limiters.get(name)
+            if limiter is None or limiter.version != version:
+                limits: dict = QIANFAN_CONFIG.get("rate_limits") or {}
+                limit = (
+                    cred.rate_limits.get(key)
+                    or cred.rate_limits.get("default")
+                    or limits.get(key)
+                    or limits.get("default")
+                    or {}
+                )
+                if limiter is None:
+                    limiter = self._limiters[name] = _Limiter(
+                        name, limit.get("rpm"), limit.get("tpm")
+                    )
+                else:
+                    limiter.configure(limit.get("rpm"), limit.get("tpm"))
+                limiter.version = version
+
+            return limiter
+
+    def _enter(self, limiter: _Limiter, tokens: int) -> float:
+        """Reserve budget for one call and return how long it has to wait"""
+        wait = limiter.reserve(tokens)
+        annotate(queue_wait=wait)
+        with self._lock:
+            limiter.queue_depth += 1
+            limiter.total_wait += wait
+            limiter.max_wait = max(limiter.max_wait, wait)
+            depth = limiter.queue_depth
+        get_registry().set_gauge(
+            "qianfan_rate_limit_queue_depth", (("key", limiter.name),), depth
+        )
+        return wait
+
+    def _leave(self, limiter: _Limiter) -> None:
+        with self._lock:
+            limiter.queue_depth -= 1
+            limiter.calls += 1
+            depth = limiter.queue_depth
+        get_registry().set_gauge(
+            "qianfan_rate_limit_queue_depth", (("key", limiter.name),), depth
+        )
+
+    def _backoff(
+        self, key: str, service: str, limiter: _Limiter, e: Exception, attempt: int
+    ) -> float:
+        """Get the delay before retrying a failed call, re-raise if it should not be"""
+        max_retries = int(
+            QIANFAN_CONFIG.get("rate_limit_max_retries", DEFAULT_MAX_RETRIES)
+        )
+        base = float(QIANFAN_CONFIG.get("rate_limit_backoff_base", DEFAULT_BACKOFF_BASE))
+        if not is_throttle_error(e) or attempt >= max_retries:
+            raise e
+
+        with self._lock:
+            limiter.throttled += 1
+        annotate(retries=1)
+        if get_pool().available(service):
+            logger.warning(f"Throttled on {key}, retrying with another credential set")
+            return 0.0
+
+        delay = random.uniform(0, min(DEFAULT_BACKOFF_CAP, base * 2**attempt))
+        logger.warning(
+            f"Throttled on {key}, retry {attempt + 1}/{max_retries} "
+            f"in {delay:.2f}s, reason: {repr(e)}"
+        )
+        return delay
+
+    async def arun(
+        self,
+        key: str,
+        fn: tg.Callable[[Credential], tg.Awaitable[R]],
+        prompt_tokens: int = 0,
+        service: str = "qianfan",
+    ) -> R:
+        """
+        Await `fn` with a credential set of `service` within the limits of `key`,
+        retrying throttled calls. Waiting does not block the event loop.
+        """
+        pool = get_pool()
+
+        attempt = 0
+        while True:
+            cred = pool.acquire(service)
+            annotate(credential=cred.name)
+            limiter = self._get_limiter(cred, key)
+            try:
+                wait = self._enter(limiter, prompt_tokens)
+                try:
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                finally:
+                    self._leave(limiter)
+
+                resp = await fn(cred)
+            except Exception as e:
+                pool.release(cred, is_throttle_error(e))
+                await asyncio.sleep(self._backoff(key, service, limiter, e, attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                pool.release(cred)
+                raise
+
+            pool.release(cred)
+            if limiter.tpm is not None:
+                limiter.tpm.debit(completion_tokens(resp))
+            return resp
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Get queue depth, wait time and throttle counters per key"""
+        with self._lock:
+            return {
+                key: {
+                    "queue_depth": limiter.queue_depth,
+                    "calls": limiter.calls,
+                    "throttled": limiter.throttled,
+                    "total_wait": limiter.total_wait,
+                    "max_wait": limiter.max_wait,
+                }
+                for key, limiter in self._limiters.items()
+            }
+
+
+_scheduler = RateScheduler()
+
+
+def get_scheduler() -> RateScheduler:
+    """Get the process-wide rate scheduler"""
+    return _scheduler
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate used to reserve TPM budget before a call"""
+    return count_tokens(text)
+
+
+async def arate_limited(
+    key: str,
+    fn: tg.Callable[[Credential], tg.Awaitable[R]],
+    text: str = "",
+    service: str = "qianfan",
+) -> R:
+    """Await `fn` with a credential set through the process-wide rate scheduler"""
+    return await _scheduler.arun(key, fn, estimate_tokens(text), service)
+
+
+__all__ = [
+    "RateScheduler",
+    "TokenBucket",
+    "arate_limited",
+    "estimate_tokens",
+    "get_scheduler",
+    "is_throttle_error",
+]
@@ -0,0 +1,320 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import typing as tg
+
+from .config import QIANFAN_CONFIG, reload_config
+from .metrics import annotate
+from .model_catalog import cache_dir
+from .singleflight import asingle_flight
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+sqlite_path = cache_dir / "responses.sqlite3"
+
+DEFAULT_MEMORY_MB = 64
+
+
+def make_key(kind: str, **parts: tg.Any) -> str:
+    """Hash parsed request parts into a stable cache key"""
+    payload = json.dumps(
+        {"kind": kind, **parts},
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheTier(tg.Protocol):
+    """Storage tier of ResponseCache, values are JSON strings"""
+
+    name: str
+
+    def get(self, key: str) -> str | None: ...
+
+    def put(self, key: str, value: str) -> None: ...
+
+    def clear(self) -> None: ...
+
+
+class MemoryTier:
+    """In-memory LRU tier, evicts least recently used entries above `max_bytes`"""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        cost = len(value.encode("utf-8"))
+        if cost > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old.encode("utf-8"))
+
+            self._data[key] = value
+            self.size += cost
+
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted.encode("utf-8"))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteTier:
+    """On-disk tier backed by SQLite, survives restarts"""
+
+    name = "sqlite"
+
+    def __init__(self, path=sqlite_path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT value FROM responses WHERE key = ?", (key,))
+                .fetchone()
+            )
+        return row[0] if row else None
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+
+
+class ResponseCache:
+    """Tiered response cache, lookups go through tiers in order and backfill faster tiers"""
+
+    def __init__(self, tiers: list[CacheTier]):
+        self.tiers = tiers
+        self.hits: collections.Counter[str] = collections.Counter()
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> tg.Any | None:
+        """Get cached value, None if missing"""
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(key)
+            except Exception as e:
+                logger.warning(f"Cache tier {tier.name} get failed, reason: {repr(e)}")
+                continue
+
+            if value is not None:
+                for faster in self.tiers[:i]:
+                    faster.put(key, value)
+                with self._lock:
+                    self.hits[tier.name] += 1
+                return json.loads(value)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: tg.Any) -> None:
+        """Store a JSON-serializable value in all tiers"""
+        data = json.dumps(value, ensure_ascii=False)
+        for tier in self.tiers:
+            try:
+                tier.put(key, data)
+            except Exception as e:
+                logger.warning(f"Cache tier {tier.name} put failed, reason: {repr(e)}")
+
+    def clear(self) -> None:
+        """Drop all entries in all tiers"""
+        for tier in self.tiers:
+            tier.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Get hit/miss counters"""
+        with self._lock:
+            return {
+                **{f"{name}_hits": count for name, count in self.hits.items()},
+                "hits": sum(self.hits.values()),
+                "misses": self.misses,
+            }
+
+
+_cache: ResponseCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Get the shared response cache, tiers are configured from config.yaml"""
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            reload_config()
+            memory_mb = float(
+                QIANFAN_CONFIG.get("response_cache_memory_mb", DEFAULT_MEMORY_MB)
+            )
+            tiers: list[CacheTier] = [MemoryTier(int(memory_mb * 1024 * 1024))]
+            if QIANFAN_CONFIG.get("response_cache_disk", False):
+                tiers.append(SQLiteTier())
+            _cache = ResponseCache(tiers)
+
+        return _cache
+
+
+def _lookup(key: str, similar: tuple[str, str | tg.Sequence[str]] | None) -> tuple | None:
+    """Get a cached result by exact key, then by prompt similarity if enabled"""
+    cached = get_response_cache().get(key)
+    if cached is not None:
+        logger.debug(f"Response cache hit: {key[:12]}")
+        annotate(cache_hit=True)
+        return tuple(cached)
+
+    if similar is None:
+        return None
+    # numpy is only imported once the semantic cache is used
+    from .semantic_cache import get_semantic_cache
+
+    semantic = get_semantic_cache()
+    found = semantic.get(*similar) if semantic is not None else None
+    if found is None:
+        return None
+
+    value, similarity = found
+    logger.debug(f"Semantic cache hit: {key[:12]}, similarity {similarity:.3f}")
+    annotate(cache_hit=True, cache_similarity=similarity)
+    return tuple(json.loads(value))
+
+
+def _store(key: str, similar: tuple[str, str | tg.Sequence[str]] | None, res: tuple) -> None:
+    get_response_cache().put(key, list(res))
+    if similar is None:
+        return
+    from .semantic_cache import get_semantic_cache
+
+    semantic = get_semantic_cache()
+    if semantic is not None:
+        semantic.put(*similar, json.dumps(list(res), ensure_ascii=False))
+
+
+async def _off_loop(
+    fn: tg.Callable[..., tg.Any], similar: tuple | None, *args: tg.Any
+) -> tg.Any:
+    """
+    Run a cache access in a worker thread if it may block the event loop, on
+    SQLite or a semantic index search and save, in place if memory only
+    """
+    if similar is None and all(
+        isinstance(tier, MemoryTier) for tier in get_response_cache().tiers
+    ):
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+async def acached_call(
+    key: str,
+    fn: tg.Callable[[], tg.Awaitable[tuple]],
+    use_cache: bool,
+    similar: tuple[str, str | tg.Sequence[str]] | None = None,
+    cacheable: tg.Callable[[tuple], bool] | None = None,
+) -> tuple:
+    """
+    Await `fn` for a node result tuple, served from response cache if `use_cache`.
+    Concurrent calls with the same key share one upstream call either way.
+    `similar` is a (scope, prompt text or parts) pair, with `semantic_cache` on
+    the result of a near-duplicate prompt in the same scope is served too.
+    Results `cacheable` rejects, e.g. failed extractions, are not stored.
+    """
+    if not use_cache:
+        return await asingle_flight(key, fn)
+
+    cached = await _off_loop(_lookup, similar, key, similar)
+    if cached is not None:
+        return cached
+
+    res = await asingle_flight(key, fn)
+    if cacheable is None or cacheable(res):
+        await _off_loop(_store, similar, key, similar, res)
+    return res
+
+
+__all__ = [
+    "CacheTier",
+    "MemoryTier",
+    "SQLiteTier",
+    "ResponseCache",
+    "acached_call",
+    "get_response_cache",
+    "make_key",
+]
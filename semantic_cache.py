@@ -0,0 +1,351 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import collections
+import json
+import logging
+import os
+import pathlib
+import re
+import threading
+import time
+import typing as tg
+import unicodedata
+
+import numpy as np
+
+from .config import QIANFAN_CONFIG, reload_config
+from .model_catalog import cache_dir
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+index_path = cache_dir / "semantic_cache.npz"
+
+DIM = 256
+NGRAM_SIZES = (2, 3)
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_MAX_ENTRIES = 10000
+# seconds between saves of a changed index, it is also saved at exit
+SAVE_INTERVAL = 60.0
+
+# punctuation, except a decimal separator between digits: 1.5 is not 15
+_SEPARATORS = re.compile(r"(?:(?!(?<=\d)[.,](?=\d))[\W_])+")
+_MULTIPLIER = np.uint64(0x100000001B3)
+_MIX = np.uint64(0xBF58476D1CE4E5B9)
+
+
+def normalize(text: str) -> str:
+    """Fold width and case, drop whitespace and punctuation but keep numbers intact"""
+    return _SEPARATORS.sub("", unicodedata.normalize("NFKC", text).casefold())
+
+
+def embed(text: str, dim: int = DIM) -> np.ndarray:
+    """
+    Embed text into a unit float32 vector of hashed, signed character n-gram
+    counts, single characters for text shorter than the n-grams. Deterministic
+    across processes, unlike `hash()` of str.
+    """
+    codes = np.frombuffer(normalize(text).encode("utf-32-le"), dtype=np.uint32)
+    codes = codes.astype(np.uint64)
+    vec = np.zeros(dim, dtype=np.float32)
+
+    for n in NGRAM_SIZES if len(codes) >= min(NGRAM_SIZES) else (1,):
+        count = len(codes) - n + 1
+        if count <= 0:
+            continue
+        h = np.full(count, n, dtype=np.uint64)
+        for i in range(n):
+            h = h * _MULTIPLIER + codes[i : i + count]
+        h ^= h >> np.uint64(31)
+        h *= _MIX
+        h ^= h >> np.uint64(29)
+
+        sign = 1.0 - 2.0 * (h >> np.uint64(63)).astype(np.float32)
+        vec += np.bincount(
+            (h % np.uint64(dim)).astype(np.intp), weights=sign, minlength=dim
+        ).astype(np.float32)
+
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+def embed_parts(parts: tg.Sequence[str], dim: int = DIM) -> np.ndarray:
+    """
+    Embed each part into its own `dim` columns of one vector. An empty part
+    gets a fixed unit vector, so it matches another empty part only.
+    """
+    vec = np.zeros(len(parts) * dim, dtype=np.float32)
+    for i, part in enumerate(parts):
+        part_vec = embed(part, dim)
+        if not part_vec.any():
+            part_vec[0] = 1.0
+        vec[i * dim : (i + 1) * dim] = part_vec
+    return vec
+
+
+class _Shard:
+    """Vectors and responses of one scope, freed rows are zeroed and reused"""
+
+    def __init__(self, dim: int, parts: int):
+        self.parts = parts
+        self.vectors = np.zeros((16, dim * parts), dtype=np.float32)
+        self.values: list[str | None] = []
+        self.free: list[int] = []
+
+    def add(self, vec: np.ndarray, value: str) -> int:
+        if self.free:
+            slot = self.free.pop()
+            self.values[slot] = value
+        else:
+            slot = len(self.values)
+            if slot == len(self.vectors):
+                grown = np.zeros((slot * 2, self.vectors.shape[1]), dtype=np.float32)
+                grown[:slot] = self.vectors
+                self.vectors = grown
+            self.values.append(value)
+        self.vectors[slot] = vec
+        return slot
+
+    def remove(self, slot: int) -> None:
+        self.vectors[slot] = 0.0
+        self.values[slot] = None
+        self.free.append(slot)
+
+    def search(self, vec: np.ndarray) -> tuple[int, float]:
+        """Get the row whose least similar part is the most similar, and that similarity"""
+        rows = self.vectors[: len(self.values)]
+        if self.parts == 1:
+            sims = rows @ vec
+        else:
+            sims = np.einsum(
+                "npd,pd->np",
+                rows.reshape(len(rows), self.parts, -1),
+                vec.reshape(self.parts, -1),
+            ).min(axis=1)
+        best = int(np.argmax(sims))
+        return best, float(sims[best])
+
+    def __len__(self) -> int:
+        return len(self.values) - len(self.free)
+
+
+class SemanticCache:
+    """
+    Responses of near-duplicate prompts, matched by cosine similarity of their
+    n-gram embeddings. Prompts only match within the same scope, e.g. node kind
+    and model. A prompt may be a sequence of parts, e.g. the parameters of a
+    template, compared one by one: a match needs every part to be similar.
+    Every prompt of a scope has the same number of parts. Least recently used
+    entries are evicted above `max_entries`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_THRESHOLD,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        path: pathlib.Path | None = None,
+        dim: int = DIM,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.dim = dim
+        self._shards: dict[str, _Shard] = {}
+        self._lru: collections.OrderedDict[tuple[str, int], None] = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+
+        if path is not None:
+            self.load()
+
+    def _embed(self, text: str | tg.Sequence[str]) -> np.ndarray:
+        return embed_parts([text] if isinstance(text, str) else text, self.dim)
+
+    def get(
+        self, scope: str, text: str | tg.Sequence[str]
+    ) -> tuple[str, float] | None:
+        """Get the cached value of the most similar prompt and its similarity, None if below threshold"""
+        start = time.perf_counter()
+        vec = self._embed(text)
+        with self._lock:
+            shard = self._shards.get(scope)
+            found = None
+            if shard is not None and len(shard) and shard.vectors.shape[1] == len(vec):
+                slot, sim = shard.search(vec)
+                value = shard.values[slot]
+                if sim >= self.threshold and value is not None:
+                    self._lru.move_to_end((scope, slot))
+                    found = (value, sim)
+
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+        return found
+
+    def put(self, scope: str, text: str | tg.Sequence[str], value: str) -> None:
+        """Store the value of a prompt, evicting least recently used entries"""
+        vec = self._embed(text)
+        with self._lock:
+            self._insert(scope, vec, value)
+            self._dirty = True
+
+        if self.path is not None and time.monotonic() - self._saved_at > SAVE_INTERVAL:
+            self.save()
+
+    def _insert(self, scope: str, vec: np.ndarray, value: str) -> None:
+        shard = self._shards.get(scope)
+        if shard is None:
+            shard = self._shards[scope] = _Shard(self.dim, len(vec) // self.dim)
+        elif shard.vectors.shape[1] != len(vec):
+            logger.warning(f"Prompt parts changed in semantic cache scope {scope[:12]}")
+            return
+        self._lru[(scope, shard.add(vec, value))] = None
+
+        while len(self._lru) > self.max_entries:
+            (old_scope, slot), _ = self._lru.popitem(last=False)
+            old_shard = self._shards[old_scope]
+            old_shard.remove(slot)
+            if not len(old_shard):
+                del self._shards[old_scope]
+
+    def save(self) -> None:
+        """Write the index to `path` if it changed since the last save"""
+        with self._lock:
+            self._saved_at = time.monotonic()
+            if self.path is None or not self._dirty:
+                return
+            entries = list(self._lru)
+            # rows of all scopes one after another, scopes differ in parts per row
+            vectors = np.concatenate(
+                [self._shards[scope].vectors[slot] for scope, slot in entries]
+                or [np.zeros(0, dtype=np.float32)]
+            )
+            meta = {
+                "dim": self.dim,
+                "parts": [self._shards[scope].parts for scope, _ in entries],
+                "scopes": [scope for scope, _ in entries],
+                "values": [self._shards[scope].values[slot] for scope, slot in entries],
+            }
+            self._dirty = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, vectors=vectors, meta=np.array(json.dumps(meta)))
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning(f"Failed to save semantic cache, reason: {repr(e)}")
+
+    def load(self) -> None:
+        """Read the index saved at `path`, oldest entries first"""
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                vectors = data["vectors"]
+                meta = json.loads(str(data["meta"]))
+        except Exception as e:
+            logger.warning(f"Failed to load semantic cache, reason: {repr(e)}")
+            return
+        if meta["dim"] != self.dim:
+            return
+
+        # an index saved before prompts had parts holds one part per row
+        parts = meta.get("parts") or [1] * len(meta["scopes"])
+        vectors = vectors.reshape(-1)
+        offsets = np.cumsum([0, *parts]) * self.dim
+        with self._lock:
+            for i, (scope, value) in enumerate(zip(meta["scopes"], meta["values"])):
+                self._insert(scope, vectors[offsets[i] : offsets[i + 1]], value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._shards.clear()
+            self._lru.clear()
+            self._dirty = True
+
+    def memory_bytes(self) -> int:
+        """Approximate memory held by vectors and cached values"""
+        with self._lock:
+            return sum(
+                shard.vectors.nbytes + sum(len(v) for v in shard.values if v)
+                for shard in self._shards.values()
+            )
+
+    def stats(self) -> dict[str, float]:
+        """Get entry count, hit rate, mean lookup latency and memory"""
+        memory = self.memory_bytes()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._lru),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "lookup_ms": self.lookup_seconds / lookups * 1000 if lookups else 0.0,
+                "memory_bytes": memory,
+            }
+
+
+_cache: SemanticCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache | None:
+    """Get the shared semantic cache, None unless `semantic_cache` is on in config.yaml"""
+    global _cache
+
+    reload_config()
+    if not QIANFAN_CONFIG.get("semantic_cache", False):
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticCache(
+                threshold=float(
+                    QIANFAN_CONFIG.get("semantic_cache_threshold", DEFAULT_THRESHOLD)
+                ),
+                max_entries=int(
+                    QIANFAN_CONFIG.get("semantic_cache_max_entries", DEFAULT_MAX_ENTRIES)
+                ),
+                path=(
+                    index_path if QIANFAN_CONFIG.get("response_cache_disk", False) else None
+                ),
+            )
+            atexit.register(_cache.save)
+        return _cache
+
+
+__all__ = ["SemanticCache", "embed", "embed_parts", "get_semantic_cache", "normalize"]
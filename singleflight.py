@@ -0,0 +1,127 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import asyncio
+import concurrent.futures
+import threading
+import typing as tg
+
+from .metrics import annotate
+
+R = tg.TypeVar("R")
+
+# errors meaning the leader was cancelled, not that the request itself failed
+CANCEL_ERRORS: tuple[type[BaseException], ...] = (
+    asyncio.CancelledError,
+    concurrent.futures.CancelledError,
+    KeyboardInterrupt,
+)
+try:
+    from comfy.model_management import InterruptProcessingException
+
+    CANCEL_ERRORS += (InterruptProcessingException,)
+except ImportError:
+    pass
+
+
+class _Call:
+    """One in-flight call, its outcome can be waited on from threads and coroutines"""
+
+    __slots__ = ("future",)
+
+    def __init__(self):
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one upstream call.
+
+    Waiters get the leader's result or exception. If the leader was cancelled
+    (e.g. its prompt was interrupted), waiters retry instead of failing with it.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.deduplicated = 0
+
+    def _join(self, key: str) -> tuple[_Call, bool]:
+        """Get the in-flight call of `key` and whether the caller leads it"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                return call, True
+            self.deduplicated += 1
+            return call, False
+
+    def _settle(
+        self, key: str, call: _Call, value: tg.Any, error: BaseException | None
+    ) -> None:
+        with self._lock:
+            del self._calls[key]
+        if error is None:
+            call.future.set_result(value)
+        else:
+            call.future.set_exception(error)
+
+    async def ado(self, key: str, fn: tg.Callable[[], tg.Awaitable[R]]) -> R:
+        """Await `fn` unless a call with `key` is in flight, then share its result"""
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                try:
+                    value = await fn()
+                except BaseException as e:
+                    self._settle(key, call, None, e)
+                    raise
+                self._settle(key, call, value, None)
+                return value
+
+            annotate(deduplicated=True)
+            try:
+                # shield, so a cancelled waiter does not cancel the shared call
+                return await asyncio.shield(asyncio.wrap_future(call.future))
+            except CANCEL_ERRORS:
+                if not call.future.done():
+                    raise
+
+    def stats(self) -> dict[str, int]:
+        """Get upstream call and deduplicated call counters"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "deduplicated": self.deduplicated,
+                "in_flight": len(self._calls),
+            }
+
+
+_flight = SingleFlight()
+
+
+async def asingle_flight(key: str, fn: tg.Callable[[], tg.Awaitable[R]]) -> R:
+    """Await `fn` through the process-wide single-flight group"""
+    return await _flight.ado(key, fn)
+
+
+def get_single_flight() -> SingleFlight:
+    """Get the process-wide single-flight group"""
+    return _flight
+
+
+__all__ = ["SingleFlight", "asingle_flight", "get_single_flight"]
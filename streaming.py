@@ -0,0 +1,131 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import logging
+import threading
+import time
+import typing as tg
+
+from .metrics import annotate
+
+# Set up logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(filename)s[line:%(lineno)d] - %(levelname)s: %(message)s"
+)
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+# event name listened by web/qianfan_stream.js
+STREAM_EVENT = "qianfan.stream"
+
+_stats_lock = threading.Lock()
+_stats = {"streams": 0, "ttft_total": 0.0, "ttft_last": 0.0}
+
+
+def send_progress(node_id: str | None, text: str, done: bool = False) -> None:
+    """Push partial text of a node to the ComfyUI frontend, no-op outside ComfyUI"""
+    if node_id is None:
+        return
+
+    try:
+        from server import PromptServer
+    except ImportError:
+        return
+
+    instance = getattr(PromptServer, "instance", None)
+    if instance is None:
+        return
+
+    instance.send_sync(STREAM_EVENT, {"node": str(node_id), "text": text, "done": done})
+
+
+class _Progress:
+    """Accumulate streamed text of one node and forward it to the frontend"""
+
+    def __init__(self, node_id: str | None):
+        self.node_id = node_id
+        self.begin = time.perf_counter()
+        self.parts: list[str] = []
+        self.ttft: float | None = None
+
+    def feed(self, chunk: str) -> None:
+        if not chunk:
+            return
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.begin
+            logger.debug(f"Time to first token: {self.ttft * 1000:.1f} ms")
+            annotate(ttft=self.ttft)
+        self.parts.append(chunk)
+        send_progress(self.node_id, "".join(self.parts))
+
+    def finish(self) -> str:
+        text = "".join(self.parts)
+        send_progress(self.node_id, text, done=True)
+
+        if self.ttft is not None:
+            with _stats_lock:
+                _stats["streams"] += 1
+                _stats["ttft_total"] += self.ttft
+                _stats["ttft_last"] = self.ttft
+
+        return text
+
+
+def stream_text(
+    start: tg.Callable[[], tg.Iterable[str]],
+    node_id: str | None,
+) -> str:
+    """
+    Start a stream with `start`, forward accumulated text to the frontend as chunks
+    arrive, and return the final text. Time-to-first-token is recorded.
+    """
+    progress = _Progress(node_id)
+    for chunk in start():
+        progress.feed(chunk)
+    return progress.finish()
+
+
+async def astream_text(
+    start: tg.Callable[[], tg.AsyncIterable[str]],
+    node_id: str | None,
+) -> str:
+    """Async counterpart of `stream_text`"""
+    progress = _Progress(node_id)
+    async for chunk in start():
+        progress.feed(chunk)
+    return progress.finish()
+
+
+def get_stream_stats() -> dict[str, float]:
+    """Get stream count and time-to-first-token stats in seconds"""
+    with _stats_lock:
+        streams = _stats["streams"]
+        return {
+            **_stats,
+            "ttft_mean": _stats["ttft_total"] / streams if streams else 0.0,
+        }
+
+
+__all__ = [
+    "STREAM_EVENT",
+    "astream_text",
+    "get_stream_stats",
+    "send_progress",
+    "stream_text",
+]
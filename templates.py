@@ -0,0 +1,113 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import functools
+import itertools
+import string
+import typing as tg
+
+# params key holding lists to combine, unless the template has a placeholder of that name
+SWEEP_KEY = "sweep"
+MAX_RENDERINGS = 1024
+
+_formatter = string.Formatter()
+
+
+@dataclasses.dataclass(frozen=True)
+class Template:
+    """A prompt template in `str.format` syntax, parsed once"""
+
+    text: str
+    # (literal text, placeholder name or None)
+    segments: tuple[tuple[str, str | None], ...]
+    fields: tuple[str, ...]
+    # placeholders with a format spec, conversion or attribute access go through str.format
+    simple: bool
+
+    def missing(self, params: tg.Mapping[str, tg.Any]) -> list[str]:
+        """Get placeholders without a value in `params`"""
+        return [f for f in self.fields if f not in params]
+
+    def render(self, params: tg.Mapping[str, tg.Any]) -> str:
+        """Fill in the placeholders, raises KeyError if one is missing"""
+        if not self.simple:
+            return self.text.format_map(params)
+        return "".join(
+            literal if name is None else literal + str(params[name])
+            for literal, name in self.segments
+        )
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(text: str) -> Template:
+    """Parse a prompt template, results are cached by template text"""
+    segments: list[tuple[str, str | None]] = []
+    fields: dict[str, None] = {}
+    simple = True
+    for literal, field, spec, conversion in _formatter.parse(text):
+        if field is None:
+            segments.append((literal, None))
+            continue
+        if field == "" or field.isdigit():
+            raise ValueError(
+                "positional placeholders are not supported, name them, e.g. {object}"
+            )
+
+        name = field.split(".", 1)[0].split("[", 1)[0]
+        fields[name] = None
+        simple = simple and name == field and not spec and not conversion
+        segments.append((literal, name))
+
+    return Template(text, tuple(segments), tuple(fields), simple)
+
+
+def expand_params(params: tg.Any, template: Template) -> list[dict[str, tg.Any]] | None:
+    """
+    Expand the params of a sweep into the params of each rendering, in order:
+    a list of mappings, or a mapping whose `sweep` key maps names to lists of
+    values, combined as a cartesian product with the other keys fixed.
+    None if `params` is a single mapping.
+    """
+    if isinstance(params, list):
+        if not all(isinstance(p, dict) for p in params):
+            raise ValueError("every item of a params list must be a mapping")
+        renderings = params
+    elif not isinstance(params, dict):
+        raise ValueError("params must be a mapping or a list of mappings")
+    elif SWEEP_KEY in params and SWEEP_KEY not in template.fields:
+        sweep = params[SWEEP_KEY]
+        if not isinstance(sweep, dict) or not sweep:
+            raise ValueError(f"{SWEEP_KEY} must map names to lists of values")
+
+        base = {k: v for k, v in params.items() if k != SWEEP_KEY}
+        names = list(sweep)
+        axes = [v if isinstance(v, list) else [v] for v in sweep.values()]
+        count = 1
+        for axis in axes:
+            count *= len(axis)
+        if count > MAX_RENDERINGS:
+            raise ValueError(f"{count} renderings in sweep, at most {MAX_RENDERINGS}")
+        renderings = [
+            {**base, **dict(zip(names, values))} for values in itertools.product(*axes)
+        ]
+    else:
+        return None
+
+    if len(renderings) > MAX_RENDERINGS:
+        raise ValueError(f"{len(renderings)} renderings in sweep, at most {MAX_RENDERINGS}")
+    return renderings
+
+
+__all__ = ["SWEEP_KEY", "Template", "compile_template", "expand_params"]
@@ -0,0 +1,60 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from comfyui_qianfan_llm.tokens import message_tokens, trim_messages
+
+
+def words(n: int) -> str:
+    """Text estimated at `n` tokens"""
+    return " ".join(["word"] * n)
+
+
+def turn(user: int, assistant: int) -> list[dict]:
+    return [
+        {"role": "user", "content": words(user)},
+        {"role": "assistant", "content": words(assistant)},
+    ]
+
+
+def test_trim_keeps_whole_turns():
+    messages = turn(5, 5) + turn(10, 10)
+    kept, dropped = trim_messages(messages, 25)
+
+    assert kept == messages[2:]
+    assert dropped == messages[:2]
+
+
+def test_trim_never_starts_with_assistant():
+    # the last turn alone exceeds the budget, its reply alone would fit
+    messages = turn(5, 5) + turn(20, 10)
+    assert message_tokens(messages[-1]) <= 25
+
+    kept, dropped = trim_messages(messages, 25)
+
+    assert kept == []
+    assert dropped == messages
+
+
+def test_trim_drops_leading_assistant():
+    messages = [{"role": "assistant", "content": words(5)}, *turn(5, 5)]
+    kept, dropped = trim_messages(messages, 100)
+
+    assert kept == messages[1:]
+    assert [m["role"] for m in kept] == ["user", "assistant"]
+    assert dropped == messages[:1]
+
+
+def test_trim_fitting_history_is_kept():
+    messages = turn(5, 5) + turn(5, 5)
+    assert trim_messages(messages, 20) == (messages, [])
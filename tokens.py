@@ -0,0 +1,101 @@
+# Copyright 2024 SLAPaper
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import functools
+import re
+
+from .config import QIANFAN_CONFIG, reload_config
+
+# same approximation as the local mode of qianfan.Tokenizer:
+# 0.625 token per CJK character, 1 token per other word
+HAN_TOKEN_RATIO = 0.625
+WORD_TOKEN_RATIO = 1.0
+
+DEFAULT_CONTEXT_TOKENS = 8 * 1024
+DEFAULT_OUTPUT_RESERVE = 2048
+
+_han_re = re.compile(r"[⺀-鿿豈-﫿＀-￯]")
+_word_re = re.compile(r"[^\s⺀-鿿豈-﫿＀-￯!-/:-@\[-`{-~]+")
+_context_re = re.compile(r"(\d+)K", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Estimate token count of `text` locally, results are cached"""
+    han = len(_han_re.findall(text))
+    words = len(_word_re.findall(text))
+    return int(han * HAN_TOKEN_RATIO + words * WORD_TOKEN_RATIO)
+
+
+def message_tokens(message: dict) -> int:
+    """Estimate token count of one chat message"""
+    return count_tokens(str(message.get("content", "")))
+
+
+def messages_tokens(messages: list[dict]) -> int:
+    """Estimate token count of chat messages"""
+    return sum(message_tokens(m) for m in messages)
+
+
+def context_tokens(model: str) -> int:
+    """
+    Get context size of `model`, from `model_context_tokens` in config.yaml or
+    the size in its name (e.g. ERNIE-Speed-128K)
+    """
+    reload_config()
+    overrides: dict = QIANFAN_CONFIG.get("model_context_tokens") or {}
+    if model in overrides:
+        return int(overrides[model])
+
+    match = _context_re.search(model)
+    return int(match.group(1)) * 1024 if match else DEFAULT_CONTEXT_TOKENS
+
+
+def history_budget(model: str) -> int:
+    """Get token budget for history of `model`, leaving room for the reply"""
+    reserve = int(QIANFAN_CONFIG.get("history_output_reserve", DEFAULT_OUTPUT_RESERVE))
+    return max(0, context_tokens(model) - reserve)
+
+
+def trim_messages(messages: list[dict], budget: int) -> tuple[list[dict], list[dict]]:
+    """
+    Drop the oldest turns until `messages` fit in `budget` tokens.
+
+    Messages are dropped up to the next user message, so a user message goes
+    together with the assistant reply that follows and the kept messages still
+    start with a user message. If the last turn alone does not fit, nothing is
+    kept. Returns (kept, dropped).
+    """
+    sizes = [message_tokens(m) for m in messages]
+    total = sum(sizes)
+    start = 0
+
+    while start < len(messages) and (
+        total > budget or messages[start].get("role") != "user"
+    ):
+        total -= sizes[start]
+        start += 1
+
+    return messages[start:], messages[:start]
+
+
+__all__ = [
+    "context_tokens",
+    "count_tokens",
+    "history_budget",
+    "message_tokens",
+    "messages_tokens",
+    "trim_messages",
+]
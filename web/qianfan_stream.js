@@ -0,0 +1,31 @@
+import { app } from "../../scripts/app.js";
+import { api } from "../../scripts/api.js";
+import { ComfyWidgets } from "../../scripts/widgets.js";
+
+// Show partial text streamed by QianFan nodes, see streaming.py
+app.registerExtension({
+  name: "QianFan.Stream",
+  setup() {
+    api.addEventListener("qianfan.stream", ({ detail }) => {
+      const node = app.graph.getNodeById(Number(detail.node));
+      if (!node) {
+        return;
+      }
+
+      let widget = node.widgets?.find((w) => w.name === "stream_preview");
+      if (!widget) {
+        widget = ComfyWidgets["STRING"](
+          node,
+          "stream_preview",
+          ["STRING", { multiline: true }],
+          app
+        ).widget;
+        widget.inputEl.readOnly = true;
+        widget.serialize = false;
+      }
+
+      widget.value = detail.text;
+      node.setDirtyCanvas(true, false);
+    });
+  },
+});